@@ -0,0 +1,52 @@
+import argparse
+import json
+import sys
+
+
+def result_key(result):
+    return (result['name'], json.dumps(result['params'], sort_keys=True))
+
+
+def compare(base, head, threshold, stat='median'):
+    base_results = dict((result_key(result), result) for result in base['results'])
+    rows = []
+    regressions = []
+    for result in head['results']:
+        key = result_key(result)
+        if key not in base_results:
+            continue
+
+        before = base_results[key]['seconds'][stat]
+        after = result['seconds'][stat]
+        ratio = after / before if before else float('inf')
+        rows.append((key, before, after, ratio))
+        if ratio > 1 + threshold:
+            regressions.append(key)
+    return rows, regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='Compare two benchmark JSON reports.')
+    parser.add_argument('base')
+    parser.add_argument('head')
+    parser.add_argument('--threshold', type=float, default=0.1,
+        help='fail when head is slower than base by more than this fraction')
+    parser.add_argument('--stat', default='median', choices=['min', 'median', 'p95', 'p99', 'max'])
+    args = parser.parse_args()
+
+    with open(args.base) as base, open(args.head) as head:
+        rows, regressions = compare(json.load(base), json.load(head),
+            args.threshold, args.stat)
+
+    for (name, params), before, after, ratio in rows:
+        flag = ' <-- slower' if (name, params) in regressions else ''
+        print '{:<30} {:<45} {:.4f}s -> {:.4f}s ({:+.1%}){}'.format(
+            name, params, before, after, ratio - 1, flag)
+
+    if regressions:
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
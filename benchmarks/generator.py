@@ -0,0 +1,123 @@
+import random
+from datetime import datetime, timedelta
+
+ACTIONS = [('view', 60), ('signup', 15), ('add_cart', 12), ('buy', 8), ('share', 5)]
+PLANS = [('free', 80), ('basic', 15), ('pro', 5)]
+COUNTRIES = [('us', 50), ('gb', 15), ('de', 12), ('fr', 10), ('br', 8), ('jp', 5)]
+
+
+class EventGenerator(object):
+
+    def __init__(self, seed=0, start=datetime(2013, 1, 1), days=365,
+            abtests=('checkout', 'pricing'), max_actions=200):
+        self.random = random.Random(seed)
+        self.start = start
+        self.days = days
+        self.abtests = abtests
+        self.max_actions = max_actions
+
+    def choice(self, weighted):
+        point = self.random.uniform(0, sum(weight for value, weight in weighted))
+        for value, weight in weighted:
+            point -= weight
+            if point <= 0:
+                return value
+        return weighted[-1][0]
+
+    def users(self, count):
+        for id in xrange(count):
+            yield self.user(id)
+
+    def user(self, id):
+        offset = self.days * self.random.random() ** 0.5
+        created_at = self.start + timedelta(days=offset)
+        user = {
+            '_id': id,
+            'created_at': created_at,
+            'plan': self.choice(PLANS),
+            'country': self.choice(COUNTRIES),
+            'ab': dict((test, self.random.randint(0, 1)) for test in self.abtests),
+            'actions': []
+        }
+
+        count = min(int(self.random.paretovariate(1.2)) - 1, self.max_actions)
+        for idx in range(count):
+            user['actions'].append(self.action(created_at))
+        user['actions'].sort(key=lambda action: action['created_at'])
+        user['updated_at'] = max([created_at] + 
+            [action['created_at'] for action in user['actions']])
+        return user
+
+    def action(self, created_at):
+        action = {
+            'name': self.choice(ACTIONS),
+            'created_at': created_at + timedelta(
+                seconds=int(self.random.expovariate(1 / (14 * 86400.0))))
+        }
+        if action['name'] == 'buy':
+            action['amount'] = int(self.random.lognormvariate(3, 1)) + 1
+            action['item'] = self.random.choice(['book', 'game', 'music', 'app'])
+        return action
+
+    def load(self, db, count, batch_size=1000):
+        batch = []
+        for user in self.users(count):
+            batch.append(user)
+            if len(batch) >= batch_size:
+                db.users.insert(batch)
+                batch = []
+        if batch:
+            db.users.insert(batch)
+
+    def period(self, idx):
+        return (self.start + timedelta(days=7 * idx)).strftime('%Y/%m/%d')
+
+    def stat(self, calc, total, n):
+        return {'value': total / float(n) if n else 0, 'calc': calc,
+            'total': total, 'n': n}
+
+    def funnel_results(self, count):
+        results = []
+        plans = [plan for plan, weight in PLANS]
+        for idx in xrange(count):
+            total = self.random.randint(1, 5000)
+            buy = self.random.randint(0, total)
+            results.append({
+                '_id': {'created_at': self.period(idx // len(plans)),
+                    'plan': plans[idx % len(plans)]},
+                'value': {
+                    'total': {'value': total, 'calc': 'sum'},
+                    'buy': {'value': buy, 'calc': 'sum'},
+                    'avg_buy': self.stat('avg', buy, total),
+                    'pct_buy': self.stat('pct', self.random.randint(0, total), total)
+                }
+            })
+        return results
+
+    def ab_results(self, count):
+        results = []
+        for variation in range(2):
+            value = {'total': {'value': 10000, 'calc': 'sum'}}
+            for idx in xrange(count):
+                total = self.random.randint(0, 10000)
+                value['metric_{}'.format(idx)] = self.stat('pct', total, 10000)
+            results.append({
+                '_id': {'checkout': 'variation_{}'.format(variation)},
+                'value': value
+            })
+        return results
+
+    def retention_results(self, count, periods=12):
+        results = []
+        for idx in xrange(count):
+            start = self.random.randint(100, 5000)
+            value = {}
+            remaining = start
+            for period in range(periods):
+                value[self.period(idx + period)] = {
+                    'total': remaining,
+                    'pct': self.stat('pct', remaining, start)
+                }
+                remaining = int(remaining * self.random.uniform(0.3, 0.9))
+            results.append({'_id': {'created_at': self.period(idx)}, 'value': value})
+        return results
@@ -0,0 +1,243 @@
+import argparse
+import json
+import random
+import threading
+import time
+from datetime import datetime, timedelta
+
+from benchmarks.generator import ACTIONS, PLANS, EventGenerator
+from benchmarks.suite import git_commit
+from dashgourd.api.actions import ActionsApi
+from dashgourd.testing import FakeDatabase
+
+OPERATIONS = [
+    ('create_user', 5),
+    ('insert_action', 60),
+    ('insert_action_unique', 20),
+    ('update_profile', 10),
+    ('tag_abtest', 5)
+]
+
+HISTOGRAM = [0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01,
+    0.025, 0.05, 0.1, 0.25, 0.5, 1.0]
+
+
+def percentile(timings, pct):
+    if not timings:
+        return None
+    return timings[min(int(len(timings) * pct), len(timings) - 1)]
+
+
+def histogram(timings):
+    counts = [0] * (len(HISTOGRAM) + 1)
+    bucket = 0
+    for timing in timings:
+        while bucket < len(HISTOGRAM) and timing > HISTOGRAM[bucket]:
+            bucket += 1
+        counts[bucket] += 1
+    return [{'le': le, 'count': count} for le, count in zip(HISTOGRAM + [None], counts)]
+
+
+class IngestLoad(object):
+
+    def __init__(self, api, users=1000, workers=8, duration=10.0, 
+            mix=None, seed=0, actions_per_user=0):
+        self.api = api
+        self.users = users
+        self.workers = workers
+        self.duration = duration
+        self.mix = mix or OPERATIONS
+        self.seed = seed
+        self.actions_per_user = actions_per_user
+        self.lock = threading.Lock()
+        self.next_id = users
+        self.timings = dict((name, []) for name, weight in self.mix)
+        self.errors = dict((name, 0) for name, weight in self.mix)
+        self.timeline = []
+
+    def prepare(self):
+        generator = EventGenerator(self.seed, max_actions=self.actions_per_user)
+        for user in generator.users(self.users):
+            actions = user.pop('actions')
+            self.api.create_user(user)
+            for action in actions:
+                self.api.insert_action(user['_id'], action)
+
+    def new_id(self):
+        with self.lock:
+            self.next_id += 1
+            return self.next_id
+
+    def operation(self, name, generator):
+        id = generator.random.randrange(self.users)
+        created_at = datetime.utcnow()
+
+        if name == 'create_user':
+            return lambda: self.api.create_user(
+                {'_id': self.new_id(), 'created_at': created_at, 
+                    'plan': generator.choice(PLANS)})
+        elif name == 'insert_action':
+            return lambda: self.api.insert_action(id, 
+                {'name': generator.choice(ACTIONS), 'created_at': created_at})
+        elif name == 'insert_action_unique':
+            return lambda: self.api.insert_action(id, 
+                {'name': 'badge', 'level': generator.random.randint(0, 50), 
+                    'created_at': created_at}, True)
+        elif name == 'update_profile':
+            return lambda: self.api.update_profile(id, 
+                {'plan': generator.choice(PLANS), 'updated_at': created_at})
+        elif name == 'tag_abtest':
+            return lambda: self.api.tag_abtest(id, 
+                {'abtest': 'checkout', 'variation': generator.random.randint(0, 1)})
+
+    def work(self, worker, deadline, start):
+        generator = EventGenerator(self.seed + worker + 1)
+        timings = dict((name, []) for name, weight in self.mix)
+        errors = dict((name, 0) for name, weight in self.mix)
+        timeline = []
+
+        while time.time() < deadline:
+            name = generator.choice(self.mix)
+            operation = self.operation(name, generator)
+            began = time.time()
+            try:
+                operation()
+            except Exception:
+                errors[name] += 1
+                continue
+            elapsed = time.time() - began
+            timings[name].append(elapsed)
+            timeline.append((int(began - start), elapsed))
+
+        with self.lock:
+            for name in timings:
+                self.timings[name].extend(timings[name])
+                self.errors[name] += errors[name]
+            self.timeline.extend(timeline)
+
+    def run(self):
+        start = time.time()
+        deadline = start + self.duration
+        threads = [threading.Thread(target=self.work, args=(worker, deadline, start))
+            for worker in range(self.workers)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        return self.report(time.time() - start)
+
+    def report(self, elapsed):
+        params = {'workers': self.workers, 'users': self.users,
+            'actions_per_user': self.actions_per_user}
+        results = []
+        for name, weight in self.mix:
+            results.append(self.summary('ingest.' + name, params, 
+                self.timings[name], self.errors[name], elapsed))
+        results.append(self.summary('ingest.total', params,
+            sum(self.timings.values(), []), sum(self.errors.values()), elapsed))
+
+        seconds = {}
+        for second, timing in self.timeline:
+            seconds.setdefault(second, []).append(timing)
+
+        timeline = []
+        for second in sorted(seconds):
+            timings = sorted(seconds[second])
+            timeline.append({'second': second, 'ops': len(timings),
+                'p95': percentile(timings, 0.95)})
+
+        return {
+            'meta': {
+                'commit': git_commit(),
+                'seed': self.seed,
+                'duration': elapsed,
+                'created_at': datetime.utcnow().isoformat()
+            },
+            'results': results,
+            'timeline': timeline
+        }
+
+    def summary(self, name, params, timings, errors, elapsed):
+        timings = sorted(timings)
+        return {
+            'name': name,
+            'params': params,
+            'count': len(timings),
+            'errors': errors,
+            'ops_per_sec': len(timings) / elapsed if elapsed else 0,
+            'seconds': {
+                'min': timings[0] if timings else None,
+                'median': percentile(timings, 0.5),
+                'p95': percentile(timings, 0.95),
+                'p99': percentile(timings, 0.99),
+                'max': timings[-1] if timings else None
+            },
+            'histogram': histogram(timings)
+        }
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Drive ActionsApi from concurrent '
+        'workers and report throughput and latency percentiles.')
+    parser.add_argument('--mongo-uri', help='run against this server instead of '
+        'the in-process FakeDatabase')
+    parser.add_argument('--mongo-db', default='dashgourd_ingest')
+    parser.add_argument('--layout', default='embedded', choices=['embedded', 'bucketed'])
+    parser.add_argument('--users', type=int, default=1000)
+    parser.add_argument('--actions-per-user', type=int, default=0,
+        help='preload each user with up to this many actions')
+    parser.add_argument('--workers', type=int, default=8)
+    parser.add_argument('--duration', type=float, default=10.0)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--output', help='write the report as JSON to this file')
+    parser.add_argument('--drop', action='store_true', help='drop existing users, '
+        'action buckets and action keys in --mongo-db before the run')
+    args = parser.parse_args()
+
+    if args.mongo_uri:
+        api = ActionsApi(args.mongo_uri, args.mongo_db, layout=args.layout)
+        try:
+            clear_collections(api, args.drop)
+        except ValueError as e:
+            parser.error(str(e))
+    else:
+        api = ActionsApi(FakeDatabase(), layout=args.layout)
+    api.ensure_indexes()
+
+    load = IngestLoad(api, args.users, args.workers, args.duration, 
+        seed=args.seed, actions_per_user=args.actions_per_user)
+    load.prepare()
+    report = load.run()
+
+    for result in report['results']:
+        seconds = result['seconds']
+        print '{:<30} {:>8} ops {:>10.1f}/s  p50 {}  p95 {}  p99 {}  errors {}'.format(
+            result['name'], result['count'], result['ops_per_sec'],
+            *[format_ms(seconds[stat]) for stat in ('median', 'p95', 'p99')] +
+            [result['errors']])
+
+    if args.output:
+        with open(args.output, 'w') as output:
+            json.dump(report, output, indent=2, sort_keys=True)
+
+
+def clear_collections(api, drop=False):
+    names = [name for name in ('users', api.buckets, api.keys)
+        if api.db[name].find_one() is not None]
+    if names and not drop:
+        raise ValueError('{} is not empty ({}); pass --drop to clear it'.format(
+            api.db.name, ', '.join(names)))
+
+    for name in names:
+        api.db[name].drop()
+    return names
+
+
+def format_ms(seconds):
+    if seconds is None:
+        return '-'
+    return '{:.2f}ms'.format(seconds * 1000)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,193 @@
+import argparse
+import gc
+import json
+import platform
+import shutil
+import subprocess
+import tempfile
+import time
+from datetime import datetime
+
+from benchmarks.generator import EventGenerator
+from dashgourd.api.charts import ChartsApi
+from dashgourd.charts.compiler import ChartCompiler
+from dashgourd.charts.formatters import FormatAb, FormatCombo, FormatRetention, FormatTable
+from dashgourd.testing import FakeDatabase
+
+CHARTS = [
+    ('cohort_funnel', {
+        'query': {'created_at': {'$gte': datetime(2013, 1, 1)}},
+        'group': [
+            {'attr': 'created_at', 'format': 'monthly'},
+            {'attr': 'plan'}
+        ],
+        'calc': [
+            {'attr': 'signup', 'calc': 'pct'},
+            {'attr': 'buy', 'calc': 'avg', 
+                'bucket': {'type': 'range', 'value': [0, 1, [2, 5], [6, None]]}},
+            {'attr': 'buy', 'meta': 'amount', 'calc': 'avg'},
+            {'attr': ['view', 'share'], 'calc': 'pct', 
+                'cond': {'type': 'at_least', 'value': 3}}
+        ]
+    }),
+    ('action_cohort', {
+        'query': {},
+        'pivot': 'item',
+        'group': [
+            {'attr': 'plan'},
+            {'type': 'action', 'attr': 'buy', 'meta': 'created_at', 'format': 'monthly'}
+        ],
+        'calc': [{'attr': 'buy', 'meta': 'amount', 'calc': 'avg'}]
+    }),
+    ('retention', {
+        'query': {},
+        'group': [{'attr': 'created_at', 'format': 'weekly'}],
+        'action': 'view'
+    })
+]
+
+
+def timed(func, repeat):
+    timings = []
+    for idx in range(repeat):
+        gc.collect()
+        start = time.time()
+        func()
+        timings.append(time.time() - start)
+    timings.sort()
+    return {
+        'min': timings[0],
+        'median': timings[len(timings) // 2],
+        'max': timings[-1]
+    }
+
+
+def git_commit():
+    try:
+        return subprocess.check_output(
+            ['git', 'rev-parse', 'HEAD'], stderr=subprocess.STDOUT).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+class BenchmarkSuite(object):
+
+    def __init__(self, seed=0, repeat=3, users=10000, rows=(10000, 100000)):
+        self.seed = seed
+        self.repeat = repeat
+        self.users = users
+        self.rows = rows
+        self.results = []
+
+    def record(self, name, params, timings):
+        self.results.append({'name': name, 'params': params, 'seconds': timings})
+        print '{:<40} {:<40} {:.4f}s'.format(
+            name, json.dumps(params, sort_keys=True), timings['median'])
+
+    def run(self, groups=('compile', 'charts', 'formatters')):
+        for group in groups:
+            getattr(self, 'bench_' + group)()
+        return {
+            'meta': {
+                'commit': git_commit(),
+                'python': platform.python_version(),
+                'platform': platform.platform(),
+                'seed': self.seed,
+                'repeat': self.repeat,
+                'created_at': datetime.utcnow().isoformat()
+            },
+            'results': self.results
+        }
+
+    def bench_compile(self):
+        api = ChartsApi(FakeDatabase())
+        for plugin, options in CHARTS:
+            plugin = api.plugins[plugin]
+            self.record('compile.cold', {'plugin': type(plugin).__name__},
+                timed(lambda: ChartCompiler().compile(plugin, options), self.repeat))
+
+            compiler = ChartCompiler()
+            compiler.compile(plugin, options)
+            self.record('compile.warm', {'plugin': type(plugin).__name__},
+                timed(lambda: compiler.compile(plugin, options), self.repeat))
+
+    def bench_charts(self):
+        db = FakeDatabase()
+        EventGenerator(self.seed).load(db, self.users)
+        api = ChartsApi(db)
+
+        for plugin, options in CHARTS:
+            self.record('chart.fake_mapreduce', {'plugin': plugin, 'users': self.users},
+                timed(lambda: api.generate_chart(plugin, 'bench', options), self.repeat))
+
+        try:
+            from dashgourd.snapshot import SnapshotEngine, export_snapshot
+        except ImportError:
+            return
+
+        path = tempfile.mkdtemp()
+        try:
+            engine = SnapshotEngine(export_snapshot(db, path))
+            for plugin, options in CHARTS:
+                self.record('chart.snapshot', {'plugin': plugin, 'users': self.users},
+                    timed(lambda: engine.run(plugin, options), self.repeat))
+        finally:
+            shutil.rmtree(path)
+
+    def bench_formatters(self):
+        generator = EventGenerator(self.seed)
+        fields = [
+            {'name': 'buy'},
+            {'name': 'avg_buy'},
+            {'name': 'pct_buy'}
+        ]
+        table_fields = [
+            {'name': 'created_at', 'is_key_col': True, 'data_type': 'date'},
+            {'name': 'plan', 'is_key_col': True, 'data_type': 'string'}
+        ] + fields
+
+        for rows in self.rows:
+            results = generator.funnel_results(rows)
+            self.record('format.table', {'rows': rows}, timed(
+                lambda: FormatTable().build(results, table_fields), self.repeat))
+            self.record('format.combo', {'rows': rows}, timed(
+                lambda: FormatCombo().build(results, fields, {'name': 'created_at'}, 'plan'),
+                self.repeat))
+            results = None
+
+            results = generator.ab_results(rows)
+            ab_fields = [{'name': name} for name in results[0]['value']]
+            self.record('format.ab', {'rows': rows}, timed(
+                lambda: FormatAb().build(results, ab_fields), self.repeat))
+            results = None
+
+            results = generator.retention_results(rows)
+            self.record('format.retention', {'rows': rows}, timed(
+                lambda: FormatRetention().build(results), self.repeat))
+            results = None
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Time chart compilation, '
+        'chart execution and formatters against a seeded synthetic data set.')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--repeat', type=int, default=3)
+    parser.add_argument('--users', type=int, default=10000)
+    parser.add_argument('--rows', default='10000,100000',
+        help='comma separated formatter input sizes')
+    parser.add_argument('--only', default='compile,charts,formatters',
+        help='comma separated benchmark groups')
+    parser.add_argument('--output', help='write results as JSON to this file')
+    args = parser.parse_args()
+
+    suite = BenchmarkSuite(args.seed, args.repeat, args.users,
+        [int(rows) for rows in args.rows.split(',')])
+    report = suite.run(args.only.split(','))
+
+    if args.output:
+        with open(args.output, 'w') as output:
+            json.dump(report, output, indent=2, sort_keys=True)
+
+
+if __name__ == '__main__':
+    main()
@@ -1,38 +1,315 @@
 import copy
+import hashlib
+import pymongo
+from collections import OrderedDict
+from datetime import datetime
+from bson import json_util
+from bson.son import SON
+from pymongo.errors import BulkWriteError, DuplicateKeyError
 from dashgourd.api.helper import init_mongodb
 
 class ActionsApi(object):
 
-    def __init__(self, mongodb, dbname=None):
+    def __init__(self, mongodb, dbname=None, layout='embedded', 
+            buckets='action_buckets', keys='action_keys'):
         if type(mongodb) is str:
             self.db = init_mongodb(mongodb, dbname)
         else:
             self.db = mongodb
+
+        if layout not in ('embedded', 'bucketed'):
+            raise ValueError("layout must be 'embedded' or 'bucketed'")
+
+        self.layout = layout
+        self.buckets = buckets
+        self.keys = keys
     
 
+    def ensure_indexes(self):
+        if self.layout == 'bucketed':
+            return [self.db[self.buckets].create_index(
+                [('user_id', pymongo.ASCENDING), ('month', pymongo.ASCENDING)],
+                background=True)]
+        else:
+            return [
+                self.db.users.create_index(
+                    [('created_at', pymongo.ASCENDING)], background=True),
+                self.db.users.create_index(
+                    [('actions.name', pymongo.ASCENDING)], background=True),
+                self.db.users.create_index(
+                    [('updated_at', pymongo.ASCENDING)], background=True)
+            ]
+
+
     def create_user(self, data):
         if ('_id' in data and 
             'created_at' in data):
-            self.db.users.insert(data)
+            self.db.users.insert(self.build_user(data))
+
+
+    # Embedded writes stamp users.updated_at, the default watermark of
+    # incremental charts, so changed users are rebuilt on the next run.
+    def build_user(self, data):
+        if 'updated_at' in data:
+            return data
+        return dict(data, updated_at=datetime.utcnow())
+
+
+    def build_touch(self, update):
+        update = dict(update)
+        update['$set'] = dict(update.get('$set', {}))
+        update['$set'].setdefault('updated_at', datetime.utcnow())
+        return update
+
+
+    def create_users_batch(self, users):
+        results = [None] * len(users)
+        indexes = []
+        bulk = self.db.users.initialize_unordered_bulk_op()
+
+        for idx, data in enumerate(users):
+            if ('_id' in data and 
+                'created_at' in data):
+                bulk.insert(self.build_user(data))
+                indexes.append([idx])
+            else:
+                results[idx] = {'ok': False, 'error': 'missing _id or created_at'}
+
+        self.execute_bulk(bulk, indexes, results)
+        return results
 
 
     def update_profile(self, id, data):
-        self.db.users.update({'_id':id}, {'$set': data})
+        self.db.users.update({'_id':id}, self.build_touch({'$set': data}))
 
 
     def insert_action(self, id, data, unique=False):
         if ('name' in data and 
             'created_at' in data):
 
+            if self.layout == 'bucketed':
+                self.insert_bucketed_action(id, data, unique)
+            else:
+                self.db.users.update(
+                    self.build_action_spec(id, data, unique), 
+                    self.build_touch({'$push': {'actions': data}}))
+
+
+    def insert_bucketed_action(self, id, data, unique):
+        if unique is True:
+            try:
+                self.db[self.keys].insert(
+                    {'_id': self.build_action_key(id, data)}, **self.write_concern())
+            except DuplicateKeyError:
+                return
+
+        bucket_id = self.build_bucket_id(id, data)
+        try:
+            self.db[self.buckets].update(
+                {'_id': bucket_id}, 
+                self.build_bucket_update(bucket_id, [data]), 
+                True)
+        except Exception:
             if unique is True:
-                insert_values = copy.copy(data)
-                del insert_values['created_at']
-                user = self.db.users.find_one({ 
-                    '_id' : id,
-                    'actions':{'$elemMatch': insert_values}}, {'_id': 1})
-                if user:
-                    return
-            self.db.users.update({'_id':id}, {'$push': {'actions': data}})
+                self.db[self.keys].remove({'_id': self.build_action_key(id, data)})
+            raise
+
+
+    def build_action_spec(self, id, data, unique):
+        spec = {'_id': id}
+        if unique is True:
+            spec['actions'] = {'$not': {'$elemMatch': self.build_unique_values(data)}}
+        return spec
+
+
+    def build_unique_values(self, data):
+        insert_values = copy.copy(data)
+        del insert_values['created_at']
+        return insert_values
+
+
+    def build_action_key(self, id, data):
+        key = json_util.dumps(self.build_unique_values(data), sort_keys=True)
+        return SON([('user_id', id), ('key', hashlib.sha1(key).hexdigest())])
+
+
+    def build_bucket_id(self, id, data):
+        return SON([('user_id', id), ('month', data['created_at'].strftime('%Y/%m'))])
+
+
+    def build_bucket_update(self, bucket_id, actions):
+        return {
+            '$push': {'actions': {'$each': actions}},
+            '$inc': {'count': len(actions)},
+            '$setOnInsert': {
+                'user_id': bucket_id['user_id'], 
+                'month': bucket_id['month']
+            }
+        }
+
+
+    def insert_actions_batch(self, events, unique=False):
+        results = [None] * len(events)
+        user_actions = OrderedDict()
+
+        for idx, (id, data) in enumerate(events):
+            if ('name' in data and 
+                'created_at' in data):
+                user_actions.setdefault(id, []).append((idx, data))
+            else:
+                results[idx] = {'ok': False, 'error': 'missing name or created_at'}
+
+        if self.layout == 'bucketed':
+            self.insert_bucketed_batch(user_actions, unique, results)
+            return results
+
+        indexes = []
+        bulk = self.db.users.initialize_unordered_bulk_op()
+        for id, actions in user_actions.items():
+            if unique is True:
+                self.build_unique_batch(bulk, indexes, id, actions)
+            else:
+                bulk.find({'_id': id}).update_one(self.build_touch(
+                    {'$push': {'actions': {'$each': [data for idx, data in actions]}}}))
+                indexes.append([idx for idx, data in actions])
+
+        ignored, details = self.execute_bulk(bulk, indexes, results)
+        if details.get('nMatched', 0) < len(indexes):
+            self.check_users(user_actions, results)
+        return results
+
+
+    def check_users(self, user_actions, results):
+        found = set(user['_id'] for user in self.db.users.find(
+            {'_id': {'$in': user_actions.keys()}}, fields=['_id']))
+        for id, actions in user_actions.items():
+            if id not in found:
+                for idx, data in actions:
+                    results[idx] = {'ok': False, 'error': 'user not found'}
+
+
+    def build_unique_batch(self, bulk, indexes, id, actions):
+        seen = {}
+        for idx, data in actions:
+            key = json_util.dumps(self.build_unique_values(data), sort_keys=True)
+            if key in seen:
+                indexes[seen[key]].append(idx)
+            else:
+                seen[key] = len(indexes)
+                bulk.find(self.build_action_spec(id, data, True)).update_one(
+                    self.build_touch({'$push': {'actions': data}}))
+                indexes.append([idx])
+
+
+    def insert_bucketed_batch(self, user_actions, unique, results):
+        aliases = {}
+        if unique is True:
+            user_actions, aliases = self.claim_action_keys(user_actions, results)
+
+        bucket_actions = OrderedDict()
+        for id, actions in user_actions.items():
+            for idx, data in actions:
+                bucket_id = self.build_bucket_id(id, data)
+                key = (id, bucket_id['month'])
+                if key not in bucket_actions:
+                    bucket_actions[key] = (bucket_id, [])
+                bucket_actions[key][1].append((idx, data))
+
+        indexes = []
+        bulk = self.db[self.buckets].initialize_unordered_bulk_op()
+        for bucket_id, actions in bucket_actions.values():
+            bulk.find({'_id': bucket_id}).upsert().update_one(
+                self.build_bucket_update(bucket_id, [data for idx, data in actions]))
+            indexes.append([idx for idx, data in actions])
+
+        if unique is not True:
+            self.execute_bulk(bulk, indexes, results)
+            return
+
+        try:
+            self.execute_bulk(bulk, indexes, results)
+        except Exception:
+            self.release_action_keys(user_actions)
+            raise
+
+        failed = OrderedDict()
+        for id, actions in user_actions.items():
+            for idx, data in actions:
+                if not results[idx]['ok']:
+                    failed.setdefault(id, []).append((idx, data))
+                    for alias in aliases[idx]:
+                        results[alias] = results[idx]
+        self.release_action_keys(failed)
+
+
+    def release_action_keys(self, user_actions):
+        keys = [self.build_action_key(id, data)
+            for id, actions in user_actions.items() for idx, data in actions]
+        if keys:
+            self.db[self.keys].remove({'_id': {'$in': keys}}, **self.write_concern())
+
+
+    def claim_action_keys(self, user_actions, results):
+        claims = []
+        indexes = []
+        seen = {}
+        bulk = self.db[self.keys].initialize_unordered_bulk_op()
+        for id, actions in user_actions.items():
+            for idx, data in actions:
+                key = self.build_action_key(id, data)
+                seen_key = (id, key['key'])
+                if seen_key in seen:
+                    indexes[seen[seen_key]].append(idx)
+                else:
+                    seen[seen_key] = len(indexes)
+                    bulk.insert({'_id': key})
+                    claims.append((id, idx, data))
+                    indexes.append([idx])
+
+        duplicates, details = self.execute_bulk(bulk, indexes, results, 
+            ignore_codes=(11000,))
+
+        claimed = OrderedDict()
+        aliases = {}
+        for op_index, (id, idx, data) in enumerate(claims):
+            if results[idx]['ok'] and op_index not in duplicates:
+                claimed.setdefault(id, []).append((idx, data))
+                aliases[idx] = indexes[op_index][1:]
+        return claimed, aliases
+
+
+    def write_concern(self):
+        concern = dict(self.db.write_concern)
+        if not concern.get('w'):
+            concern['w'] = 1
+        return concern
+
+
+    def execute_bulk(self, bulk, indexes, results, ignore_codes=()):
+        errors = {}
+        ignored = set()
+        details = {}
+        if indexes:
+            try:
+                details = bulk.execute(self.write_concern())
+            except BulkWriteError as e:
+                details = e.details
+                for error in e.details.get('writeErrors', []):
+                    if error.get('code') in ignore_codes:
+                        ignored.add(error['index'])
+                    else:
+                        errors[error['index']] = error['errmsg']
+                for error in e.details.get('writeConcernErrors', []):
+                    for op_index in range(len(indexes)):
+                        errors.setdefault(op_index, error['errmsg'])
+
+        for op_index, items in enumerate(indexes):
+            for idx in items:
+                if op_index in errors:
+                    results[idx] = {'ok': False, 'error': errors[op_index]}
+                else:
+                    results[idx] = {'ok': True}
+        return ignored, details
     
 
     def tag_abtest(self, id, data): 
@@ -42,4 +319,4 @@ class ActionsApi(object):
             abtest = ".".join(['ab', data['abtest']])
             self.db.users.update(
                 {'_id': id}, 
-                {'$set': {abtest: data['variation']}})       
\ No newline at end of file
+                self.build_touch({'$set': {abtest: data['variation']}}))       
\ No newline at end of file
@@ -0,0 +1,202 @@
+import atexit
+import threading
+import time
+import weakref
+import Queue
+from bson import json_util
+
+STOP = object()
+
+# Writers still open at exit get flushed; closed ones are no longer kept alive.
+open_writers = weakref.WeakSet()
+
+
+def close_writers():
+    for writer in list(open_writers):
+        writer.close()
+
+atexit.register(close_writers)
+
+class BufferedActionsWriter(object):
+
+    def __init__(self, actions_api, batch_size=500, flush_interval=1.0,
+            max_queue=10000, overflow='block', spill_path=None):
+
+        if overflow not in ('block', 'drop', 'spill'):
+            raise ValueError("overflow must be 'block', 'drop' or 'spill'")
+        if overflow == 'spill' and spill_path is None:
+            raise ValueError("overflow 'spill' needs a spill_path")
+
+        self.api = actions_api
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.overflow = overflow
+        self.spill_path = spill_path
+
+        self.queue = Queue.Queue(max_queue)
+        self.lock = threading.Lock()
+        self.close_lock = threading.Lock()
+        self.closed = False
+        self.counters = {
+            'queued': 0,
+            'flushed': 0,
+            'dropped': 0,
+            'spilled': 0,
+            'failed': 0
+        }
+
+        self.worker = threading.Thread(target=self.run)
+        self.worker.daemon = True
+        self.worker.start()
+        open_writers.add(self)
+
+
+    def insert_action(self, id, data, unique=False):
+        self.enqueue(('insert_action', id, data, unique))
+
+
+    def update_profile(self, id, data):
+        self.enqueue(('update_profile', id, data, False))
+
+
+    def tag_abtest(self, id, data):
+        self.enqueue(('tag_abtest', id, data, False))
+
+
+    def enqueue(self, item):
+        # close() takes the same lock, so no item can land behind STOP.
+        with self.close_lock:
+            if self.closed:
+                raise ValueError('writer is closed')
+            self.put(item)
+
+
+    def put(self, item):
+        if self.overflow == 'block':
+            self.queue.put(item)
+        else:
+            try:
+                self.queue.put_nowait(item)
+            except Queue.Full:
+                if self.overflow == 'spill':
+                    self.spill([item])
+                    self.count('spilled')
+                else:
+                    self.count('dropped')
+                return
+        self.count('queued')
+
+
+    def count(self, counter, amount=1):
+        with self.lock:
+            self.counters[counter] += amount
+
+
+    def close(self, timeout=None):
+        with self.close_lock:
+            if self.closed:
+                return
+            self.closed = True
+            self.queue.put(STOP)
+        open_writers.discard(self)
+        self.worker.join(timeout)
+
+
+    def run(self):
+        stopping = False
+        while not stopping:
+            batch, stopping = self.take_batch()
+            if batch:
+                self.write(batch)
+
+
+    def take_batch(self):
+        batch = []
+        deadline = None
+        while len(batch) < self.batch_size:
+            if deadline is None:
+                timeout = self.flush_interval
+            else:
+                timeout = deadline - time.time()
+                if timeout <= 0:
+                    break
+
+            try:
+                item = self.queue.get(timeout=timeout)
+            except Queue.Empty:
+                break
+
+            if item is STOP:
+                return batch, True
+
+            batch.append(item)
+            if deadline is None:
+                deadline = time.time() + self.flush_interval
+        return batch, False
+
+
+    def write(self, batch):
+        try:
+            failed = self.apply(batch)
+        except Exception:
+            failed = batch
+
+        self.count('flushed', len(batch) - len(failed))
+        if failed:
+            self.count('failed', len(failed))
+            if self.spill_path is not None:
+                self.spill(failed)
+                self.count('spilled', len(failed))
+
+
+    def apply(self, batch):
+        failed = []
+        for run in self.split_runs(batch):
+            try:
+                failed.extend(self.apply_run(run))
+            except Exception:
+                failed.extend(run)
+        return failed
+
+
+    def split_runs(self, batch):
+        # Consecutive action inserts with the same unique flag share one batch
+        # call; anything else runs on its own, so submission order is kept.
+        runs = []
+        for item in batch:
+            method, id, data, unique = item
+            if (method == 'insert_action' and runs and 
+                    runs[-1][0][0] == 'insert_action' and runs[-1][0][3] == unique):
+                runs[-1].append(item)
+            else:
+                runs.append([item])
+        return runs
+
+
+    def apply_run(self, run):
+        method, id, data, unique = run[0]
+        if method != 'insert_action':
+            getattr(self.api, method)(id, data)
+            return []
+
+        results = self.api.insert_actions_batch(
+            [(id, data) for method, id, data, flag in run], unique is True)
+        return [item for item, result in zip(run, results) if not result['ok']]
+
+
+    def spill(self, items):
+        with self.lock:
+            with open(self.spill_path, 'a') as spill_file:
+                for item in items:
+                    spill_file.write(json_util.dumps(item) + '\n')
+
+
+    def replay(self, path):
+        with self.lock:
+            with open(path) as spill_file:
+                items = [tuple(json_util.loads(line)) for line in spill_file if line.strip()]
+            open(path, 'w').close()
+
+        for i in range(0, len(items), self.batch_size):
+            self.write(items[i:i + self.batch_size])
+        return len(items)
@@ -0,0 +1,74 @@
+import time
+import threading
+from collections import OrderedDict
+from bson import BSON
+
+
+class ResultCache(object):
+
+    def __init__(self, max_bytes=64 * 1024 * 1024, ttl=300):
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self.entries = OrderedDict()
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.lock = threading.Lock()
+
+    def get(self, key, generation):
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is not None:
+                entry_generation, encoded, size, expires = entry
+                if entry_generation == generation and (
+                        expires is None or expires > time.time()):
+                    del self.entries[key]
+                    self.entries[key] = entry
+                    self.hits += 1
+                    # Decoding per read hands every caller its own documents.
+                    return [BSON(doc).decode() for doc in encoded]
+                self.discard(key)
+            self.misses += 1
+            return None
+
+    def put(self, key, generation, docs):
+        encoded = [BSON.encode(doc) for doc in docs]
+        size = sum(len(doc) for doc in encoded)
+        if size > self.max_bytes:
+            return False
+
+        expires = None if self.ttl is None else time.time() + self.ttl
+        with self.lock:
+            self.discard(key)
+            while self.entries and self.size + size > self.max_bytes:
+                self.discard(next(iter(self.entries)))
+                self.evictions += 1
+            self.entries[key] = (generation, encoded, size, expires)
+            self.size += size
+        return True
+
+    def invalidate(self, collection):
+        with self.lock:
+            for key in [key for key in self.entries if key[0] == collection]:
+                self.discard(key)
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+            self.size = 0
+
+    def discard(self, key):
+        entry = self.entries.pop(key, None)
+        if entry is not None:
+            self.size -= entry[2]
+
+    def stats(self):
+        with self.lock:
+            return {
+                'entries': len(self.entries),
+                'bytes': self.size,
+                'hits': self.hits,
+                'misses': self.misses,
+                'evictions': self.evictions
+            }
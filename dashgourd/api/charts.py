@@ -1,11 +1,33 @@
+import copy
+import time
+import hashlib
+import logging
+import traceback
+import pymongo
+from bson import json_util
+from bson.son import SON
+from collections import OrderedDict
+from datetime import datetime
+from multiprocessing.pool import ThreadPool
 from dashgourd.api.helper import init_mongodb
 from dashgourd.charts.cohort_funnel import CohortFunnel
 from dashgourd.charts.retention import Retention
 from dashgourd.charts.action_cohort import ActionCohort
+from dashgourd.charts.fusion import ChartFusion
+from dashgourd.charts.indexes import IndexAdvisor, explain_query
+from dashgourd.charts.partition import replace_collection
+from dashgourd.charts.formatters import FormatAb, FormatCombo, FormatRetention, FormatTable
+
+NOT_MODIFIED = object()
+
+log = logging.getLogger(__name__)
+log.addHandler(logging.NullHandler())
+
 
 class ChartsApi(object):
     
-    def __init__(self, mongodb, dbname=None, plugins=None):     
+    def __init__(self, mongodb, dbname=None, plugins=None, backend=None, layout=None,
+            hooks=None, formatters=None, cache=None):
         if type(mongodb) is str:
             self.db = init_mongodb(mongodb, dbname)
         else:
@@ -19,15 +41,431 @@ class ChartsApi(object):
             }
         else:
             self.plugins = plugins
+
+        if formatters is None:
+            self.formatters = {
+                'ab': FormatAb,
+                'combo': FormatCombo,
+                'retention': FormatRetention,
+                'table': FormatTable
+            }
+        else:
+            self.formatters = formatters
+
+        self.backend = backend
+        self.layout = layout
+        self.hooks = list(hooks or [])
+        self.cache = cache
+        self.fusion = ChartFusion()
       
 
-    def get_chart(self, collection):
-        return self.db[collection].find()
+    def ensure_indexes(self, charts, runs_ttl=None):
+        advisor = IndexAdvisor()
+        indexes = self.ensure_run_indexes(runs_ttl)
+        unindexed = []
+
+        for plugin, collection, options in charts:
+            for spec in advisor.chart_indexes(options):
+                name = self.db.users.create_index(spec, background=True)
+                if name not in indexes:
+                    indexes.append(name)
+
+            if options.get('layout', self.layout) == 'bucketed':
+                buckets = options.get('buckets', 'action_buckets')
+                self.db[buckets].create_index(
+                    [('user_id', pymongo.ASCENDING)], background=True)
+
+        for plugin, collection, options in charts:
+            query = options.get('query')
+            problems = advisor.query_problems(query)
+            if not problems and explain_query(self.db, query)['index'] is None:
+                problems.append('query plan does not use an index')
+
+            if problems:
+                unindexed.append({'collection': collection, 'problems': problems})
+
+        return {'indexes': indexes, 'unindexed': unindexed}
+
+
+    def ensure_run_indexes(self, ttl=None):
+        created_at = {'background': True}
+        if ttl is not None:
+            created_at['expireAfterSeconds'] = ttl
+        return [
+            self.db.chart_runs.create_index(
+                [('created_at', pymongo.ASCENDING)], **created_at),
+            self.db.chart_runs.create_index(
+                [('collection', pymongo.ASCENDING), ('created_at', pymongo.DESCENDING)],
+                background=True)
+        ]
+
+
+    def explain_chart(self, plugin, collection, options):
+        return self.generate_chart(plugin, collection, dict(options, explain=True))
+
+
+    def get_chart(self, collection, sort=None):
+        if self.cache is not None:
+            return self.get_cached_chart(collection, sort)
+
+        cursor = self.db[collection].find()
+        if sort is not None:
+            cursor = cursor.sort(sort)
+        return cursor
+
+
+    def get_cached_chart(self, collection, sort=None):
+        key = (collection, repr(sort))
+        generation = self.get_generation(collection)
+        docs = self.cache.get(key, generation)
+        if docs is None:
+            cursor = self.db[collection].find()
+            if sort is not None:
+                cursor = cursor.sort(sort)
+            docs = list(cursor)
+            self.cache.put(key, generation, docs)
+        return docs
+
+
+    def get_chart_columns(self, collection, fields, sort=None):
+        from dashgourd.api.columns import chart_columns
+
+        if self.cache is not None:
+            docs = self.get_cached_chart(collection, sort)
+        else:
+            docs = self.db[collection].find(
+                fields=['_id'] + ['value.{}'.format(name) for name in fields])
+            if sort is not None:
+                docs = docs.sort(sort)
+        return chart_columns(docs, fields)
+
+
+    def get_generation(self, collection):
+        result = self.db.chart_generations.find_one({'_id': collection})
+        
+        if result is not None:
+            return result.get('generation', 0)
+        else:
+            return 0
+
+
+    def bump_generation(self, collection):
+        self.db.chart_generations.update(
+            {'_id': collection},
+            {'$inc': {'generation': 1}},
+            True)
+        if self.cache is not None:
+            self.cache.invalidate(collection)
     
 
     def generate_chart(self, plugin, collection, options):
-        plugin = self.plugins.get(plugin)
-        if plugin is not None:
+        chart_plugin = self.plugins.get(plugin)
+        if chart_plugin is None:
+            return False
+
+        options = self.chart_options(options)
+        if options.get('explain', False):
+            return chart_plugin.run(self.db, collection, options)
+
+        if options.get('incremental', False):
+            stats = self.generate_incremental(chart_plugin, collection, options)
+        else:
+            stats = self.run_plugin(chart_plugin, collection, options)
+
+        if type(stats) is dict and not options.get('debug', False):
+            self.record_run(plugin, collection, stats)
+            self.store_payloads(collection, options.get('formats'), stats)
+        return stats
+
+
+    def run_plugin(self, plugin, collection, options):
+        if options.get('debug', False):
             return plugin.run(self.db, collection, options)
+
+        # A run that failed halfway through a reduce or merge may still have
+        # changed the collection, so it invalidates cached reads as well.
+        try:
+            stats = plugin.run(self.db, collection, options)
+        except Exception:
+            self.bump_generation(collection)
+            raise
+        if type(stats) is dict:
+            self.bump_generation(collection)
+        return stats
+
+
+    def chart_options(self, options):
+        if self.backend is not None and 'backend' not in options:
+            options = dict(options, backend=self.backend)
+        if self.layout is not None and 'layout' not in options:
+            options = dict(options, layout=self.layout)
+        return options
+
+
+    def generate_charts(self, charts, max_workers=4, fuse=False):
+        if fuse:
+            jobs = self.fusion.plan(self.plugins, 
+                [(plugin, collection, self.chart_options(options)) 
+                    for plugin, collection, options in charts])
+        else:
+            jobs = [[idx] for idx in range(len(charts))]
+
+        pool = ThreadPool(max_workers)
+        try:
+            results = pool.map(lambda job: self.generate_job(charts, job), jobs)
+        finally:
+            pool.close()
+            pool.join()
+
+        statuses = [None] * len(charts)
+        for job, result in zip(jobs, results):
+            for idx, status in zip(job, result):
+                statuses[idx] = status
+        return statuses
+
+
+    def generate_job(self, charts, job):
+        if len(job) == 1:
+            return [self.generate_chart_status(charts[job[0]])]
         else:
-            return False
\ No newline at end of file
+            return self.generate_fused_status([charts[idx] for idx in job])
+
+
+    def generate_fused_status(self, charts):
+        status = 'ok'
+        error = None
+
+        start = time.time()
+        try:
+            self.generate_fused(charts)
+        except Exception:
+            status = 'failed'
+            error = traceback.format_exc()
+        duration = time.time() - start
+
+        return [{
+            'plugin': plugin,
+            'collection': collection,
+            'status': status,
+            'error': error,
+            'duration': duration,
+            'fused': len(charts)
+        } for plugin, collection, options in charts]
+
+
+    def generate_fused(self, charts):
+        plugin = self.plugins[charts[0][0]]
+        options = self.fusion.fuse(plugin, 
+            [(name, collection, self.chart_options(options)) 
+                for name, collection, options in charts])
+
+        fused = '{}_fused'.format(charts[0][1])
+        try:
+            stats = plugin.run(self.db, fused, options)
+            # Read as SON so each chart keeps its _id keys in group order.
+            results = self.fusion.split(self.db[fused].find(as_class=SON), len(charts))
+        finally:
+            self.db[fused].drop()
+
+        for (name, collection, options), docs in zip(charts, results):
+            replace_collection(self.db, collection, docs)
+            self.bump_generation(collection)
+            self.record_run(name, collection, dict(stats, fused=len(charts)))
+            self.store_payloads(collection, options.get('formats'), stats)
+
+
+    def generate_chart_status(self, chart):
+        plugin, collection, options = chart
+        status = {
+            'plugin': plugin,
+            'collection': collection,
+            'status': 'ok',
+            'error': None
+        }
+
+        start = time.time()
+        try:
+            if self.generate_chart(plugin, collection, options) is False:
+                status['status'] = 'invalid'
+        except Exception:
+            status['status'] = 'failed'
+            status['error'] = traceback.format_exc()
+        status['duration'] = time.time() - start
+        return status
+
+
+    def payload_id(self, collection, key):
+        return SON([('collection', collection), ('key', key)])
+
+
+    def build_payload(self, collection, config):
+        config = dict(config)
+        formatter = self.formatters[config.pop('formatter')](config.pop('formatted', True))
+        sort = formatter.sort_spec(**config) or None
+        if sort is not None and isinstance(formatter, FormatTable):
+            config['presorted'] = True
+        return formatter.build_json(self.get_chart(collection, sort=sort), **config)
+
+
+    def store_payloads(self, collection, formats, stats=None):
+        if not formats:
+            return
+
+        for key, config in formats.items():
+            payload_id = self.payload_id(collection, key)
+            try:
+                payload = self.build_payload(collection, config)
+            except Exception:
+                # The chart itself was written; only this format is missing,
+                # and its old payload no longer matches the chart.
+                log.exception('could not build %s payload for %s', key, collection)
+                self.db.chart_payloads.remove({'_id': payload_id})
+                continue
+
+            self.db.chart_payloads.update(
+                {'_id': payload_id},
+                {'$set': {
+                    'payload': payload,
+                    'etag': hashlib.sha1(payload).hexdigest(),
+                    'config_hash': (stats or {}).get('config_hash'),
+                    'created_at': datetime.utcnow()
+                }},
+                True)
+
+
+    def get_formatted(self, collection, key, if_none_match=None):
+        payload_id = self.payload_id(collection, key)
+        if if_none_match is not None:
+            current = self.db.chart_payloads.find_one(
+                {'_id': payload_id}, fields={'etag': 1})
+            if current is None:
+                return None
+            if current['etag'] == if_none_match.strip('"'):
+                return NOT_MODIFIED
+
+        current = self.db.chart_payloads.find_one(
+            {'_id': payload_id}, fields={'payload': 1, 'etag': 1, 'created_at': 1})
+        if current is None:
+            return None
+        return {
+            'payload': current['payload'],
+            'etag': current['etag'],
+            'created_at': current['created_at']
+        }
+
+
+    def generate_incremental(self, plugin, collection, options):
+        query = options.get('query')
+        field = options.get('watermark', 'updated_at')
+        if query is None:
+            return False
+        plugin.check_incremental(options)
+
+        latest = self.db.users.find_one(
+            {'$and': [query, {field: {'$exists': True}}]}, 
+            fields={field: 1}, sort=[(field, pymongo.DESCENDING)])
+        last_update = self.get_last_update(collection)
+
+        if last_update is None:
+            result = self.run_plugin(plugin, collection, dict(options, output='replace'))
+        elif latest is None or latest[field] <= last_update:
+            return None
+        else:
+            # Rebuilding whole groups is idempotent, unlike reducing a changed
+            # user into its group again, so the window may overlap the last one.
+            changed = {'$and': [query, {field: {'$gte': last_update, '$lte': latest[field]}}]}
+            groups = self.changed_groups(plugin, options, changed)
+            if not groups:
+                return None
+            result = self.run_plugin(plugin, collection, dict(options, 
+                output='merge', query={'$and': [query, {'$or': groups}]}))
+
+        if (result is not False and latest is not None and 
+                not options.get('debug', False)):
+            self.set_last_update(collection, latest[field])
+        return result
+
+
+    def changed_groups(self, plugin, options, changed):
+        group = plugin.validate_group_config(copy.deepcopy(options['group']))
+        keys = OrderedDict()
+        for user in self.db.users.find(changed, fields=[data['attr'] for data in group]):
+            key = plugin.map_keys(group, user)
+            keys.setdefault(json_util.dumps(key), key)
+        return [plugin.group_query(group, key) for key in keys.values()]
+
+
+    def add_hook(self, hook):
+        self.hooks.append(hook)
+
+
+    def record_run(self, plugin, collection, stats):
+        run = dict(stats, plugin=plugin, collection=collection, 
+            created_at=datetime.utcnow())
+        self.db.chart_runs.insert(run)
+        for hook in self.hooks:
+            try:
+                hook(run)
+            except Exception:
+                log.exception('chart run hook failed for %s', collection)
+        return run
+
+
+    def get_runs(self, collection, limit=20):
+        return (self.db.chart_runs.find({'collection': collection})
+            .sort('created_at', pymongo.DESCENDING)
+            .limit(limit))
+
+
+    def slowest_charts(self, limit=10, since=None):
+        return self.rank_charts('wall_time', limit, since)
+
+
+    def expensive_charts(self, limit=10, since=None, metric='counts.input'):
+        return self.rank_charts(metric, limit, since)
+
+
+    def rank_charts(self, metric, limit, since):
+        query = {metric: {'$ne': None}}
+        if since is not None:
+            query['created_at'] = {'$gte': since}
+
+        value = '$' + metric
+        pipeline = [
+            {'$match': query},
+            {'$sort': {'created_at': pymongo.ASCENDING}},
+            {'$group': {
+                '_id': '$collection',
+                'plugin': {'$last': '$plugin'},
+                'runs': {'$sum': 1},
+                'total': {'$sum': value},
+                'max': {'$max': value},
+                'avg': {'$avg': value},
+                'last_run': {'$last': '$created_at'},
+                'config_hash': {'$last': '$config_hash'}
+            }},
+            {'$sort': {'avg': pymongo.DESCENDING}},
+            {'$limit': limit}
+        ]
+
+        ranked = []
+        for chart in self.db.chart_runs.aggregate(pipeline, cursor={}):
+            chart['collection'] = chart.pop('_id')
+            ranked.append(chart)
+        return ranked
+
+
+    def get_last_update(self, collection):
+        result = self.db.chart_logs.find_one({'_id': collection})
+        
+        if result is not None:
+            return result.get('last_update')
+        else:
+            return None
+
+
+    def set_last_update(self, collection, last_update):
+        self.db.chart_logs.update(
+            {'_id': collection},
+            {'$set': {'last_update': last_update}},
+            True)
\ No newline at end of file
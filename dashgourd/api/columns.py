@@ -0,0 +1,47 @@
+import numpy as np
+
+METRIC_PARTS = ('value', 'total', 'n')
+
+
+def chart_columns(docs, fields):
+    keys = {}
+    metrics = dict((name, dict((part, []) for part in METRIC_PARTS))
+        for name in fields)
+
+    rows = 0
+    for doc in docs:
+        for key, value in doc['_id'].items():
+            if key not in keys:
+                keys[key] = [None] * rows
+            keys[key].append(value)
+        for key, values in keys.items():
+            if len(values) == rows:
+                values.append(None)
+
+        value = doc.get('value') or {}
+        for name in fields:
+            meta = value.get(name) or {}
+            columns = metrics[name]
+            for part in METRIC_PARTS:
+                columns[part].append(meta.get(part))
+        rows += 1
+
+    return {
+        'size': rows,
+        'keys': dict((key, key_array(values)) for key, values in keys.items()),
+        'values': dict((name, dict((part, metric_array(values))
+            for part, values in columns.items()))
+            for name, columns in metrics.items())
+    }
+
+
+def key_array(values):
+    # numpy would coerce mixed keys (e.g. 1 and u'1', or None) to one type.
+    if len(set(type(value) for value in values)) > 1:
+        return np.array(values, dtype=object)
+    return np.array(values)
+
+
+def metric_array(values):
+    return np.array([np.nan if value is None else value for value in values],
+        dtype=np.float64)
@@ -1,5 +1,69 @@
-from pymongo import Connection
+import os
+import threading
+from pymongo import MongoClient
+
+clients = {}
+clients_pid = None
+clients_lock = threading.Lock()
+
+
+def get_client(mongo_uri):
+    global clients_pid
+    with clients_lock:
+        if clients_pid != os.getpid():
+            # Sockets inherited across fork belong to the parent's pool.
+            clients.clear()
+            clients_pid = os.getpid()
+
+        client = clients.get(mongo_uri)
+        if client is None:
+            client = MongoClient(mongo_uri, _connect=False)
+            clients[mongo_uri] = client
+        return client
+
+
+def client_uri(client):
+    with clients_lock:
+        for mongo_uri, registered in clients.items():
+            if registered is client:
+                return mongo_uri
+    return None
+
+
+def close_client(mongo_uri):
+    with clients_lock:
+        client = clients.pop(mongo_uri, None)
+    if client is not None:
+        client.close()
+
+
+def close_clients():
+    with clients_lock:
+        closing = clients.values()
+        clients.clear()
+    for client in closing:
+        client.close()
+
+
+class LazyDatabase(object):
+    # Looks the client up on every access, so an API object built before a
+    # fork talks to the child's own client instead of the parent's sockets.
+
+    def __init__(self, mongo_uri, mongo_dbname):
+        self.mongo_uri = mongo_uri
+        self.mongo_dbname = mongo_dbname
+
+    def get(self):
+        return get_client(self.mongo_uri)[self.mongo_dbname]
+
+    def __getattr__(self, name):
+        if name.startswith('__'):
+            raise AttributeError(name)
+        return getattr(self.get(), name)
+
+    def __getitem__(self, name):
+        return self.get()[name]
+
 
 def init_mongodb(mongo_uri, mongo_dbname):
-    conn = Connection(mongo_uri)
-    return conn[mongo_dbname]
+    return LazyDatabase(mongo_uri, mongo_dbname)
@@ -0,0 +1,28 @@
+import socket
+
+
+class StatsdSink(object):
+
+    def __init__(self, host='localhost', port=8125, prefix='dashgourd.charts'):
+        self.address = (host, port)
+        self.prefix = prefix
+        self.socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+
+    def __call__(self, run):
+        name = '.'.join([self.prefix, run['collection']])
+        metrics = [
+            '{}.wall_time:{}|ms'.format(name, int(run['wall_time'] * 1000)),
+            '{}.compile_time:{}|ms'.format(name, int(run['compile_time'] * 1000))
+        ]
+        if run.get('server_time') is not None:
+            metrics.append('{}.server_time:{}|ms'.format(name, run['server_time']))
+        for key, count in (run.get('counts') or {}).items():
+            if count is not None:
+                metrics.append('{}.{}:{}|g'.format(name, key, count))
+        self.send(metrics)
+
+    def send(self, metrics):
+        try:
+            self.socket.sendto('\n'.join(metrics), self.address)
+        except socket.error:
+            pass
@@ -0,0 +1,86 @@
+import hashlib
+from collections import OrderedDict
+from bson import json_util
+from bson.son import SON
+from dashgourd.api.actions import ActionsApi
+from dashgourd.api.helper import init_mongodb
+
+class MigrateApi(object):
+
+    def __init__(self, mongodb, dbname=None):
+        if type(mongodb) is str:
+            self.db = init_mongodb(mongodb, dbname)
+        else:
+            self.db = mongodb
+
+
+    def actions_to_buckets(self, batch_size=1000, remove=True, 
+            buckets='action_buckets'):
+        actions_api = ActionsApi(self.db, layout='bucketed', buckets=buckets)
+
+        migrated = 0
+        events = 0
+        users = []
+        # Read as SON so $pullAll can match the embedded actions field by field.
+        cursor = self.db.users.find(
+            {'actions': {'$exists': True}}, {'actions': 1}, as_class=SON)
+
+        for user in cursor:
+            users.append(user)
+            events += len(user['actions'])
+
+            if events >= batch_size:
+                migrated += self.migrate_batch(actions_api, users, remove)
+                events = 0
+                users = []
+
+        if users:
+            migrated += self.migrate_batch(actions_api, users, remove)
+        return migrated
+
+
+    def migrate_batch(self, actions_api, users, remove):
+        bucket_actions = OrderedDict()
+        for user in users:
+            for data in user['actions']:
+                bucket_id = actions_api.build_bucket_id(user['_id'], data)
+                key = (user['_id'], bucket_id['month'])
+                if key not in bucket_actions:
+                    bucket_actions[key] = (bucket_id, [])
+                bucket_actions[key][1].append(data)
+
+        owners = []
+        indexes = []
+        bulk = self.db[actions_api.buckets].initialize_unordered_bulk_op()
+        for (id, month), (bucket_id, actions) in bucket_actions.items():
+            # A bucket remembers which action sets it received, so a rerun
+            # (or a retry after a failed unset) does not append them twice.
+            token = hashlib.sha1(json_util.dumps(actions)).hexdigest()
+            update = actions_api.build_bucket_update(bucket_id, actions)
+            update['$addToSet'] = {'migrated': token}
+            bulk.find({'_id': bucket_id, 'migrated': {'$ne': token}}).upsert().update_one(
+                update)
+            indexes.append([len(owners)])
+            owners.append(id)
+
+        results = [None] * len(owners)
+        actions_api.execute_bulk(bulk, indexes, results, ignore_codes=(11000,))
+        failed = set(id for id, result in zip(owners, results) if not result['ok'])
+
+        migrated = [user for user in users if user['_id'] not in failed]
+        if remove and migrated:
+            self.remove_actions(actions_api, migrated)
+        return len(migrated)
+
+
+    def remove_actions(self, actions_api, users):
+        bulk = self.db.users.initialize_unordered_bulk_op()
+        for user in users:
+            bulk.find({'_id': user['_id']}).update_one(
+                {'$pullAll': {'actions': user['actions']}})
+        bulk.execute(actions_api.write_concern())
+
+        self.db.users.update(
+            {'_id': {'$in': [user['_id'] for user in users]}, 'actions': {'$size': 0}},
+            {'$unset': {'actions': 1}},
+            multi=True)
@@ -1,8 +1,12 @@
+import copy
+from collections import OrderedDict
+
+from dashgourd.charts.compiler import ChartPlan
 from dashgourd.charts.cohort_funnel import CohortFunnel
 
 class ActionCohort(CohortFunnel):
-    def __init__(self):
-        super(ActionCohort, self).__init__()
+    def __init__(self, compiler=None):
+        super(ActionCohort, self).__init__(compiler)
         self.mapper_template = """ 
         function() {{
 
@@ -50,10 +54,12 @@ class ActionCohort(CohortFunnel):
         """          
 
 
-    def run(self, db, collection, options):
+    def compile(self, options):
 
-        debug = options.get('debug', False)
-        output = options.get('output', 'replace')
+        backend = options.get('backend', 'mapreduce')
+        layout = options.get('layout', 'embedded')
+        if layout == 'bucketed':
+            backend = 'pipeline'
         
         query = options.get('query')
         pivot = options.get('pivot')
@@ -61,7 +67,7 @@ class ActionCohort(CohortFunnel):
         calc = options.get('calc')
         
         if pivot is None or query is None or group is None or calc is None:
-            return False
+            return None
 
         group = self.validate_group_config(group)
         calc = self.validate_calc_config(calc)
@@ -108,13 +114,73 @@ class ActionCohort(CohortFunnel):
 
         finalizer = self.finalizer_template.format(out_init_final_values, out_set_final_calc)
 
-        if debug:
-            self.debug(mapper, reducer, finalizer)
-        else:
-            self.build_chart(db, output, collection, mapper, 
-                reducer, finalizer, query)
+        pipeline = None
+        if backend == 'pipeline':
+            source = self.build_pipeline_source(query, layout, options)
+            pipeline = self.build_pipeline(
+                source, pivot, group, calc, init_values, init_values_cond)
+
+        return ChartPlan(
+            plugin=None,
+            backend=backend,
+            layout=layout,
+            query=query,
+            mapper=mapper,
+            reducer=reducer,
+            finalizer=finalizer,
+            pipeline=pipeline,
+            values=tuple(init_values),
+            finals=tuple((data['calc_name'], data['calc'], data['name'], data['n']) 
+                for data in calc if data['calc'] != 'sum'),
+            date_field=None,
+            config_hash=None,
+            options=None)
+
+    def check_incremental(self, options):
+        raise ValueError('action cohorts key rows by action values, so they '
+            'cannot be refreshed incrementally')
+
+    def map_spec(self, options):
+        group = self.validate_group_config(copy.deepcopy(options['group']))
+        calc = self.validate_calc_config(copy.deepcopy(options['calc']))
+        self.build_init_final_values(calc)
+        event = [data for data in group if data['type'] == 'action'][0]
+        actions = set(self.build_init_values_cond(calc, self.build_init_values_cond(group)))
+        return group, calc, options['pivot'], event, actions
+
+    def map_user(self, plan, spec, user):
+        group, calc, pivot, event, actions = spec
+        pivots = OrderedDict()
+        for z in user.get('actions', []):
+            if z.get('name') not in actions:
+                continue
+
+            values = pivots.get(z.get(pivot))
+            if values is None:
+                values = {'total': {'value': 0, 'calc': 'sum'}}
+                for name in plan.values:
+                    values[name] = {'value': 0, 'calc': 'sum'}
+                pivots[z.get(pivot)] = values
 
-    def build_init_pivot_values(self, pivot, group, set_action_values={}):
+            if z['name'] in self.map_attrs(event):
+                values['total']['value'] = 1
+                values[event['meta']] = self.map_key(z.get(event['meta']), event['format'])
+
+            for data in calc:
+                if data['type'] == 'action' and z['name'] in self.map_attrs(data):
+                    values[data['name']]['value'] += self.map_action_value(data, z, False)
+
+        results = []
+        for values in pivots.values():
+            self.map_adjust(calc, values, False)
+            keys = self.map_keys(group, user)
+            keys[event['meta']] = values.pop(event['meta'], None)
+            results.append((keys, values))
+        return results
+
+    def build_init_pivot_values(self, pivot, group, set_action_values=None):
+        if set_action_values is None:
+            set_action_values = {}
         
         for data in group:
             if data['type'] == 'action':
@@ -143,7 +209,9 @@ class ActionCohort(CohortFunnel):
                     set_action_values[action][action] = code
         return set_action_values
 
-    def build_init_values_cond(self, config, init_values_cond=[]):
+    def build_init_values_cond(self, config, init_values_cond=None):
+        if init_values_cond is None:
+            init_values_cond = []
         
         for data in config:
             if data['type'] == 'action':
@@ -153,7 +221,9 @@ class ActionCohort(CohortFunnel):
                     init_values_cond.append(data['attr'])
         return init_values_cond
 
-    def build_set_pivot_action_values(self, pivot, calc, set_action_values={}):
+    def build_set_pivot_action_values(self, pivot, calc, set_action_values=None):
+        if set_action_values is None:
+            set_action_values = {}
         for data in calc:
             if data['type'] == 'action':
                 if 'meta' in data:
@@ -177,7 +247,9 @@ class ActionCohort(CohortFunnel):
                     set_action_values[action][data['name']] = code
         return set_action_values
 
-    def build_adjust_pivot_cond_values(self, calc, adjust_cond_values=[]):
+    def build_adjust_pivot_cond_values(self, calc, adjust_cond_values=None):
+        if adjust_cond_values is None:
+            adjust_cond_values = []
         for data in calc:
             if data['calc'] == 'pct' and data['cond']['type'] != 'sum':
                 op = self.accepted_conditions[data['cond']['type']]            
@@ -192,4 +264,73 @@ class ActionCohort(CohortFunnel):
     def gen_event_emit_key(self, group):
         for data in group:
             if data['type'] == 'action':
-                return data['meta'] 
\ No newline at end of file
+                return data['meta']
+
+    def build_pipeline(self, source, pivot, group, calc, init_values, init_values_cond):
+        names = ['total'] + init_values
+        keys = self.build_pipeline_keys(group)
+
+        group_cond = None
+        group_meta = None
+        for data in group:
+            if data['type'] == 'action':
+                group_cond = self.build_pipeline_action_cond(data['attr'], '$actions')
+                group_meta = self.build_pipeline_key(
+                    '$actions.' + data['meta'], data['format'])
+
+        values = {}
+        for name in init_values:
+            values[name] = {'$literal': 0}
+        for data in calc:
+            if data['type'] == 'action':
+                cond = self.build_pipeline_action_cond(data['attr'], '$actions')
+                if 'meta' in data:
+                    values[data['name']] = {'$cond': [cond,
+                        {'$ifNull': ['$actions.' + data['meta'], 0]}, 0]}
+                else:
+                    values[data['name']] = {'$cond': [cond, 1, 0]}
+
+        pair = {
+            '_id': {'u': '$_id', 'p': '$p'},
+            '_k': {'$first': '$_k'},
+            'total': {'$max': '$g'},
+            'm': {'$max': '$m'}
+        }
+        for name in init_values:
+            pair[name] = {'$sum': '$_v.' + name}
+
+        pipeline = source + [
+            {'$project': {
+                '_k': keys or {'$literal': {}},
+                'actions': {'$filter': {
+                    'input': {'$ifNull': ['$actions', []]},
+                    'as': 'z',
+                    'cond': self.build_pipeline_action_cond(init_values_cond)}}
+            }},
+            {'$unwind': '$actions'},
+            {'$project': {
+                '_k': 1,
+                'p': '$actions.' + pivot,
+                'g': {'$cond': [group_cond, 1, 0]},
+                'm': {'$cond': [group_cond, group_meta, None]},
+                '_v': values
+            }},
+            {'$group': pair},
+            {'$project': {
+                '_k': 1,
+                'm': 1,
+                '_v': dict((name, '$' + name) for name in names)
+            }}
+        ]
+        pipeline.extend(self.build_pipeline_cond_stages(calc, names, ('_k', 'm')))
+
+        group_keys = self.build_pipeline_group_keys(keys)
+        group_keys[self.gen_event_emit_key(group)] = '$m'
+        pipeline.append(self.build_pipeline_group(group_keys, init_values))
+        pipeline.append(self.build_pipeline_final(calc, init_values))
+        return pipeline
+
+    def build_pipeline_adjust(self, data):
+        if data['calc'] == 'pct' and data['cond']['type'] != 'sum':
+            return super(ActionCohort, self).build_pipeline_adjust(data)
+        return None
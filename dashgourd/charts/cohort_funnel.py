@@ -1,9 +1,24 @@
 import re
+import copy
+import itertools
+import operator
+import pprint
+import time
+from datetime import datetime, timedelta
+from multiprocessing import Pool
+from multiprocessing.pool import ThreadPool
+from bson import json_util
 from bson.code import Code
+from bson.son import SON
+from dashgourd.charts.compiler import ChartPlan, default_compiler
+from dashgourd.charts.indexes import IndexAdvisor, explain_query
+from dashgourd.charts.partition import (partition_bounds, partition_queries, 
+    group_results, replace_collection, connection_uri, map_shard)
 
 class CohortFunnel(object):
     
-    def __init__(self):
+    def __init__(self, compiler=None):
+        self.compiler = compiler or default_compiler
         self.mapper_template = """ 
         function() {{
 
@@ -78,17 +93,393 @@ class CohortFunnel(object):
             'if': None
         }
 
+        self.pipeline_conditions = {
+            'at_least': '$gte',
+            'at_most': '$lte',
+            'exactly': '$eq'
+        }
+
+        self.map_conditions = {
+            'at_least': operator.ge,
+            'at_most': operator.le,
+            'exactly': operator.eq
+        }
+
     def run(self, db, collection, options):
 
         debug = options.get('debug', False)
         output = options.get('output', 'replace')
+        partitions = options.get('partitions', 1)
+        processes = options.get('processes', 1)
+
+        start = time.time()
+        plan = self.compiler.compile(self, options)
+        compile_time = time.time() - start
+        if plan is None:
+            return False
+
+        if options.get('explain', False):
+            return self.explain(db, plan, options)
+
+        stats = {'counts': None, 'server_time': None}
+        if debug:
+            self.debug(plan)
+        elif processes > 1:
+            stats = self.execute_sharded(db, output, collection, options, plan, processes)
+        elif partitions > 1:
+            stats = self.execute_partitioned(db, output, collection, options, plan, partitions)
+        else:
+            stats = self.execute(db, output, collection, plan)
+
+        stats.update({
+            'backend': plan.backend,
+            'layout': plan.layout,
+            'output': output,
+            'config_hash': plan.config_hash,
+            'compile_time': compile_time,
+            'wall_time': time.time() - start
+        })
+        return stats
+
+    def explain(self, db, plan, options):
+        report = {
+            'plugin': plan.plugin,
+            'config_hash': plan.config_hash,
+            'backend': plan.backend,
+            'layout': plan.layout,
+            'query': plan.query
+        }
+        if plan.backend == 'pipeline':
+            report['pipeline'] = list(plan.pipeline)
+        else:
+            report['mapper'] = plan.mapper
+            report['reducer'] = plan.reducer
+            report['finalizer'] = plan.finalizer
+
+        query_plan = explain_query(db, plan.query,
+            execution=options.get('explain_stats', False))
+        problems = IndexAdvisor().query_problems(plan.query)
+        if query_plan['index'] is None:
+            problems.append('query plan does not use an index')
+        report['query_plan'] = query_plan
+        report['problems'] = problems
+
+        matched = query_plan['returned']
+        if matched is None:
+            matched = db.users.find(plan.query).count()
+        report['matched'] = matched
+        report.update(self.explain_emits(db, plan, options, matched))
+        return report
+
+    def explain_emits(self, db, plan, options, matched):
+        if plan.layout != 'embedded':
+            return {'sampled': 0, 'emits': None, 'groups': None}
+
+        spec = self.map_spec(options)
+        sampled = 0
+        emits = 0
+        groups = set()
+        for user in db.users.find(plan.query).limit(options.get('explain_sample', 1000)):
+            sampled += 1
+            for key, value in self.map_user(plan, spec, user):
+                emits += 1
+                groups.add(json_util.dumps(key))
+
+        estimate = 0
+        if sampled:
+            estimate = int(round(emits * matched / float(sampled)))
+        return {
+            'sampled': sampled,
+            'emits': {'sampled': emits, 'estimate': estimate},
+            'groups': {'sampled': len(groups), 'exact': sampled >= matched}
+        }
+
+    def execute(self, db, output, collection, plan):
+        if plan.backend == 'pipeline' and output == 'reduce':
+            temp = '{}_reduce'.format(collection)
+            try:
+                self.build_aggregate(db, 'replace', temp, plan.pipeline)
+                written = self.write_results(db, output, collection, plan, 
+                    db[temp].find(as_class=SON))
+            finally:
+                db[temp].drop()
+            return {'counts': {'output': written}, 'server_time': None}
+        elif plan.backend == 'pipeline':
+            written = self.build_aggregate(db, output, collection, plan.pipeline)
+            return {'counts': {'output': written}, 'server_time': None}
+        else:
+            response = self.build_chart(db, output, collection, plan.mapper,
+                plan.reducer, plan.finalizer, plan.query)
+            return {
+                'counts': response.get('counts'),
+                'server_time': response.get('timeMillis')
+            }
+
+    def execute_partitioned(self, db, output, collection, options, plan, partitions):
+        key = options.get('partition_key', '_id')
+        bounds = partition_bounds(db, plan.query, key, partitions)
+        plans = [self.compiler.compile(self, dict(options, query=query)) 
+            for query in partition_queries(plan.query, key, bounds)]
+        temps = ['{}_part{}'.format(collection, idx) for idx in range(len(plans))]
+
+        pool = ThreadPool(len(plans))
+        try:
+            parts = pool.map(lambda job: self.execute(db, 'replace', job[0], job[1]), 
+                zip(temps, plans))
+            # Embedded _ids only match in field order, so keep it on the read.
+            results = itertools.chain(*[db[temp].find(as_class=SON) for temp in temps])
+            written = self.write_results(db, output, collection, plan, 
+                self.merge_results(plan, results))
+        finally:
+            pool.close()
+            pool.join()
+            for temp in temps:
+                db[temp].drop()
+        return self.merge_stats(parts, written)
+
+    def execute_sharded(self, db, output, collection, options, plan, processes):
+        if plan.layout != 'embedded':
+            raise ValueError('processes needs the embedded actions layout')
+
+        key = options.get('partition_key', '_id')
+        uri = options.get('mongodb_uri') or connection_uri(db)
+        bounds = partition_bounds(db, plan.query, key, processes)
+        jobs = [(uri, db.name, type(self), options, query)
+            for query in partition_queries(plan.query, key, bounds)]
+
+        pool = Pool(len(jobs))
+        try:
+            shards = pool.map(map_shard, jobs)
+        finally:
+            pool.close()
+            pool.join()
+
+        results = ({'_id': id, 'value': value}
+            for groups, stats in shards for id, value in groups)
+        written = self.write_results(db, output, collection, plan,
+            self.merge_results(plan, results))
+        return self.merge_stats([stats for groups, stats in shards], written)
+
+    def merge_stats(self, parts, written):
+        counts = {}
+        server_time = None
+        for stats in parts:
+            for name, count in (stats['counts'] or {}).items():
+                if name != 'output':
+                    counts[name] = counts.get(name, 0) + count
+            if stats['server_time'] is not None:
+                server_time = (server_time or 0) + stats['server_time']
+
+        counts['output'] = written
+        return {'counts': counts, 'server_time': server_time}
+
+    def merge_results(self, plan, results):
+        for key, values in group_results(results):
+            value = self.finalize_value(plan, key, self.reduce_values(plan, values))
+            yield {'_id': key, 'value': value}
+
+    def write_results(self, db, output, collection, plan, docs):
+        if output == 'replace':
+            return replace_collection(db, collection, docs)
+
+        written = 0
+        for doc in docs:
+            if output == 'reduce':
+                existing = db[collection].find_one({'_id': doc['_id']})
+                if existing is not None:
+                    value = self.reduce_values(plan, [existing['value'], doc['value']])
+                    doc['value'] = self.finalize_value(plan, doc['_id'], value)
+            db[collection].save(doc)
+            written += 1
+        return written
+
+    def reduce_values(self, plan, values):
+        result = {'total': {'value': 0, 'calc': 'sum'}}
+        for name in plan.values:
+            result[name] = {'value': 0, 'calc': 'sum'}
+
+        for value in values:
+            result['total']['value'] += value['total']['value']
+            for name in plan.values:
+                if name in value:
+                    result[name]['value'] += value[name]['value']
+        return result
+
+    def finalize_value(self, plan, key, value):
+        for calc_name, calc, name, n in plan.finals:
+            value[calc_name] = {'value': 0, 'calc': calc, 'total': 0, 'n': 0}
+
+        for calc_name, calc, name, n in plan.finals:
+            if value[n]['value'] != 0:
+                value[calc_name]['value'] = value[name]['value'] / float(value[n]['value'])
+                value[calc_name]['total'] = value[name]['value']
+                value[calc_name]['n'] = value[n]['value']
+        return value
+
+    def map_spec(self, options):
+        group = self.validate_group_config(copy.deepcopy(options['group']))
+        calc = self.validate_calc_config(copy.deepcopy(options['calc']))
+        calc, init_values, set_bucket_values = self.build_set_range_bucket_values(
+            calc, self.build_init_values(calc))
+        self.build_init_final_values(calc)
+        return group, calc
+
+    def map_user(self, plan, spec, user):
+        group, calc = spec
+        values = {'total': {'value': 1, 'calc': 'sum'}}
+        for name in plan.values:
+            values[name] = {'value': 0, 'calc': 'sum'}
+
+        for data in calc:
+            if data['type'] == 'user' and 'value' in data:
+                if self.map_equals(user.get(data['attr']), data['value']):
+                    values[data['name']]['value'] += 1
+
+        for z in user.get('actions', []):
+            for data in calc:
+                if (data['type'] == 'action' and 'range_of' not in data and
+                        z.get('name') in self.map_attrs(data)):
+                    values[data['name']]['value'] += self.map_action_value(data, z)
+
+        self.map_buckets(calc, values)
+        self.map_adjust(calc, values)
+        return [(self.map_keys(group, user), values)]
+
+    def map_keys(self, group, user):
+        keys = SON()
+        for data in group:
+            if data['type'] == 'user':
+                keys[data['attr']] = self.map_key(user.get(data['attr']), data['format'])
+            elif data['type'] == 'ab':
+                keys[data['attr']] = self.map_variation(
+                    user.get('ab', {}).get(data['attr']))
+        return keys
+
+    def map_key(self, value, format):
+        if format == 'value' or not isinstance(value, datetime):
+            return value
+        return self.map_period(value, format).strftime('%Y/%m/%d')
+
+    def map_period(self, value, format):
+        if format == 'monthly':
+            return value.date().replace(day=1)
+        return value.date() - timedelta(days=(value.weekday() + 1) % 7)
+
+    # Incremental refreshes rebuild every group that holds a changed user, so
+    # each group key has to map back to a query over user attributes. Users
+    # are assumed to stay in their group: one that moves to another group, or
+    # stops matching the chart query, leaves its old group stale until the
+    # next full rebuild.
+    def check_incremental(self, options):
+        if options.get('layout', 'embedded') != 'embedded':
+            raise ValueError('incremental charts need the embedded layout, '
+                'bucketed action writes do not touch users.updated_at')
+        for data in self.validate_group_config(copy.deepcopy(options['group'])):
+            if data['type'] != 'user':
+                raise ValueError('incremental charts can only group by user '
+                    'attributes, not {} groups'.format(data['type']))
+
+    def group_query(self, group, key):
+        query = {}
+        for data in group:
+            value = key.get(data['attr'])
+            start = None
+            if data['format'] in ('monthly', 'weekly') and isinstance(value, basestring):
+                try:
+                    start = datetime.strptime(value, '%Y/%m/%d')
+                except ValueError:
+                    pass
+
+            if start is None:
+                query[data['attr']] = value
+            else:
+                query[data['attr']] = {
+                    '$gte': start, 
+                    '$lt': self.next_period(start, data['format'])
+                }
+        return query
+
+    def next_period(self, start, format):
+        if format == 'monthly':
+            return (start.replace(day=28) + timedelta(days=4)).replace(day=1)
+        return start + timedelta(days=7)
+
+    def map_variation(self, value):
+        if isinstance(value, (int, long, float)):
+            return 'variation_{}'.format(int(value))
+
+        match = None
+        if value is not None:
+            match = re.match(r'\s*([+-]?\d+)', unicode(value))
+        if match is None:
+            return 'variation_NaN'
+        return 'variation_{}'.format(int(match.group(1)))
+
+    def map_equals(self, value, expected):
+        if value is None:
+            return False
+        elif isinstance(value, (int, long, float)):
+            try:
+                return value == float(expected)
+            except ValueError:
+                return False
+        return unicode(value) == unicode(expected)
+
+    def map_attrs(self, data):
+        if type(data['attr']) is list:
+            return data['attr']
+        return [data['attr']]
+
+    def map_action_value(self, data, z, match_value=True):
+        if 'meta' in data and 'value' in data and match_value:
+            return 1 if self.map_equals(z.get(data['meta']), data['value']) else 0
+        elif 'meta' in data:
+            meta = z.get(data['meta'])
+            return meta if isinstance(meta, (int, long, float)) else 0
+        return 1
+
+    def map_buckets(self, calc, values):
+        for data in calc:
+            if 'range_of' not in data:
+                continue
+
+            count = values[data['range_of']]['value']
+            value = data['range']
+            if type(value) is int:
+                matched = count == value
+            elif len(value) == 2 and value[1] is None:
+                matched = count >= value[0]
+            else:
+                matched = value[0] <= count <= value[1]
+
+            if matched:
+                values[data['name']]['value'] = 1
+                break
+
+    def map_adjust(self, calc, values, conditional=True):
+        for data in calc:
+            value = values[data['name']]
+            if data['calc'] == 'pct' and data['cond']['type'] != 'sum':
+                op = self.map_conditions[data['cond']['type']]
+                value['value'] = 1 if op(value['value'], data['cond']['value']) else 0
+            elif conditional and data['cond']['type'] == 'if':
+                other = values[data['cond']['value']]
+                if not (value['value'] > 0 and other['value'] > 0):
+                    value['value'] = 0
+
+    def compile(self, options):
+
+        backend = options.get('backend', 'mapreduce')
+        layout = options.get('layout', 'embedded')
+        if layout == 'bucketed':
+            backend = 'pipeline'
         
         query = options.get('query')
         group = options.get('group')
         calc = options.get('calc')
         
         if query is None or group is None or calc is None:
-            return False
+            return None
 
         group = self.validate_group_config(group)
         calc = self.validate_calc_config(calc)
@@ -135,11 +526,26 @@ class CohortFunnel(object):
 
         finalizer = self.finalizer_template.format(out_init_final_values, out_set_final_calc)
 
-        if debug:
-            self.debug(mapper, reducer, finalizer)
-        else:
-            self.build_chart(db, output, collection, mapper, 
-                reducer, finalizer, query)
+        pipeline = None
+        if backend == 'pipeline':
+            source = self.build_pipeline_source(query, layout, options)
+            pipeline = self.build_pipeline(source, group, calc, init_values)
+
+        return ChartPlan(
+            plugin=None,
+            backend=backend,
+            layout=layout,
+            query=query,
+            mapper=mapper,
+            reducer=reducer,
+            finalizer=finalizer,
+            pipeline=pipeline,
+            values=tuple(init_values),
+            finals=tuple((data['calc_name'], data['calc'], data['name'], data['n']) 
+                for data in calc if data['calc'] != 'sum'),
+            date_field=None,
+            config_hash=None,
+            options=None)
 
     def validate_group_config(self, group):
         validated_group = []
@@ -154,7 +560,9 @@ class CohortFunnel(object):
             validated_group.append(data)
         return validated_group
          
-    def build_set_emit_keys(self, group, set_emit_keys=[]):      
+    def build_set_emit_keys(self, group, set_emit_keys=None):
+        if set_emit_keys is None:
+            set_emit_keys = []
         for data in group:
             
             if data['type'] == 'user':
@@ -176,7 +584,9 @@ class CohortFunnel(object):
                 set_emit_keys.append(emit_key_part)                   
         return set_emit_keys
 
-    def build_init_emit_keys(self, group, init_emit_keys=[]):        
+    def build_init_emit_keys(self, group, init_emit_keys=None):
+        if init_emit_keys is None:
+            init_emit_keys = []
 
         for data in group:
             if data['type'] == 'user' or data['type'] == 'ab':
@@ -231,13 +641,17 @@ class CohortFunnel(object):
         
         return validated_calc
 
-    def build_init_values(self, calc, init_values=[]):
+    def build_init_values(self, calc, init_values=None):
+        if init_values is None:
+            init_values = []
         for data in calc:
             if data['name'] not in init_values:    
                 init_values.append(data['name'])
         return init_values
 
-    def build_set_user_values(self, calc, set_user_values=[]):
+    def build_set_user_values(self, calc, set_user_values=None):
+        if set_user_values is None:
+            set_user_values = []
         for data in calc:
             if data['type'] == 'user' and 'value' in data:
                 code = "if(this.{a} == '{v}'){{ values.{n}.value++; }}".format(
@@ -245,7 +659,9 @@ class CohortFunnel(object):
                 set_user_values.append(code)
         return set_user_values
 
-    def build_set_action_values(self, calc, set_action_values={}):
+    def build_set_action_values(self, calc, set_action_values=None):
+        if set_action_values is None:
+            set_action_values = {}
         for data in calc:
             if data['type'] == 'action':
                 if 'meta' in data and 'value' in data:
@@ -270,7 +686,9 @@ class CohortFunnel(object):
         
         return set_action_values
 
-    def build_adjust_cond_values(self, calc, adjust_cond_values=[]):
+    def build_adjust_cond_values(self, calc, adjust_cond_values=None):
+        if adjust_cond_values is None:
+            adjust_cond_values = []
         for data in calc:
             if data['calc'] == 'pct' and data['cond']['type'] != 'sum':
                 op = self.accepted_conditions[data['cond']['type']]            
@@ -284,7 +702,11 @@ class CohortFunnel(object):
                 adjust_cond_values.append(cond_code)  
         return adjust_cond_values
 
-    def build_set_range_bucket_values(self, calc, init_values=[], set_bucket_values=[]):
+    def build_set_range_bucket_values(self, calc, init_values=None, set_bucket_values=None):
+        if init_values is None:
+            init_values = []
+        if set_bucket_values is None:
+            set_bucket_values = []
         new_calc = []
         for data in calc:
             bucket = data.get('bucket', None)    
@@ -314,7 +736,9 @@ class CohortFunnel(object):
                         'name': new_name,
                         'n': data['n'], 
                         'type': data['type'],
-                        'cond': data['cond']   
+                        'cond': data['cond'],
+                        'range_of': data['name'],
+                        'range': value
                     }
                     new_calc.append(calc_config)
                     
@@ -324,14 +748,18 @@ class CohortFunnel(object):
         calc.extend(new_calc)
         return [calc, init_values, set_bucket_values]         
 
-    def build_init_final_values(self, calc, init_final_values=[]):
+    def build_init_final_values(self, calc, init_final_values=None):
+        if init_final_values is None:
+            init_final_values = []
         for data in calc:
             if data['calc'] != 'sum':
                 data['calc_name'] = "{}_{}".format(data['calc'], data['name'])
                 init_final_values.append({'n':data['calc_name'], 'c': data['calc']})
         return init_final_values
 
-    def build_init_final_calc(self, calc, set_final_calc=[]):
+    def build_init_final_calc(self, calc, set_final_calc=None):
+        if set_final_calc is None:
+            set_final_calc = []
         for data in calc:
             if data['calc'] != 'sum':
                 final_calc = ("if(value.{n}.value != 0){{value.{c}.value = value.{t}.value/value.{n}.value; "
@@ -376,16 +804,223 @@ class CohortFunnel(object):
     def gen_set_final_calc(self, set_final_calc):    
         return " ".join(set_final_calc)
 
-    def debug(self, mapper, reducer, finalizer):
-        print mapper
-        print reducer
-        print finalizer
+    def debug(self, plan):
+        print plan.mapper
+        print plan.reducer
+        print plan.finalizer
+        if plan.pipeline is not None:
+            pprint.pprint(list(plan.pipeline))
 
     def build_chart(self, db, output, collection, mapper, 
             reducer, finalizer, query):
-        db.users.map_reduce(
+        return db.users.map_reduce(
             Code(mapper), 
             Code(reducer), 
             out={output : collection}, 
+            full_response=True,
             finalize=Code(finalizer), 
             query=query)
+
+
+    def build_pipeline(self, source, group, calc, init_values):
+        names = ['total'] + init_values
+        keys = self.build_pipeline_keys(group)
+
+        values = self.build_pipeline_values(calc, init_values)
+        values['total'] = {'$literal': 1}
+
+        pipeline = source + [
+            {'$project': {'_k': keys or {'$literal': {}}, '_v': values}}
+        ]
+        pipeline.extend(self.build_pipeline_bucket_stages(calc, names))
+        pipeline.extend(self.build_pipeline_cond_stages(calc, names))
+        pipeline.append(self.build_pipeline_group(
+            self.build_pipeline_group_keys(keys), init_values))
+        pipeline.append(self.build_pipeline_final(calc, init_values))
+        return pipeline
+
+    def build_pipeline_source(self, query, layout, options):
+        source = [{'$match': query}]
+        if layout == 'bucketed':
+            source.extend([
+                {'$lookup': {
+                    'from': options.get('buckets', 'action_buckets'),
+                    'localField': '_id',
+                    'foreignField': 'user_id',
+                    'as': 'buckets'
+                }},
+                {'$addFields': {'actions': {'$reduce': {
+                    'input': '$buckets.actions',
+                    'initialValue': [],
+                    'in': {'$concatArrays': ['$$value', '$$this']}
+                }}}}
+            ])
+        return source
+
+    def build_pipeline_keys(self, group):
+        keys = SON()
+        for data in group:
+            if data['type'] == 'user':
+                keys[data['attr']] = self.build_pipeline_key(
+                    '$' + data['attr'], data['format'])
+            elif data['type'] == 'ab' and data['format'] == 'value':
+                keys[data['attr']] = {'$concat': [
+                    'variation_', {'$substr': ['$ab.' + data['attr'], 0, -1]}]}
+        return keys
+
+    def build_pipeline_key(self, field, format):
+        if format == 'monthly':
+            return {'$dateToString': {'format': '%Y/%m/01', 'date': field}}
+        elif format == 'weekly':
+            week_start = {'$subtract': [field, {'$multiply': [
+                {'$subtract': [{'$dayOfWeek': field}, 1]}, 86400000]}]}
+            return {'$dateToString': {'format': '%Y/%m/%d', 'date': week_start}}
+        else:
+            return field
+
+    def build_pipeline_group_keys(self, keys):
+        group_keys = SON()
+        for attr in keys:
+            group_keys[attr] = '$_k.' + attr
+        return group_keys
+
+    def build_pipeline_action_cond(self, actions, var='$$z'):
+        if type(actions) is not list:
+            actions = [actions]
+        return {'$or': [{'$eq': [var + '.name', {'$literal': action}]}
+            for action in actions]}
+
+    def build_pipeline_values(self, calc, init_values):
+        actions = {'$ifNull': ['$actions', []]}
+        values = dict((name, {'$literal': 0}) for name in init_values)
+
+        for data in calc:
+            if 'range_of' in data:
+                continue
+
+            if data['type'] == 'user' and 'value' in data:
+                values[data['name']] = {'$cond': [
+                    {'$eq': ['$' + data['attr'], {'$literal': data['value']}]}, 1, 0]}
+            elif data['type'] == 'action':
+                cond = self.build_pipeline_action_cond(data['attr'])
+                if 'meta' in data and 'value' in data:
+                    cond = {'$and': [cond, {'$eq': [
+                        '$$z.' + data['meta'], {'$literal': data['value']}]}]}
+
+                matched = {'$filter': {'input': actions, 'as': 'z', 'cond': cond}}
+                if 'meta' in data and 'value' not in data:
+                    values[data['name']] = {'$sum': {'$map': {
+                        'input': matched, 'as': 'z',
+                        'in': {'$ifNull': ['$$z.' + data['meta'], 0]}}}}
+                else:
+                    values[data['name']] = {'$size': matched}
+        return values
+
+    def build_pipeline_stage(self, names, updates, keep=('_k',)):
+        stage = dict((field, 1) for field in keep)
+        stage['_v'] = dict((name, '$_v.' + name) for name in names)
+        stage['_v'].update(updates)
+        return {'$project': stage}
+
+    def build_pipeline_bucket_stages(self, calc, names):
+        # Buckets are evaluated as a single else-chain, the same as the mapper.
+        updates = {}
+        matched = []
+        for data in calc:
+            if 'range_of' not in data:
+                continue
+
+            source = '$_v.' + data['range_of']
+            value = data['range']
+            if type(value) is int:
+                cond = {'$eq': [source, value]}
+            elif len(value) == 2 and value[1] is None:
+                cond = {'$gte': [source, value[0]]}
+            else:
+                cond = {'$and': [{'$gte': [source, value[0]]},
+                    {'$lte': [source, value[1]]}]}
+
+            updates[data['name']] = {'$cond': [
+                {'$and': [cond] + [{'$not': [prev]} for prev in matched]}, 1, 0]}
+            matched.append(cond)
+
+        if updates:
+            return [self.build_pipeline_stage(names, updates)]
+        return []
+
+    def build_pipeline_adjust(self, data):
+        value = '$_v.' + data['name']
+        if data['calc'] == 'pct' and data['cond']['type'] != 'sum':
+            op = self.pipeline_conditions[data['cond']['type']]
+            return ({'$cond': [{op: [value, data['cond']['value']]}, 1, 0]}, [])
+        elif data['cond']['type'] == 'if':
+            if_value = '$_v.' + data['cond']['value']
+            return ({'$cond': [{'$and': [{'$gt': [value, 0]}, {'$gt': [if_value, 0]}]},
+                value, 0]}, [data['cond']['value']])
+        return None
+
+    def build_pipeline_cond_stages(self, calc, names, keep=('_k',)):
+        # Adjustments run in order, so one that reads a value adjusted earlier
+        # starts a new stage.
+        stages = []
+        updates = {}
+        for data in calc:
+            adjust = self.build_pipeline_adjust(data)
+            if adjust is None:
+                continue
+
+            expr, refs = adjust
+            if data['name'] in updates or any(ref in updates for ref in refs):
+                stages.append(self.build_pipeline_stage(names, updates, keep))
+                updates = {}
+            updates[data['name']] = expr
+
+        if updates:
+            stages.append(self.build_pipeline_stage(names, updates, keep))
+        return stages
+
+    def build_pipeline_group(self, group_keys, init_values):
+        stage = {
+            '_id': group_keys or {'$literal': {}},
+            'total': {'$sum': '$_v.total'}
+        }
+        for name in init_values:
+            stage[name] = {'$sum': '$_v.' + name}
+        return {'$group': stage}
+
+    def build_pipeline_final(self, calc, init_values):
+        value = {'total': {'value': '$total', 'calc': {'$literal': 'sum'}}}
+        for name in init_values:
+            value[name] = {'value': '$' + name, 'calc': {'$literal': 'sum'}}
+
+        for data in calc:
+            if data['calc'] != 'sum':
+                total = '$' + data['name']
+                n = '$' + data['n']
+                has_n = {'$ne': [n, 0]}
+                value[data['calc_name']] = {
+                    'value': {'$cond': [has_n, {'$divide': [total, n]}, 0]},
+                    'calc': {'$literal': data['calc']},
+                    'total': {'$cond': [has_n, total, 0]},
+                    'n': {'$cond': [has_n, n, 0]}
+                }
+        return {'$project': {'_id': 1, 'value': value}}
+
+    def build_aggregate(self, db, output, collection, pipeline):
+        if output == 'replace':
+            db.users.aggregate(list(pipeline) + [{'$out': collection}],
+                allowDiskUse=True, cursor={})
+            return db[collection].count()
+
+        # Aggregate cursors decode as plain dicts, which lose the _id key order
+        # that saves need to match, so merge through a $out collection instead.
+        temp = '{}_merge'.format(collection)
+        try:
+            self.build_aggregate(db, 'replace', temp, pipeline)
+            written = 0
+            for doc in db[temp].find(as_class=SON):
+                db[collection].save(doc)
+                written += 1
+        finally:
+            db[temp].drop()
+        return written
@@ -0,0 +1,109 @@
+import copy
+import hashlib
+import json
+import threading
+from collections import namedtuple, OrderedDict
+from bson import json_util
+
+ChartPlan = namedtuple('ChartPlan', [
+    'plugin',
+    'backend',
+    'layout',
+    'query',
+    'mapper',
+    'reducer',
+    'finalizer',
+    'pipeline',
+    'values',
+    'finals',
+    'date_field',
+    'config_hash',
+    'options'
+])
+
+# Options that change how a plan is executed but not what gets compiled.
+RUNTIME_OPTIONS = ('debug', 'output', 'incremental', 'watermark', 
+    'partitions', 'partition_key', 'processes', 'mongodb_uri', 'explain',
+    'explain_sample', 'explain_stats', 'formats')
+
+
+def plugin_name(plugin):
+    return '.'.join([type(plugin).__module__, type(plugin).__name__])
+
+
+def chart_config(options):
+    return dict((key, value) for key, value in options.items()
+        if key not in RUNTIME_OPTIONS)
+
+
+# Plans are cached without their query and bound to it on every compile, so
+# incremental windows and partitions reuse the plan of the chart they split.
+def config_hash(plugin, options):
+    config = chart_config(options)
+    config.pop('query', None)
+    config['plugin'] = plugin_name(plugin)
+    encoded = json.dumps(config, sort_keys=True, default=json_util.default)
+    return hashlib.sha1(encoded).hexdigest()
+
+
+class ChartCompiler(object):
+
+    def __init__(self, max_size=256):
+        self.max_size = max_size
+        self.plans = OrderedDict()
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def compile(self, plugin, options):
+        if options.get('query') is None:
+            return None
+        key = config_hash(plugin, options)
+
+        with self.lock:
+            plan = self.plans.pop(key, None)
+            if plan is not None:
+                self.plans[key] = plan
+                self.hits += 1
+            else:
+                self.misses += 1
+
+        if plan is None:
+            plan = plugin.compile(copy.deepcopy(options))
+            if plan is None:
+                return None
+
+            plan = plan._replace(
+                plugin=plugin_name(plugin),
+                config_hash=key,
+                options=copy.deepcopy(chart_config(options)),
+                pipeline=tuple(plan.pipeline) if plan.pipeline else None)
+
+            with self.lock:
+                self.plans[key] = plan
+                while len(self.plans) > self.max_size:
+                    self.plans.popitem(last=False)
+
+        return self.bind(plan, options['query'])
+
+    def bind(self, plan, query):
+        query = copy.deepcopy(query)
+        pipeline = plan.pipeline
+        if pipeline is not None:
+            pipeline = ({'$match': query},) + pipeline[1:]
+        return plan._replace(query=query, pipeline=pipeline,
+            options=dict(plan.options, query=query))
+
+    def find(self, mapper):
+        with self.lock:
+            for plan in reversed(self.plans.values()):
+                if plan.mapper == mapper:
+                    return plan
+        return None
+
+    def clear(self):
+        with self.lock:
+            self.plans.clear()
+
+
+default_compiler = ChartCompiler()
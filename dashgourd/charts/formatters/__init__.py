@@ -1,9 +1,11 @@
 from dashgourd.charts.formatters import ab
 from dashgourd.charts.formatters import combo
+from dashgourd.charts.formatters import datatable
 from dashgourd.charts.formatters import retention
 from dashgourd.charts.formatters import table
 
 FormatAb = ab.FormatAb
 FormatCombo = combo.FormatCombo
 FormatRetention = retention.FormatRetention
-FormatTable = table.FormatTable
\ No newline at end of file
+FormatTable = table.FormatTable
+DataTableEncoder = datatable.DataTableEncoder
\ No newline at end of file
@@ -1,24 +1,48 @@
+import pymongo
 from dashgourd.charts.formatters.helper import FormatHelper
+from dashgourd.charts.formatters.datatable import to_json
 
 class FormatAb(object):
 
-    def __init__(self):
+    def __init__(self, formatted=True):
         
-        self.helper = FormatHelper(True)
+        self.helper = FormatHelper(True, formatted)
         self.change_formats = self.helper.change_formats
         self.default_formats = self.helper.default_formats
 
     def build(self, results, fields):
 
-        data = []
-        data_key = {}
         description = {}
         columns_order = []
-        
+        data = list(self.iter_rows(results, fields, description, columns_order))
+
+        return {
+            'data':data, 
+            'description':description,
+            'columns_order': tuple(columns_order)
+        }
+
+    def build_json(self, results, fields):
+        return to_json(self.build(results, fields), self.helper.formatted)
+
+    # The first variation is the control, so keep variation_0 first.
+    def sort_spec(self, fields):
+        return [('_id', pymongo.ASCENDING)]
+
+    # There is one result per variation, so only those are held in memory;
+    # metric rows are formatted and yielded one at a time.
+    def iter_rows(self, results, fields, description=None, columns_order=None):
+
+        if description is None:
+            description = {}
+        if columns_order is None:
+            columns_order = []
+
         variations = []
+        values = {}
 
         description['metric'] = ("string", "Metric")
-        columns_order = ['metric']
+        columns_order.append('metric')
         
         for result in results:
         
@@ -30,52 +54,46 @@ class FormatAb(object):
                     change_key = "change_{}".format(variation)
                     description[change_key] = ("number", "% Change")
 
-            value = result['value']
-            
-            for field in fields:
-        
-                name = field['name']
-                meta = value[name]
+            values[variation] = result['value']
 
-                if name not in data_key:
-                    data_key[name] = {'idx': len(data), 'calc_type': meta['calc']}
-                    row = {'metric': field.get('label', name.replace('_', ' ').title())}
-                    data.append(row)
-                else:
-                    row = data[data_key[name]['idx']]
+        if not variations:
+            return
+
+        control = variations[0]
+        for variation in variations:
+            columns_order.append(variation)
+            if variation != control:
+                columns_order.append("change_{}".format(variation))
 
-                row[variation] = self.helper.format(value[name], field)
+        for field in fields:
+            yield self.build_row(field, variations, values)
 
+    def build_row(self, field, variations, values):
+        name = field['name']
         control = variations[0]
-        for key in data_key:
-            idx = data_key[key]['idx']
-            calc_type = data_key[key]['calc_type']
-            data_format = field.get('format', self.change_formats['pct'])
+        calc_type = values[control][name]['calc']
+        data_format = field.get('format', self.change_formats['pct'])
+
+        row = {'metric': field.get('label', name.replace('_', ' ').title())}
+        for variation in variations:
+            row[variation] = self.helper.format(values[variation][name], field)
+
+        for variation in variations:
+            change_key = "change_{}".format(variation)
             
-            row = data[idx]
-            for variation in variations:
-                change_key = "change_{}".format(variation)
-                
-                if calc_type == 'sum':
-                    if row[control][0] != 0:
-                        change = (row[variation][0] / float(row[control][0])) - 1.0
-                    else:
-                        change = 0
+            if calc_type == 'sum':
+                if row[control][0] != 0:
+                    change = (row[variation][0] / float(row[control][0])) - 1.0
+                else:
+                    change = 0
+            else:
+                if row[control][0] != 0:
+                    change = (row[variation][0] / row[control][0]) - 1
                 else:
-                    if row[control][0] != 0:
-                        change = (row[variation][0] / row[control][0]) - 1
-                    else:
-                        change = 0
-                
+                    change = 0
+            
+            if self.helper.formatted:
                 row[change_key] = (change, data_format.format(change))
-                
-                if variation not in columns_order:
-                    columns_order.append(variation)
-                    if variation != control:
-                        columns_order.append(change_key)
-
-        return {
-            'data':data, 
-            'description':description,
-            'columns_order': tuple(columns_order)
-        }
\ No newline at end of file
+            else:
+                row[change_key] = (change, None)
+        return row
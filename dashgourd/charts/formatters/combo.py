@@ -1,74 +1,113 @@
-from datetime import datetime
+import pymongo
 from dashgourd.charts.formatters.helper import FormatHelper
+from dashgourd.charts.formatters.datatable import to_json
 
 class FormatCombo(object):
 
-    def __init__(self):
+    def __init__(self, formatted=True):
         
-        self.helper = FormatHelper()
+        self.helper = FormatHelper(formatted=formatted)
         self.default_formats = self.helper.default_formats
 
     def build(self, results, fields, group, split=None):
         
         data = []
         data_key = {}
-        description = {}
-        columns_order = []
+        description, columns_order = self.build_description(group)
 
-        single_field = True if len(fields) == 1 else False
-        
+        for result in results:
+            key = result['_id'][group['name']]
+            if key not in data_key:
+                data_key[key] = {'idx': len(data)}
+                data.append(self.build_key_row(key, group))
+
+            row = data[data_key[key]['idx']]
+            self.fill_row(row, result, fields, split, description, columns_order)
+
+        return {
+            'data':data, 
+            'description':description,
+            'columns_order': tuple(columns_order)
+        }
+
+    def build_json(self, results, fields, group, split=None):
+        return to_json(self.build(results, fields, group, split), self.helper.formatted)
+
+    def sort_spec(self, fields, group, split=None):
+        return [('_id.' + group['name'], pymongo.ASCENDING)]
+
+    # Results must be sorted by the group key so rows can be emitted as soon as
+    # the key changes, e.g. ChartsApi.get_chart(collection, sort='_id.created_at').
+    def iter_rows(self, results, fields, group, split=None, 
+            description=None, columns_order=None):
+
+        if description is None:
+            description = {}
+        if columns_order is None:
+            columns_order = []
+        if group['name'] not in description:
+            group_description, group_order = self.build_description(group)
+            description.update(group_description)
+            columns_order.extend(group_order)
+
+        row = None
+        last_key = None
+        for result in results:
+            key = result['_id'][group['name']]
+            if row is None or key != last_key:
+                if row is not None:
+                    yield row
+                row = self.build_key_row(key, group)
+                last_key = key
+            self.fill_row(row, result, fields, split, description, columns_order)
+
+        if row is not None:
+            yield row
+
+    def build_description(self, group):
         group_name = group['name']
         group_data_type = group.get('data_type', 'date')
         group_label = group.get('label', group['name'].replace('_', ' ').title())
 
-        description[group_name] = (group_data_type, group_label) 
+        description = {group_name: (group_data_type, group_label)}
         columns_order = [group_name]
+        return description, columns_order
 
-        for result in results:
-            
-            key = result['_id'][group_name]
-            prefix = result['_id'].get(split, None)
-            value = result['value']
-
-            for field in fields:
-                name = field['name']
-               
-                if prefix is None:
-                    line_name = name
-                    label = field.get('label', name.replace('_', ' ').title())
-                elif single_field:
-                    line_name = prefix
-                    field_label = field.get('label', None)
-                    
-                    if type(field_label) is str:
-                        label = "{} {}".format(prefix.title(), field_label)
-                    elif type(field_label) is dict and prefix in field_label:
-                        label = field_label[prefix]
-                    else:
-                        label = prefix.title()
-                else:
-                    line_name = "{}_{}".format(prefix, name)
-                    label = " ".join([prefix, field.get('label', name.replace('_', ' ').title())])
-
-                if key not in data_key:
-                    key_value = key             
-                    if group_data_type == 'date':
-                        key_value = datetime.strptime(key, '%Y/%m/%d')
-                    data_key[key] = {'idx': len(data)}
-                    row = {group_name : key_value}
-                    data.append(row)
-                else:
-                    row = data[data_key[key]['idx']]
-                
-                if line_name not in description:
-                    columns_order.append(line_name)
-                    data_type = field.get('data_type', 'number')
-                    description[line_name] = (data_type, label)
+    def build_key_row(self, key, group):
+        key_value = key             
+        if group.get('data_type', 'date') == 'date':
+            key_value = self.helper.parse_date(key)
+        return {group['name']: key_value}
+
+    def fill_row(self, row, result, fields, split, description, columns_order):
+
+        single_field = True if len(fields) == 1 else False
+        prefix = result['_id'].get(split, None)
+        value = result['value']
+
+        for field in fields:
+            name = field['name']
+           
+            if prefix is None:
+                line_name = name
+                label = field.get('label', name.replace('_', ' ').title())
+            elif single_field:
+                line_name = prefix
+                field_label = field.get('label', None)
                 
-                row[line_name] = self.helper.format(value[name], field)
+                if type(field_label) is str:
+                    label = "{} {}".format(prefix.title(), field_label)
+                elif type(field_label) is dict and prefix in field_label:
+                    label = field_label[prefix]
+                else:
+                    label = prefix.title()
+            else:
+                line_name = "{}_{}".format(prefix, name)
+                label = " ".join([prefix, field.get('label', name.replace('_', ' ').title())])
 
-        return {
-            'data':data, 
-            'description':description,
-            'columns_order': tuple(columns_order)
-        }
\ No newline at end of file
+            if line_name not in description:
+                columns_order.append(line_name)
+                data_type = field.get('data_type', 'number')
+                description[line_name] = (data_type, label)
+            
+            row[line_name] = self.helper.format(value[name], field)
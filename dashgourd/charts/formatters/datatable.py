@@ -0,0 +1,87 @@
+import json
+
+
+def encode_date(value):
+    return 'Date({},{},{})'.format(value.year, value.month - 1, value.day)
+
+
+def encode_datetime(value):
+    return 'Date({},{},{},{},{},{})'.format(value.year, value.month - 1,
+        value.day, value.hour, value.minute, value.second)
+
+
+def encode_timeofday(value):
+    return [value.hour, value.minute, value.second]
+
+
+def encode_string(value):
+    if isinstance(value, basestring):
+        return value
+    return unicode(value)
+
+
+VALUE_ENCODERS = {
+    'date': encode_date,
+    'datetime': encode_datetime,
+    'timeofday': encode_timeofday,
+    'string': encode_string,
+    'number': None,
+    'boolean': None
+}
+
+
+class DataTableEncoder(object):
+
+    def __init__(self, description, columns_order, formatted=True):
+        self.formatted = formatted
+        self.cols = []
+        self.encoders = []
+
+        for name in columns_order:
+            data_type, label = description[name]
+            self.cols.append({'id': name, 'label': label, 'type': data_type})
+            self.encoders.append((name, self.cell_encoder(data_type)))
+
+    def cell_encoder(self, data_type):
+        encode_value = VALUE_ENCODERS[data_type]
+        formatted = self.formatted
+
+        if encode_value is None:
+            def encode(cell):
+                if type(cell) is tuple:
+                    if cell[0] is None:
+                        return None
+                    if formatted and cell[1] is not None:
+                        return {'v': cell[0], 'f': cell[1]}
+                    return {'v': cell[0]}
+                if cell is None:
+                    return None
+                return {'v': cell}
+            return encode
+
+        def encode(cell):
+            if type(cell) is tuple:
+                if cell[0] is None:
+                    return None
+                if formatted and cell[1] is not None:
+                    return {'v': encode_value(cell[0]), 'f': cell[1]}
+                return {'v': encode_value(cell[0])}
+            if cell is None:
+                return None
+            return {'v': encode_value(cell)}
+        return encode
+
+    def encode_row(self, row):
+        return {'c': [encode(row.get(name)) for name, encode in self.encoders]}
+
+    def encode(self, rows):
+        return {'cols': self.cols, 'rows': [self.encode_row(row) for row in rows]}
+
+    def to_json(self, rows):
+        return json.dumps(self.encode(rows), separators=(',', ':'))
+
+
+def to_json(table, formatted=True):
+    encoder = DataTableEncoder(
+        table['description'], table['columns_order'], formatted)
+    return encoder.to_json(table['data'])
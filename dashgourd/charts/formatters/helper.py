@@ -1,9 +1,12 @@
+from datetime import datetime
+
 
 class FormatHelper(object):
 
-    def __init__(self, allow_html=False):
+    def __init__(self, allow_html=False, formatted=True):
 
         self.allow_html = allow_html
+        self.formatted = formatted
         self.change_formats = {
             'sum': '{:+}',
             'avg': '{:+.2}',
@@ -30,15 +33,21 @@ class FormatHelper(object):
 
     def format_sum(self, meta, data_format):
         value = meta['value']
+        if not self.formatted:
+            return (int(value), None)
         return (int(value), data_format.format(value))
 
     def format_avg(self, meta, data_format):
+        if not self.formatted:
+            return (meta['value'], None)
         display = self.show_calc(
             meta['value'], meta['total'], meta['n'], data_format)
         return (meta['value'], display)
     
     def format_pct(self, meta, data_format):
         data_value = meta['value']*100
+        if not self.formatted:
+            return (data_value, None)
         display = self.show_calc(
             meta['value'], meta['total'], meta['n'], data_format)
         return (data_value, display)
@@ -48,4 +57,8 @@ class FormatHelper(object):
         if self.allow_html:
             display = '<span class="subtext">({}/{})</span> {}'
         return display.format(
-            int(total), int(n), data_format.format(value))
\ No newline at end of file
+            int(total), int(n), data_format.format(value))
+
+    def parse_date(self, value):
+        year, month, day = value.split('/')
+        return datetime(int(year), int(month), int(day))
@@ -1,11 +1,44 @@
+import pymongo
+from dashgourd.charts.formatters.datatable import to_json
+
 class FormatRetention(object):
+
+    def __init__(self, formatted=True):
+        self.formatted = formatted
     
     def build(self, results):
+        description, columns_order = self.build_description()
+        data = list(self.iter_rows(results, description, columns_order))
+        data.sort(key=lambda item:item['created_at'])
+        
+        return {
+            'data':data, 
+            'description':description, 
+            'columns_order': tuple(columns_order)
+        }
+
+    def build_json(self, results):
+        return to_json(self.build(results), self.formatted)
+
+    def sort_spec(self):
+        return [('_id.created_at', pymongo.ASCENDING)]
+
+    def build_description(self):
         columns_order = ['created_at']
         description = {
             'created_at': ('string', 'Date')
         }
-        data = []
+        return description, columns_order
+
+    def iter_rows(self, results, description=None, columns_order=None):
+        if description is None:
+            description = {}
+        if columns_order is None:
+            columns_order = []
+        if 'created_at' not in description:
+            date_description, date_order = self.build_description()
+            description.update(date_description)
+            columns_order.extend(date_order)
 
         for result in results:
             row = {
@@ -27,19 +60,12 @@ class FormatRetention(object):
                 else:
                     col_name = str(count)
                     description[col_name] = ('number', col_name)
-                    row[col_name] = (value['pct']['value'], '{:.1%}'.format(value['pct']['value']))
+                    pct = value['pct']['value']
+                    row[col_name] = (pct, '{:.1%}'.format(pct) if self.formatted else None)
                 
                 if col_name not in columns_order:
                     columns_order.append(col_name)
                 
                 count += 1
                 
-            data.append(row)
-
-        data.sort(key=lambda item:item['created_at'])
-        
-        return {
-            'data':data, 
-            'description':description, 
-            'columns_order': tuple(columns_order)
-        }
\ No newline at end of file
+            yield row
@@ -1,16 +1,52 @@
-from datetime import datetime
+import pymongo
 from dashgourd.charts.formatters.helper import FormatHelper
+from dashgourd.charts.formatters.datatable import DataTableEncoder
 
 class FormatTable(object):
     
-    def __init__(self):
+    def __init__(self, formatted=True):
         
-        self.helper = FormatHelper(True)
+        self.helper = FormatHelper(True, formatted)
         self.default_formats = self.helper.default_formats
 
     def build(self, results, fields, row_order=None):
 
-        data = []        
+        description, columns_order = self.build_description(fields)
+
+        if row_order is None:
+            row_order = self.default_row_order(fields)
+        
+        data = list(self.iter_rows(results, fields))
+        self.sort_rows(data, row_order)
+        
+        return {
+            'data':data, 
+            'description':description,
+            'columns_order': tuple(columns_order)
+        }
+
+    def build_json(self, results, fields, row_order=None, presorted=False):
+
+        description, columns_order = self.build_description(fields)
+        encoder = DataTableEncoder(description, columns_order, self.helper.formatted)
+
+        if row_order is None:
+            row_order = self.default_row_order(fields)
+
+        # Presorted results come from e.g. ChartsApi.get_chart(collection,
+        # sort=self.sort_spec(fields, row_order)) and are streamed as they are.
+        if row_order and not presorted:
+            data = list(self.iter_rows(results, fields))
+            self.sort_rows(data, row_order)
+        else:
+            data = self.iter_rows(results, fields)
+        return encoder.to_json(data)
+
+    def iter_rows(self, results, fields):
+        for result in results:
+            yield self.build_row(result, fields)
+
+    def build_description(self, fields):
         description = {}    
         columns_order = []
         
@@ -18,44 +54,63 @@ class FormatTable(object):
             label = field.get('label', field['name'].replace('_', ' ').title())
             data_type = field.get('data_type', 'number')
             description[field['name']] = (data_type, label)
-        
-        for field in fields:
             columns_order.append(field['name'])
+        return description, columns_order
 
+    def default_row_order(self, fields):
+        return [{'name': field['name']} for field in fields 
+            if field.get('is_key_col', False)]
+
+    def sort_spec(self, fields, row_order=None):
         if row_order is None:
-            row_order = []
-            for field in fields:
-                name = field['name']                
-                is_key_col = field.get('is_key_col', False)
-                if is_key_col:
-                     row_order.append({'name': name})           
-        
-        for result in results:
+            row_order = self.default_row_order(fields)
 
-            row = {}
-            value = result['value']
+        key_cols = set(field['name'] for field in fields 
+            if field.get('is_key_col', False))
+        return [(self.sort_field(col['name'], key_cols), 
+            pymongo.DESCENDING if col.get('reverse', False) else pymongo.ASCENDING)
+            for col in row_order]
 
-            for field in fields:
-                name = field['name']                
-                is_key_col = field.get('is_key_col', False)
+    def sort_field(self, name, key_cols):
+        if name in key_cols:
+            return '_id.' + name
+        return 'value.{}.value'.format(name)
 
-                if is_key_col:
-                     data_type = field.get('data_type', 'number')
-                     key_value = result['_id'][name]
-                     
-                     if data_type == 'date':
-                        key_value = datetime.strptime(key_value, '%Y/%m/%d')
-                     row[name] = key_value
-                else:                
-                    row[name] = self.helper.format(value[name], field)
+    def build_row(self, result, fields):
+        row = {}
+        value = result['value']
 
-            data.append(row)
+        for field in fields:
+            name = field['name']                
+            is_key_col = field.get('is_key_col', False)
 
-        for col in reversed(row_order):
-            data.sort(key=lambda item:item[col['name']], reverse=col.get('reverse', False))
-        
-        return {
-            'data':data, 
-            'description':description,
-            'columns_order': tuple(columns_order)
-        }
\ No newline at end of file
+            if is_key_col:
+                 data_type = field.get('data_type', 'number')
+                 key_value = result['_id'][name]
+                 
+                 if data_type == 'date':
+                    key_value = self.helper.parse_date(key_value)
+                 row[name] = key_value
+            else:                
+                row[name] = self.helper.format(value[name], field)
+        return row
+
+    def sort_rows(self, data, row_order):
+        if not row_order:
+            return
+
+        directions = set(col.get('reverse', False) for col in row_order)
+        if len(directions) == 1:
+            names = [col['name'] for col in row_order]
+            data.sort(key=lambda row: [row[name] for name in names], 
+                reverse=directions.pop())
+            return
+
+        def compare(a, b):
+            for col in row_order:
+                result = cmp(a[col['name']], b[col['name']])
+                if result != 0:
+                    return -result if col.get('reverse', False) else result
+            return 0
+
+        data.sort(cmp=compare)
@@ -0,0 +1,82 @@
+import copy
+import json
+from collections import OrderedDict
+from bson import json_util
+
+from dashgourd.charts.cohort_funnel import CohortFunnel
+
+class ChartFusion(object):
+
+    def __init__(self):
+        self.shared_options = ('query', 'group', 'backend', 'layout', 'buckets')
+        self.prefix_template = 'f{}__'
+
+    def plan(self, plugins, charts):
+        groups = OrderedDict()
+        for idx, (plugin, collection, options) in enumerate(charts):
+            key = self.fusion_key(plugins.get(plugin), plugin, options)
+            if key is None:
+                key = ('single', idx)
+            groups.setdefault(key, []).append(idx)
+        return groups.values()
+
+    def fusion_key(self, plugin, plugin_name, options):
+        if type(plugin) is not CohortFunnel:
+            return None
+
+        if (options.get('query') is None or
+            options.get('group') is None or
+            options.get('calc') is None):
+            return None
+
+        if (options.get('output', 'replace') != 'replace' or
+            options.get('incremental', False) or
+            options.get('debug', False) or
+            options.get('explain', False)):
+            return None
+
+        shared = dict((key, options.get(key)) for key in self.shared_options)
+        shared['plugin'] = plugin_name
+        return json.dumps(shared, sort_keys=True, default=json_util.default)
+
+    def fuse(self, plugin, charts):
+        calc = []
+        for idx, (plugin_name, collection, options) in enumerate(charts):
+            prefix = self.prefix_template.format(idx)
+            for data in plugin.validate_calc_config(copy.deepcopy(options['calc'])):
+                calc.append(self.namespace_calc(data, prefix))
+        return dict(charts[0][2], calc=calc)
+
+    def namespace_calc(self, data, prefix):
+        data['name'] = prefix + data['name']
+        if data['n'] != 'total':
+            data['n'] = prefix + data['n']
+        if data['cond']['type'] == 'if':
+            data['cond']['value'] = prefix + data['cond']['value']
+        return data
+
+    def split(self, results, count):
+        prefixes = [self.prefix_template.format(idx) for idx in range(count)]
+        charts = [[] for prefix in prefixes]
+
+        for result in results:
+            values = [{} for prefix in prefixes]
+            for name, value in result['value'].items():
+                if name == 'total':
+                    for chart_values in values:
+                        chart_values[name] = value
+                    continue
+
+                for idx, prefix in enumerate(prefixes):
+                    if name.startswith(prefix):
+                        values[idx][name[len(prefix):]] = value
+                        break
+
+                    pos = name.find('_' + prefix)
+                    if pos >= 0:
+                        values[idx][name[:pos + 1] + name[pos + 1 + len(prefix):]] = value
+                        break
+
+            for idx, chart_values in enumerate(values):
+                charts[idx].append({'_id': result['_id'], 'value': chart_values})
+        return charts
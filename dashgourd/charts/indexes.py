@@ -0,0 +1,153 @@
+import pymongo
+from bson.son import SON
+from pymongo.errors import OperationFailure
+
+class IndexAdvisor(object):
+
+    def __init__(self):
+        self.range_operators = ('$gt', '$gte', '$lt', '$lte', '$exists', '$regex')
+        self.unindexable_operators = ('$ne', '$nin', '$not', '$size', '$type', '$mod')
+
+    def chart_indexes(self, options):
+        query = options.get('query') or {}
+        group_fields = self.group_fields(options)
+        specs = []
+        for branch in self.query_branches(query):
+            equality, ranges, unindexed = self.query_fields(branch)
+            fields = sorted(set(equality))
+            fields.extend(sorted(set(ranges) - set(equality)))
+
+            watermark = options.get('watermark', 'updated_at')
+            if options.get('incremental', False) and watermark not in fields:
+                fields.append(watermark)
+            fields.extend(field for field in group_fields if field not in fields)
+
+            spec = [(field, pymongo.ASCENDING) for field in fields]
+            if spec and spec not in specs:
+                specs.append(spec)
+
+        if (options.get('layout', 'embedded') == 'embedded' and 
+                self.reads_actions(options)):
+            spec = [('actions.name', pymongo.ASCENDING)]
+            if spec not in specs:
+                specs.append(spec)
+        return specs
+
+    def group_fields(self, options):
+        fields = []
+        for data in options.get('group') or []:
+            group_type = data.get('type', 'user')
+            if group_type == 'user':
+                field = data['attr']
+            elif group_type == 'ab':
+                field = '.'.join(['ab', data['attr']])
+            else:
+                continue
+            if field not in fields:
+                fields.append(field)
+        return fields
+
+    def reads_actions(self, options):
+        return bool(options.get('calc') or options.get('action') or any(
+            data.get('type') == 'action' for data in options.get('group') or []))
+
+    def query_branches(self, query):
+        branches = [[]]
+        for key, value in query.items():
+            if key in ('$and', '$or'):
+                clauses = [self.query_branches(clause) for clause in value]
+                if key == '$and':
+                    for clause in clauses:
+                        branches = [branch + sub for branch in branches for sub in clause]
+                else:
+                    alternatives = [sub for clause in clauses for sub in clause]
+                    branches = [branch + sub for branch in branches for sub in alternatives]
+            else:
+                branches = [branch + [(key, value)] for branch in branches]
+        return branches
+
+    def query_fields(self, branch):
+        equality = []
+        ranges = []
+        unindexed = []
+
+        for key, value in branch:
+            if key.startswith('$'):
+                unindexed.append(key)
+            elif not self.is_operator(value):
+                equality.append(key)
+            elif '$elemMatch' in value:
+                for sub_key in value['$elemMatch']:
+                    if not sub_key.startswith('$'):
+                        equality.append('.'.join([key, sub_key]))
+            elif any(op in self.unindexable_operators for op in value):
+                unindexed.append(key)
+            elif any(op in self.range_operators for op in value):
+                if value.get('$exists', True) is False:
+                    unindexed.append(key)
+                else:
+                    ranges.append(key)
+            else:
+                equality.append(key)
+        return equality, ranges, unindexed
+
+    def is_operator(self, value):
+        return isinstance(value, dict) and any(
+            key.startswith('$') for key in value)
+
+    def query_problems(self, query):
+        problems = []
+        if not query:
+            problems.append('query has no filter')
+
+        for branch in self.query_branches(query or {}):
+            equality, ranges, unindexed = self.query_fields(branch)
+            if not equality and not ranges and unindexed:
+                problems.append('no indexable field in {}'.format(', '.join(unindexed)))
+        return problems
+
+
+# A cursor explain runs the query to completion, so execution stats are
+# opt-in and the default only asks the server for its query plan.
+def explain_query(db, query, collection='users', execution=False):
+    if execution:
+        explain = db[collection].find(query).explain()
+    else:
+        try:
+            explain = db.command(SON([
+                ('explain', SON([('find', collection), ('filter', query or {})])),
+                ('verbosity', 'queryPlanner')
+            ]))
+        except OperationFailure:
+            # Servers before 3.0 have no explain command; theirs always executes.
+            explain = db[collection].find(query).explain()
+
+    if 'queryPlanner' in explain:
+        index = find_plan_index(explain['queryPlanner'].get('winningPlan', {}))
+        stats = explain.get('executionStats', {})
+        examined = stats.get('totalDocsExamined')
+        returned = stats.get('nReturned')
+    else:
+        cursor = explain.get('cursor', '')
+        index = None
+        if cursor.startswith('BtreeCursor'):
+            index = cursor.split(' ', 1)[1]
+        examined = explain.get('nscannedObjects')
+        returned = explain.get('n')
+
+    return {'index': index, 'examined': examined, 'returned': returned}
+
+
+def find_plan_index(plan):
+    if plan.get('stage') == 'IXSCAN':
+        return plan.get('indexName')
+
+    children = plan.get('inputStages', [])
+    if 'inputStage' in plan:
+        children = [plan['inputStage']]
+
+    for child in children:
+        index = find_plan_index(child)
+        if index is not None:
+            return index
+    return None
@@ -0,0 +1,100 @@
+import time
+import pymongo
+from collections import OrderedDict
+from bson import json_util
+from dashgourd.api.helper import client_uri
+
+def partition_bounds(db, query, key, count):
+    total = db.users.find(query).count()
+    bounds = []
+    for i in range(1, count):
+        cursor = (db.users.find(query, {key: 1})
+            .sort(key, pymongo.ASCENDING)
+            .skip(total * i // count)
+            .limit(1))
+        for doc in cursor:
+            if doc.get(key) is not None and (not bounds or doc[key] > bounds[-1]):
+                bounds.append(doc[key])
+    return bounds
+
+
+def partition_queries(query, key, bounds):
+    queries = []
+    lower = None
+    for upper in bounds + [None]:
+        window = {}
+        if lower is not None:
+            window['$gte'] = lower
+        if upper is not None:
+            window['$lt'] = upper
+
+        if window:
+            queries.append({'$and': [query, {key: window}]})
+        else:
+            queries.append(query)
+        lower = upper
+
+    # Range windows never match a missing or null key, so those users get
+    # a partition of their own.
+    if bounds:
+        queries.append({'$and': [query, {key: None}]})
+    return queries
+
+
+def group_results(results):
+    groups = OrderedDict()
+    for doc in results:
+        key = json_util.dumps(doc['_id'])
+        if key not in groups:
+            groups[key] = (doc['_id'], [])
+        groups[key][1].append(doc['value'])
+    return groups.values()
+
+
+def replace_collection(db, collection, docs):
+    docs = list(docs)
+    if not docs:
+        db[collection].drop()
+        return 0
+
+    staging = '{}_staging'.format(collection)
+    db[staging].drop()
+    db[staging].insert(docs)
+    db[staging].rename(collection, dropTarget=True)
+    return len(docs)
+
+
+def connection_uri(db):
+    # Rebuilding the URI from host and port would lose credentials,
+    # authSource and replica set options, so reuse the one we connected with.
+    uri = client_uri(getattr(db, 'connection', None))
+    if uri is None:
+        raise ValueError('processes needs the mongodb_uri option unless the '
+            'database was opened from a URI')
+    return uri
+
+
+def map_shard(job):
+    uri, dbname, plugin_class, options, query = job
+    plugin = plugin_class()
+    plan = plugin.compiler.compile(plugin, dict(options, query=query))
+    spec = plugin.map_spec(options)
+
+    start = time.time()
+    counts = {'input': 0, 'emit': 0, 'reduce': 0}
+    client = pymongo.MongoClient(uri)
+    try:
+        groups = OrderedDict()
+        for user in client[dbname].users.find(query):
+            counts['input'] += 1
+            for key, value in plugin.map_user(plan, spec, user):
+                counts['emit'] += 1
+                group = json_util.dumps(key)
+                if group in groups:
+                    counts['reduce'] += 1
+                    value = plugin.reduce_values(plan, [groups[group][1], value])
+                groups[group] = (key, value)
+        stats = {'counts': counts, 'server_time': int((time.time() - start) * 1000)}
+        return groups.values(), stats
+    finally:
+        client.close()
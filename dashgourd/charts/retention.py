@@ -1,12 +1,14 @@
+import copy
 import math
 from datetime import datetime
 from bson.code import Code
 
+from dashgourd.charts.compiler import ChartPlan
 from dashgourd.charts.cohort_funnel import CohortFunnel
 
 class Retention(CohortFunnel):
-    def __init__(self):
-        super(Retention, self).__init__()
+    def __init__(self, compiler=None):
+        super(Retention, self).__init__(compiler)
         self.mapper_template = """
         function(){{
 
@@ -81,17 +83,19 @@ class Retention(CohortFunnel):
         }}
         """
 
-    def run(self, db, collection, options):
+    def compile(self, options):
 
-        debug = options.get('debug', False)
-        output = options.get('output', 'replace')
+        backend = options.get('backend', 'mapreduce')
+        layout = options.get('layout', 'embedded')
+        if layout == 'bucketed':
+            backend = 'pipeline'
     
         query = options.get('query')
         group = options.get('group')
         action = options.get('action')
     
         if query is None or group is None or action is None:
-            return False
+            return None
 
         group = self.validate_group_config(group)
         set_emit_keys = self.build_set_emit_keys(group)
@@ -112,11 +116,46 @@ class Retention(CohortFunnel):
         reducer = self.reducer_template
         finalizer = self.finalizer_template.format(out_emit_date_field)
 
-        if debug:
-            self.debug(mapper, reducer, finalizer)
-        else:
-            self.build_chart(db, output, collection, mapper, 
-                reducer, finalizer, query)
+        pipeline = None
+        if backend == 'pipeline':
+            source = self.build_pipeline_source(query, layout, options)
+            pipeline = self.build_pipeline(source, group, action)
+
+        return ChartPlan(
+            plugin=None,
+            backend=backend,
+            layout=layout,
+            query=query,
+            mapper=mapper,
+            reducer=reducer,
+            finalizer=finalizer,
+            pipeline=pipeline,
+            values=None,
+            finals=None,
+            date_field=out_emit_date_field,
+            config_hash=None,
+            options=None)
+
+    def map_spec(self, options):
+        group = self.validate_group_config(copy.deepcopy(options['group']))
+        interval = [data['format'] for data in group
+            if data['format'] == 'monthly' or data['format'] == 'weekly'][0]
+        return group, options['action'], interval
+
+    def map_user(self, plan, spec, user):
+        group, action, interval = spec
+        start = user.get(plan.date_field)
+        if not isinstance(start, datetime):
+            return []
+
+        start = self.map_period(start, interval)
+        values = {self.map_key(user[plan.date_field], interval): {'total': 1}}
+        for z in user.get('actions', []):
+            created_at = z.get('created_at')
+            if z.get('name') == action and isinstance(created_at, datetime):
+                if self.map_period(created_at, interval) >= start:
+                    values[self.map_key(created_at, interval)] = {'total': 1}
+        return [(self.map_keys(group, user), values)]
 
     def out_set_interval_code(self, group):
         interval_code = ''
@@ -137,4 +176,92 @@ class Retention(CohortFunnel):
     def out_emit_data_field(self, group):
         for data in group:
             if data['format'] == 'monthly' or data['format'] == 'weekly':
-                return data['attr']
\ No newline at end of file
+                return data['attr']
+
+    def build_pipeline(self, source, group, action):
+        keys = self.build_pipeline_keys(group)
+        date_field = self.out_emit_data_field(group)
+        start = '$_k.' + date_field
+
+        interval_format = None
+        for data in group:
+            if data['format'] == 'monthly' or data['format'] == 'weekly':
+                interval_format = data['format']
+                break
+
+        periods = {'$setUnion': [[start], {'$map': {
+            'input': '$actions',
+            'as': 'z',
+            'in': self.build_pipeline_key('$$z.created_at', interval_format)}}]}
+
+        start_total = {'$arrayElemAt': [{'$map': {
+            'input': {'$filter': {
+                'input': '$periods',
+                'as': 'p',
+                'cond': {'$eq': ['$$p.k', '$_id.' + date_field]}}},
+            'as': 'p',
+            'in': '$$p.total'}}, 0]}
+
+        return source + [
+            {'$project': {
+                '_k': keys,
+                'actions': {'$filter': {
+                    'input': {'$ifNull': ['$actions', []]},
+                    'as': 'z',
+                    'cond': self.build_pipeline_action_cond(action)}}
+            }},
+            {'$project': {
+                '_k': 1,
+                'periods': {'$filter': {
+                    'input': periods,
+                    'as': 'p',
+                    'cond': {'$gte': ['$$p', start]}}}
+            }},
+            {'$unwind': '$periods'},
+            {'$group': {
+                '_id': {'k': '$_k', 'p': '$periods'},
+                'total': {'$sum': 1}
+            }},
+            {'$group': {
+                '_id': '$_id.k',
+                'periods': {'$push': {'k': '$_id.p', 'total': '$total'}}
+            }},
+            {'$project': {'periods': 1, 'start': start_total}},
+            {'$project': {
+                '_id': 1,
+                'value': {'$arrayToObject': {'$map': {
+                    'input': '$periods',
+                    'as': 'p',
+                    'in': {'k': '$$p.k', 'v': {
+                        'total': '$$p.total',
+                        'pct': {
+                            'calc': {'$literal': 'pct'},
+                            'value': {'$divide': ['$$p.total', '$start']},
+                            'total': '$$p.total',
+                            'n': '$start'
+                        }
+                    }}
+                }}}
+            }}
+        ]
+
+    def reduce_values(self, plan, values):
+        result = {}
+        for value in values:
+            for date in value:
+                if date not in result:
+                    result[date] = {'total': 0}
+                result[date]['total'] += value[date]['total']
+        return result
+
+    def finalize_value(self, plan, key, value):
+        start = value.get(key[plan.date_field])
+        if start is not None and start['total'] > 0:
+            for date in value:
+                value[date]['pct'] = {
+                    'calc': 'pct',
+                    'value': value[date]['total'] / float(start['total']),
+                    'total': value[date]['total'],
+                    'n': start['total']
+                }
+        return value
@@ -0,0 +1,60 @@
+import argparse
+import os
+import sys
+from datetime import datetime
+
+from dashgourd.api.charts import ChartsApi
+from dashgourd.scheduler import ChartScheduler, load_manifest
+
+
+def print_statuses(statuses):
+    for status in statuses:
+        print '{} {:<8} {:<30} {}'.format(
+            datetime.utcnow().strftime('%Y-%m-%d %H:%M:%S'),
+            status['status'], status['collection'], status.get('reason', ''))
+        if status.get('error'):
+            print status['error']
+    sys.stdout.flush()
+
+
+def scheduler(args):
+    manifest = load_manifest(args.manifest)
+    charts_api = ChartsApi(args.mongo_uri, args.mongo_db)
+    chart_scheduler = ChartScheduler(charts_api, manifest, 
+        args.max_workers, args.interval)
+
+    if args.once:
+        statuses = chart_scheduler.run_once()
+        print_statuses(statuses)
+        if any(status['status'] != 'ok' for status in statuses):
+            sys.exit(1)
+    else:
+        chart_scheduler.run_forever(print_statuses)
+
+
+def main():
+    parser = argparse.ArgumentParser(prog='dashgourd')
+    commands = parser.add_subparsers()
+
+    command = commands.add_parser('scheduler', 
+        help='rebuild stale charts from a JSON manifest')
+    command.add_argument('manifest')
+    command.add_argument('--mongo-uri', default=os.environ.get('MONGO_URI'))
+    command.add_argument('--mongo-db', default=os.environ.get('MONGO_DB'))
+    command.add_argument('--max-workers', type=int)
+    command.add_argument('--interval', type=float, 
+        help='seconds between staleness checks')
+    command.add_argument('--once', action='store_true', 
+        help='run a single pass and exit')
+    command.set_defaults(func=scheduler)
+
+    args = parser.parse_args()
+    if not args.mongo_uri:
+        parser.error('set --mongo-uri or the MONGO_URI environment variable')
+    if not args.mongo_db:
+        parser.error('set --mongo-db or the MONGO_DB environment variable')
+    args.func(args)
+
+
+if __name__ == '__main__':
+    main()
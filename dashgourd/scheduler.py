@@ -0,0 +1,169 @@
+import time
+import logging
+from datetime import datetime, timedelta
+from bson import json_util
+
+log = logging.getLogger(__name__)
+log.addHandler(logging.NullHandler())
+
+
+def load_manifest(path):
+    with open(path) as manifest_file:
+        manifest = json_util.loads(manifest_file.read())
+
+    collections = set()
+    for chart in manifest['charts']:
+        if 'plugin' not in chart or 'collection' not in chart:
+            raise ValueError('manifest charts need a plugin and a collection')
+        if chart['collection'] in collections:
+            raise ValueError('duplicate chart collection {}'.format(chart['collection']))
+        collections.add(chart['collection'])
+
+    for chart in manifest['charts']:
+        for dependency in chart.get('depends_on', []):
+            if dependency not in collections:
+                raise ValueError('{} depends on unknown chart {}'.format(
+                    chart['collection'], dependency))
+
+    order_charts(manifest['charts'], collections)
+    return manifest
+
+
+def order_charts(charts, collections):
+    by_collection = dict((chart['collection'], chart) for chart in charts)
+    pending = {}
+    for collection in collections:
+        deps = by_collection[collection].get('depends_on', [])
+        pending[collection] = set(dep for dep in deps if dep in collections)
+
+    levels = []
+    while pending:
+        ready = [collection for collection, deps in pending.items() if not deps]
+        if not ready:
+            raise ValueError('chart dependencies form a cycle: {}'.format(
+                ', '.join(sorted(pending))))
+
+        ready.sort(key=lambda collection: (
+            -by_collection[collection].get('priority', 0), collection))
+        levels.append([by_collection[collection] for collection in ready])
+        for collection in ready:
+            del pending[collection]
+        for deps in pending.values():
+            deps.difference_update(ready)
+    return levels
+
+
+class ChartScheduler(object):
+
+    def __init__(self, charts_api, manifest, max_workers=None, interval=None,
+            builds='chart_builds'):
+        self.api = charts_api
+        self.db = charts_api.db
+        self.builds = builds
+        self.charts = manifest['charts']
+        self.max_workers = max_workers or manifest.get('max_workers', 4)
+        self.interval = interval or manifest.get('interval', 300)
+        self.fuse = manifest.get('fuse', False)
+
+    def import_state(self, sources=None):
+        query = {}
+        if sources is not None:
+            query['_id'] = {'$in': sources}
+        logs = self.db.import_logs.find(query).sort('_id')
+        return [{'name': log['_id'], 'last_update': log.get('last_update')}
+            for log in logs]
+
+    def build_log(self, collection):
+        return self.db[self.builds].find_one({'_id': collection}) or {}
+
+    def stale_reason(self, chart, log, imports, rebuilt):
+        built_at = log.get('built_at')
+        if built_at is None:
+            return 'never built'
+
+        for dependency in chart.get('depends_on', []):
+            if dependency in rebuilt:
+                return 'dependency {} is stale'.format(dependency)
+            dependency_built = self.build_log(dependency).get('built_at')
+            if dependency_built is not None and dependency_built > built_at:
+                return 'dependency {} was rebuilt'.format(dependency)
+
+        if log.get('sources') != imports:
+            return 'new imported data'
+
+        max_age = chart.get('max_age')
+        if max_age is not None and datetime.utcnow() - built_at > timedelta(seconds=max_age):
+            return 'older than max_age'
+        return None
+
+    def stale_charts(self):
+        collections = set(chart['collection'] for chart in self.charts)
+        stale = []
+        rebuilt = set()
+        for level in order_charts(self.charts, collections):
+            for chart in level:
+                imports = self.import_state(chart.get('sources'))
+                reason = self.stale_reason(
+                    chart, self.build_log(chart['collection']), imports, rebuilt)
+                if reason is not None:
+                    stale.append((chart, reason, imports))
+                    rebuilt.add(chart['collection'])
+        return stale
+
+    def run_once(self):
+        stale = self.stale_charts()
+        collections = set(chart['collection'] for chart, reason, imports in stale)
+        states = dict((chart['collection'], (reason, imports))
+            for chart, reason, imports in stale)
+
+        statuses = []
+        failed = set()
+        for level in order_charts([chart for chart, reason, imports in stale], collections):
+            runnable = []
+            for chart in level:
+                blocked = [dep for dep in chart.get('depends_on', []) if dep in failed]
+                if blocked:
+                    failed.add(chart['collection'])
+                    statuses.append({
+                        'plugin': chart['plugin'],
+                        'collection': chart['collection'],
+                        'status': 'skipped',
+                        'error': 'dependency {} failed'.format(blocked[0]),
+                        'reason': states[chart['collection']][0]
+                    })
+                else:
+                    runnable.append(chart)
+
+            results = self.api.generate_charts(
+                [(chart['plugin'], chart['collection'], chart.get('options', {}))
+                    for chart in runnable],
+                self.max_workers,
+                self.fuse)
+
+            for chart, status in zip(runnable, results):
+                reason, imports = states[chart['collection']]
+                status['reason'] = reason
+                if status['status'] == 'ok':
+                    self.mark_built(chart['collection'], imports)
+                else:
+                    failed.add(chart['collection'])
+                statuses.append(status)
+        return statuses
+
+    def mark_built(self, collection, imports):
+        self.db[self.builds].update(
+            {'_id': collection},
+            {'$set': {'built_at': datetime.utcnow(), 'sources': imports}},
+            True)
+
+    def run_forever(self, report=None):
+        while True:
+            start = time.time()
+            try:
+                statuses = self.run_once()
+                if report is not None:
+                    report(statuses)
+            except Exception:
+                # Keep scheduling; the next pass retries whatever is still stale.
+                log.exception('chart scheduler pass failed')
+            time.sleep(max(self.interval - (time.time() - start), 0))
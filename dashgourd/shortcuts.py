@@ -3,4 +3,8 @@ from dashgourd.api.charts import ChartsApi
 
 def gen_chart(chart_plugin, collection, options):    
     chart_api = ChartsApi(os.environ.get('MONGO_URI'), os.environ.get('MONGO_DB'))
-    chart_api.generate_chart(chart_plugin, collection, options)
\ No newline at end of file
+    chart_api.generate_chart(chart_plugin, collection, options)
+
+def gen_charts(charts, max_workers=4):
+    chart_api = ChartsApi(os.environ.get('MONGO_URI'), os.environ.get('MONGO_DB'))
+    return chart_api.generate_charts(charts, max_workers)
@@ -0,0 +1,557 @@
+import json
+import os
+from datetime import datetime, timedelta
+
+import numpy as np
+from bson.son import SON
+
+from dashgourd.charts.action_cohort import ActionCohort
+from dashgourd.charts.cohort_funnel import CohortFunnel
+from dashgourd.charts.retention import Retention
+
+EPOCH = datetime(1970, 1, 1)
+MISSING_TIME = np.iinfo(np.int64).min
+MS_PER_DAY = 86400000
+
+
+def to_ms(value):
+    delta = value.replace(tzinfo=None) - EPOCH
+    return (delta.days * MS_PER_DAY + delta.seconds * 1000 +
+        delta.microseconds // 1000)
+
+
+def from_ms(value):
+    return EPOCH + timedelta(milliseconds=int(value))
+
+
+def flatten(doc, skip=('actions',)):
+    for key, value in doc.items():
+        if key in skip:
+            continue
+        if type(value) is dict:
+            for sub_key, sub_value in value.items():
+                if type(sub_value) is not dict and type(sub_value) is not list:
+                    yield '.'.join([key, sub_key]), sub_value
+        elif type(value) is not list:
+            yield key, value
+
+
+class ColumnBuilder(object):
+
+    def __init__(self):
+        self.values = []
+
+    def set(self, row, value):
+        if len(self.values) < row:
+            self.values.extend([None] * (row - len(self.values)))
+        self.values.append(value)
+
+    def build(self, rows):
+        values = self.values + [None] * (rows - len(self.values))
+        present = [value for value in values if value is not None]
+
+        if present and all(isinstance(value, datetime) for value in present):
+            data = np.array([MISSING_TIME if value is None else to_ms(value)
+                for value in values], dtype=np.int64)
+            return 'time', data, None
+
+        if present and all(isinstance(value, (int, long, float)) for value in present):
+            data = np.array([np.nan if value is None else float(value)
+                for value in values], dtype=np.float64)
+            return 'number', data, None
+
+        dictionary = []
+        codes = {}
+        data = np.empty(rows, dtype=np.int32)
+        for idx, value in enumerate(values):
+            if value is None:
+                data[idx] = -1
+                continue
+            value = unicode(value)
+            if value not in codes:
+                codes[value] = len(dictionary)
+                dictionary.append(value)
+            data[idx] = codes[value]
+        return 'string', data, dictionary
+
+
+class ColumnSetBuilder(object):
+
+    def __init__(self):
+        self.columns = {}
+        self.rows = 0
+
+    def add(self, doc):
+        for key, value in flatten(doc):
+            if value is not None:
+                self.columns.setdefault(key, ColumnBuilder()).set(self.rows, value)
+        self.rows += 1
+
+    def save(self, path):
+        if not os.path.exists(path):
+            os.makedirs(path)
+
+        meta = {}
+        for idx, (name, builder) in enumerate(sorted(self.columns.items())):
+            kind, data, dictionary = builder.build(self.rows)
+            filename = 'col{}.npy'.format(idx)
+            np.save(os.path.join(path, filename), data)
+            meta[name] = {'kind': kind, 'file': filename, 'dictionary': dictionary}
+        return {'rows': self.rows, 'columns': meta}
+
+
+def export_snapshot(db, path, query=None):
+    users = ColumnSetBuilder()
+    actions = ColumnSetBuilder()
+    offsets = [0]
+
+    for user in db.users.find(query or {}):
+        users.add(user)
+        for action in user.get('actions', []):
+            actions.add(action)
+        offsets.append(actions.rows)
+
+    if not os.path.exists(path):
+        os.makedirs(path)
+    np.save(os.path.join(path, 'offsets.npy'), np.array(offsets, dtype=np.int64))
+
+    meta = {
+        'created_at': datetime.utcnow().isoformat(),
+        'users': users.save(os.path.join(path, 'users')),
+        'actions': actions.save(os.path.join(path, 'actions'))
+    }
+    with open(os.path.join(path, 'meta.json'), 'w') as meta_file:
+        json.dump(meta, meta_file)
+
+    return Snapshot(path)
+
+
+class Column(object):
+
+    def __init__(self, kind, data, dictionary=None):
+        self.kind = kind
+        self.data = data
+        self.dictionary = dictionary or []
+        self.codes = dict((value, idx) for idx, value in enumerate(self.dictionary))
+
+    def missing(self):
+        if self.kind == 'string':
+            return self.data < 0
+        elif self.kind == 'number':
+            return np.isnan(self.data)
+        else:
+            return self.data == MISSING_TIME
+
+    def encode(self, value):
+        if self.kind == 'string':
+            return self.codes.get(unicode(value), -2)
+        elif self.kind == 'time':
+            if isinstance(value, datetime):
+                return to_ms(value)
+            return None
+        else:
+            try:
+                return float(value)
+            except (TypeError, ValueError):
+                return None
+
+    def decode(self, raw):
+        if self.kind == 'string':
+            return self.dictionary[raw] if raw >= 0 else None
+        elif self.kind == 'time':
+            return from_ms(raw) if raw != MISSING_TIME else None
+        else:
+            return None if np.isnan(raw) else float(raw)
+
+    def numbers(self):
+        if self.kind == 'number':
+            return np.nan_to_num(self.data)
+        return np.zeros(len(self.data))
+
+    def equals(self, value):
+        if value is None:
+            return self.missing()
+        encoded = self.encode(value)
+        if encoded is None:
+            return np.zeros(len(self.data), dtype=bool)
+        return self.data == encoded
+
+    def isin(self, values):
+        mask = np.zeros(len(self.data), dtype=bool)
+        for value in values:
+            mask |= self.equals(value)
+        return mask
+
+    def compare(self, op, value):
+        present = ~self.missing()
+        if self.kind == 'string':
+            decoded = np.array(self.dictionary + [None], dtype=object)[self.data]
+            return present & op(decoded, unicode(value))
+
+        encoded = self.encode(value)
+        if encoded is None:
+            return np.zeros(len(self.data), dtype=bool)
+        return present & op(self.data, encoded)
+
+
+class Snapshot(object):
+
+    def __init__(self, path):
+        with open(os.path.join(path, 'meta.json')) as meta_file:
+            meta = json.load(meta_file)
+
+        self.path = path
+        self.size = meta['users']['rows']
+        self.users = self.load_columns(os.path.join(path, 'users'), meta['users'])
+        self.actions = self.load_columns(os.path.join(path, 'actions'), meta['actions'])
+        self.offsets = np.load(os.path.join(path, 'offsets.npy'), mmap_mode='r')
+        self.owners = np.repeat(np.arange(self.size), np.diff(self.offsets))
+
+    def load_columns(self, path, meta):
+        columns = {}
+        for name, info in meta['columns'].items():
+            data = np.load(os.path.join(path, info['file']), mmap_mode='r')
+            columns[name] = Column(info['kind'], data, info['dictionary'])
+        return columns
+
+    def user_column(self, name):
+        return self.users.get(name)
+
+    def action_column(self, name):
+        return self.actions.get(name)
+
+
+class SnapshotEngine(object):
+
+    def __init__(self, snapshot):
+        self.snapshot = snapshot
+        self.plugins = {
+            'cohort_funnel': CohortFunnel(),
+            'action_cohort': ActionCohort(),
+            'retention': Retention()
+        }
+        self.operators = {
+            '$gt': np.greater,
+            '$gte': np.greater_equal,
+            '$lt': np.less,
+            '$lte': np.less_equal
+        }
+        self.conditions = {
+            'at_least': np.greater_equal,
+            'at_most': np.less_equal,
+            'exactly': np.equal
+        }
+
+    def run(self, plugin, options):
+        if plugin == 'cohort_funnel':
+            return self.run_funnel(options)
+        elif plugin == 'action_cohort':
+            return self.run_action_cohort(options)
+        elif plugin == 'retention':
+            return self.run_retention(options)
+        raise ValueError('unknown chart plugin {}'.format(plugin))
+
+    def match(self, query):
+        size = self.snapshot.size
+        mask = np.ones(size, dtype=bool)
+        for key, value in query.items():
+            if key == '$and':
+                for clause in value:
+                    mask &= self.match(clause)
+            elif key == '$or':
+                branches = np.zeros(size, dtype=bool)
+                for clause in value:
+                    branches |= self.match(clause)
+                mask &= branches
+            elif key.startswith('$'):
+                raise ValueError('unsupported query operator {}'.format(key))
+            else:
+                mask &= self.match_field(key, value)
+        return mask
+
+    def match_field(self, key, value):
+        size = self.snapshot.size
+        column = self.snapshot.user_column(key)
+        if column is None:
+            column = Column('string', np.full(size, -1, dtype=np.int32))
+
+        if type(value) is not dict:
+            return column.equals(value)
+
+        mask = np.ones(size, dtype=bool)
+        for op, operand in value.items():
+            if op == '$eq':
+                mask &= column.equals(operand)
+            elif op == '$ne':
+                mask &= ~column.equals(operand)
+            elif op == '$in':
+                mask &= column.isin(operand)
+            elif op == '$nin':
+                mask &= ~column.isin(operand)
+            elif op == '$exists':
+                mask &= column.missing() != bool(operand)
+            elif op in self.operators:
+                mask &= column.compare(self.operators[op], operand)
+            else:
+                raise ValueError('unsupported query operator {}'.format(op))
+        return mask
+
+    def key_codes(self, column, format, size, ab=False):
+        if column is None:
+            return np.zeros(size, dtype=np.int64), [None]
+
+        missing = column.missing()
+        raw = np.asarray(column.data)
+        if column.kind == 'time' and format in ('monthly', 'weekly'):
+            raw = self.periods(raw, format)
+
+        uniq, inverse = np.unique(raw[~missing], return_inverse=True)
+        codes = np.full(size, len(uniq), dtype=np.int64)
+        codes[~missing] = inverse
+
+        labels = [self.key_label(column, value, format, ab) for value in uniq]
+        labels.append('variation_NaN' if ab else None)
+        return self.dedupe(codes, labels)
+
+    def key_label(self, column, raw, format, ab):
+        if column.kind == 'time' and format in ('monthly', 'weekly'):
+            return self.period_label(raw, format)
+
+        value = column.decode(raw)
+        if ab:
+            return self.plugins['cohort_funnel'].map_variation(value)
+        return value
+
+    def dedupe(self, codes, labels):
+        unique_labels = []
+        positions = {}
+        remap = np.empty(len(labels), dtype=np.int64)
+        for idx, label in enumerate(labels):
+            if label not in positions:
+                positions[label] = len(unique_labels)
+                unique_labels.append(label)
+            remap[idx] = positions[label]
+        return remap[codes], unique_labels
+
+    def periods(self, ms, format):
+        days = np.floor_divide(ms, MS_PER_DAY)
+        if format == 'monthly':
+            return days.astype('datetime64[D]').astype('datetime64[M]').astype(np.int64)
+        return days - (days + 4) % 7
+
+    def period_label(self, period, format):
+        if format == 'monthly':
+            date = np.datetime64(int(period), 'M').astype(object)
+            return date.strftime('%Y/%m/01')
+        date = np.datetime64(int(period), 'D').astype(object)
+        return date.strftime('%Y/%m/%d')
+
+    def group_keys(self, group, size):
+        keys = []
+        for data in group:
+            if data['type'] == 'user':
+                column = self.snapshot.user_column(data['attr'])
+                keys.append((data['attr'],) + self.key_codes(column, data['format'], size))
+            elif data['type'] == 'ab':
+                column = self.snapshot.user_column('ab.' + data['attr'])
+                keys.append((data['attr'],) + self.key_codes(column, 'value', size, True))
+        return keys
+
+    def combine_keys(self, keys, mask):
+        combined = np.zeros(int(mask.sum()), dtype=np.int64)
+        for name, codes, labels in keys:
+            combined = combined * len(labels) + codes[mask]
+        uniq, inverse = np.unique(combined, return_inverse=True)
+
+        ids = []
+        for value in uniq:
+            parts = []
+            for name, codes, labels in reversed(keys):
+                value, code = divmod(int(value), len(labels))
+                parts.append((name, labels[code]))
+            ids.append(SON(reversed(parts)))
+        return inverse, ids
+
+    def action_mask(self, attrs):
+        if type(attrs) is not list:
+            attrs = [attrs]
+        names = self.snapshot.action_column('name')
+        if names is None:
+            return np.zeros(len(self.snapshot.owners), dtype=bool)
+        return names.isin(attrs)
+
+    def action_weights(self, data, match_value=True):
+        mask = self.action_mask(data['attr'])
+        weights = np.ones(len(mask))
+        if 'meta' in data:
+            meta = self.snapshot.action_column(data['meta'])
+            if meta is None:
+                return np.zeros(len(mask))
+            if match_value and 'value' in data:
+                mask &= meta.equals(data['value'])
+            else:
+                weights = meta.numbers()
+        return np.where(mask, weights, 0)
+
+    def adjust_values(self, values, calc, conditional=True):
+        for data in calc:
+            name = data['name']
+            if data['calc'] == 'pct' and data['cond']['type'] != 'sum':
+                op = self.conditions[data['cond']['type']]
+                values[name] = op(values[name], data['cond']['value']).astype(np.float64)
+            elif conditional and data['cond']['type'] == 'if':
+                other = values[data['cond']['value']]
+                values[name] = np.where((values[name] > 0) & (other > 0), values[name], 0)
+
+    def build_docs(self, plugin, plan, ids, totals, sums):
+        docs = []
+        for idx, key in enumerate(ids):
+            value = {'total': {'value': float(totals[idx]), 'calc': 'sum'}}
+            for name in plan.values:
+                value[name] = {'value': float(sums[name][idx]), 'calc': 'sum'}
+            docs.append({'_id': key, 'value': plugin.finalize_value(plan, key, value)})
+        return docs
+
+    def run_funnel(self, options):
+        plugin = self.plugins['cohort_funnel']
+        plan = plugin.compiler.compile(plugin, options)
+        if plan is None:
+            return None
+
+        snapshot = self.snapshot
+        size = snapshot.size
+        group, calc = plugin.map_spec(options)
+
+        values = dict((name, np.zeros(size)) for name in plan.values)
+        for data in calc:
+            if 'range_of' in data:
+                continue
+            if data['type'] == 'user' and 'value' in data:
+                column = snapshot.user_column(data['attr'])
+                if column is not None:
+                    values[data['name']] = column.equals(data['value']).astype(np.float64)
+            elif data['type'] == 'action':
+                values[data['name']] = np.bincount(snapshot.owners,
+                    weights=self.action_weights(data), minlength=size)
+
+        matched = np.zeros(size, dtype=bool)
+        for data in calc:
+            if 'range_of' in data:
+                source = values[data['range_of']]
+                value = data['range']
+                if type(value) is int:
+                    cond = source == value
+                elif len(value) == 2 and value[1] is None:
+                    cond = source >= value[0]
+                else:
+                    cond = (source >= value[0]) & (source <= value[1])
+                values[data['name']] = (cond & ~matched).astype(np.float64)
+                matched |= cond
+
+        self.adjust_values(values, calc)
+
+        mask = self.match(plan.query)
+        inverse, ids = self.combine_keys(self.group_keys(group, size), mask)
+        totals = np.bincount(inverse, minlength=len(ids))
+        sums = dict((name, np.bincount(inverse, weights=values[name][mask],
+            minlength=len(ids))) for name in plan.values)
+        return self.build_docs(plugin, plan, ids, totals, sums)
+
+    def run_action_cohort(self, options):
+        plugin = self.plugins['action_cohort']
+        plan = plugin.compiler.compile(plugin, options)
+        if plan is None:
+            return None
+
+        snapshot = self.snapshot
+        size = snapshot.size
+        group, calc, pivot, event, actions = plugin.map_spec(options)
+        pivot = snapshot.action_column(pivot)
+
+        relevant = self.action_mask(list(actions))
+        relevant &= self.match(plan.query)[snapshot.owners]
+
+        pivot_codes, pivot_labels = self.key_codes(pivot, 'value', len(relevant))
+        pair_keys = snapshot.owners * len(pivot_labels) + pivot_codes
+        pairs, pair_index = np.unique(pair_keys[relevant], return_inverse=True)
+        pair_owner = pairs // len(pivot_labels)
+        rows = np.nonzero(relevant)[0]
+
+        is_event = self.action_mask(event['attr'])[rows]
+        totals = (np.bincount(pair_index, weights=is_event, minlength=len(pairs)) > 0)
+
+        last_event = np.full(len(pairs), -1, dtype=np.int64)
+        np.maximum.at(last_event, pair_index[is_event], rows[is_event])
+        meta_codes, meta_labels = self.key_codes(
+            snapshot.action_column(event['meta']), event['format'], len(relevant))
+        pair_meta = np.where(last_event >= 0,
+            meta_codes[np.maximum(last_event, 0)], len(meta_labels))
+        meta_labels = meta_labels + [None]
+
+        values = dict((name, np.zeros(len(pairs))) for name in plan.values)
+        values['total'] = totals.astype(np.float64)
+        for data in calc:
+            if data['type'] == 'action' and 'range_of' not in data:
+                weights = self.action_weights(data, False)
+                values[data['name']] = np.bincount(pair_index,
+                    weights=weights[rows], minlength=len(pairs))
+        self.adjust_values(values, calc, False)
+
+        keys = [(name, codes[pair_owner], labels)
+            for name, codes, labels in self.group_keys(group, size)]
+        keys.append((event['meta'], pair_meta, meta_labels))
+        inverse, ids = self.combine_keys(keys, np.ones(len(pairs), dtype=bool))
+        group_totals = np.bincount(inverse, weights=values['total'], minlength=len(ids))
+        sums = dict((name, np.bincount(inverse, weights=values[name],
+            minlength=len(ids))) for name in plan.values)
+        return self.build_docs(plugin, plan, ids, group_totals, sums)
+
+    def run_retention(self, options):
+        plugin = self.plugins['retention']
+        plan = plugin.compiler.compile(plugin, options)
+        if plan is None:
+            return None
+
+        snapshot = self.snapshot
+        size = snapshot.size
+        group, action, interval = plugin.map_spec(options)
+
+        start_column = snapshot.user_column(plan.date_field)
+        if start_column is None or start_column.kind != 'time':
+            return []
+
+        mask = self.match(plan.query)
+        starts = self.periods(np.asarray(start_column.data), interval)
+        mask &= ~start_column.missing()
+
+        created = snapshot.action_column('created_at')
+        if created is None:
+            created = Column('time', np.full(len(snapshot.owners), MISSING_TIME,
+                dtype=np.int64))
+        kept = self.action_mask(action) & ~created.missing()
+        action_periods = self.periods(np.asarray(created.data), interval)
+        kept &= mask[snapshot.owners]
+        kept &= action_periods >= starts[snapshot.owners]
+
+        owners = np.concatenate([np.nonzero(mask)[0], snapshot.owners[kept]])
+        periods = np.concatenate([starts[mask], action_periods[kept]])
+        offset = periods.min() if len(periods) else 0
+        span = int(periods.max() - offset + 1) if len(periods) else 1
+        user_periods = np.unique(owners * span + (periods - offset))
+
+        inverse, ids = self.combine_keys(self.group_keys(group, size), mask)
+        group_of = np.full(size, -1, dtype=np.int64)
+        group_of[mask] = inverse
+
+        cells, counts = np.unique(
+            group_of[user_periods // span] * span + user_periods % span,
+            return_counts=True)
+
+        values = [{} for key in ids]
+        for cell, count in zip(cells, counts):
+            gid, period = divmod(int(cell), span)
+            label = self.period_label(period + offset, interval)
+            values[gid][label] = {'total': float(count)}
+
+        return [{'_id': key, 'value': plugin.finalize_value(plan, key, value)}
+            for key, value in zip(ids, values)]
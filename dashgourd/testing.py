@@ -0,0 +1,976 @@
+import re
+import time
+from collections import OrderedDict
+from datetime import datetime, timedelta
+
+import pymongo
+from bson import json_util
+from bson.objectid import ObjectId
+from bson.son import SON
+from pymongo.errors import BulkWriteError, DuplicateKeyError, OperationFailure
+
+from dashgourd.charts.compiler import default_compiler
+
+MISSING = object()
+
+
+def clone(value, as_class=None):
+    if isinstance(value, datetime) and value.tzinfo is not None:
+        return (value - value.utcoffset()).replace(tzinfo=None)
+    elif isinstance(value, dict):
+        copied = (as_class or type(value))()
+        for key, item in value.items():
+            copied[key] = clone(item, as_class)
+        return copied
+    elif type(value) is list:
+        return [clone(item, as_class) for item in value]
+    return value
+
+
+def id_key(value):
+    if isinstance(value, (dict, list)):
+        return json_util.dumps(value)
+    return value
+
+
+def comparable(value, other):
+    numbers = (int, long, float)
+    strings = (str, unicode)
+    return ((isinstance(value, numbers) and isinstance(other, numbers)) or
+        (isinstance(value, strings) and isinstance(other, strings)) or
+        (isinstance(value, datetime) and isinstance(other, datetime)))
+
+
+def resolve(doc, path):
+    values = [doc]
+    for part in path.split('.'):
+        found = []
+        for value in values:
+            if isinstance(value, dict):
+                if part in value:
+                    found.append(value[part])
+            elif type(value) is list:
+                if part.isdigit() and int(part) < len(value):
+                    found.append(value[int(part)])
+                for item in value:
+                    if isinstance(item, dict) and part in item:
+                        found.append(item[part])
+        values = found
+    return values
+
+
+def expand(values):
+    expanded = []
+    for value in values:
+        expanded.append(value)
+        if type(value) is list:
+            expanded.extend(value)
+    return expanded
+
+
+def match(doc, spec):
+    for key, condition in spec.items():
+        if key == '$and':
+            if not all(match(doc, clause) for clause in condition):
+                return False
+        elif key == '$or':
+            if not any(match(doc, clause) for clause in condition):
+                return False
+        elif key == '$nor':
+            if any(match(doc, clause) for clause in condition):
+                return False
+        elif not match_field(resolve(doc, key), condition):
+            return False
+    return True
+
+
+def is_operator(condition):
+    return (isinstance(condition, dict) and len(condition) > 0 and
+        all(key.startswith('$') for key in condition))
+
+
+def match_field(values, condition):
+    if not is_operator(condition):
+        if condition is None:
+            return not values or None in expand(values)
+        return condition in expand(values)
+
+    for op, operand in condition.items():
+        if not match_operator(values, op, operand):
+            return False
+    return True
+
+
+def match_operator(values, op, operand):
+    candidates = expand(values)
+    if op == '$eq':
+        return match_field(values, operand)
+    elif op == '$ne':
+        return not match_field(values, operand)
+    elif op == '$in':
+        return any(match_field(values, item) for item in operand)
+    elif op == '$nin':
+        return not any(match_field(values, item) for item in operand)
+    elif op == '$exists':
+        return bool(values) == bool(operand)
+    elif op == '$not':
+        return not match_field(values, operand)
+    elif op == '$size':
+        return any(type(value) is list and len(value) == operand for value in values)
+    elif op == '$regex':
+        return any(isinstance(value, basestring) and re.search(operand, value)
+            for value in candidates)
+    elif op == '$elemMatch':
+        for value in values:
+            if type(value) is not list:
+                continue
+            for item in value:
+                if is_operator(operand):
+                    if match_field([item], operand):
+                        return True
+                elif isinstance(item, dict) and match(item, operand):
+                    return True
+        return False
+    elif op in ('$gt', '$gte', '$lt', '$lte'):
+        compare = {
+            '$gt': lambda a, b: a > b,
+            '$gte': lambda a, b: a >= b,
+            '$lt': lambda a, b: a < b,
+            '$lte': lambda a, b: a <= b
+        }[op]
+        return any(comparable(value, operand) and compare(value, operand)
+            for value in candidates)
+    raise OperationFailure('unsupported query operator {}'.format(op))
+
+
+def set_path(doc, path, value):
+    parts = path.split('.')
+    for part in parts[:-1]:
+        doc = doc.setdefault(part, {})
+    doc[parts[-1]] = value
+
+
+def get_path(doc, path, default=None):
+    for part in path.split('.'):
+        if not isinstance(doc, dict) or part not in doc:
+            return default
+        doc = doc[part]
+    return doc
+
+
+def unset_path(doc, path):
+    parts = path.split('.')
+    parent = get_path(doc, '.'.join(parts[:-1])) if len(parts) > 1 else doc
+    if isinstance(parent, dict):
+        parent.pop(parts[-1], None)
+
+
+def apply_update(doc, document, inserted=False):
+    if not any(key.startswith('$') for key in document):
+        replaced = clone(document)
+        replaced['_id'] = doc['_id']
+        doc.clear()
+        doc.update(replaced)
+        return
+
+    for op, fields in document.items():
+        for path, value in fields.items():
+            if op == '$set' or (op == '$setOnInsert' and inserted):
+                set_path(doc, path, clone(value))
+            elif op == '$unset':
+                unset_path(doc, path)
+            elif op == '$inc':
+                set_path(doc, path, get_path(doc, path, 0) + value)
+            elif op in ('$push', '$addToSet'):
+                items = value['$each'] if is_operator(value) else [value]
+                current = get_path(doc, path)
+                if current is None:
+                    current = []
+                    set_path(doc, path, current)
+                for item in items:
+                    if op == '$push' or item not in current:
+                        current.append(clone(item))
+            elif op == '$pullAll':
+                current = get_path(doc, path)
+                if current is not None:
+                    current[:] = [item for item in current if item not in value]
+            elif op != '$setOnInsert':
+                raise OperationFailure('unsupported update operator {}'.format(op))
+
+
+def upsert_base(spec):
+    doc = {}
+    for key, value in spec.items():
+        if not key.startswith('$') and not is_operator(value):
+            set_path(doc, key, clone(value))
+    return doc
+
+
+def sort_docs(docs, keys):
+    for key, direction in reversed(keys):
+        docs.sort(key=lambda doc: get_path(doc, key),
+            reverse=direction == pymongo.DESCENDING)
+    return docs
+
+
+def project(doc, fields, as_class=dict):
+    if fields is None:
+        return clone(doc, as_class)
+    if type(fields) is list:
+        fields = dict((field, 1) for field in fields)
+
+    include = [key for key, value in fields.items() if value and key != '_id']
+    if include:
+        projected = as_class()
+        for key in include + ['_id']:
+            value = get_path(doc, key)
+            if value is not None and (key != '_id' or fields.get('_id', 1)):
+                set_path(projected, key, clone(value, as_class))
+        return projected
+
+    projected = clone(doc, as_class)
+    for key, value in fields.items():
+        if not value:
+            unset_path(projected, key)
+    return projected
+
+
+def value_of(value):
+    return None if value is MISSING else value
+
+
+def is_number(value):
+    return isinstance(value, (int, long, float)) and not isinstance(value, bool)
+
+
+def sort_value(value):
+    value = value_of(value)
+    if value is None:
+        return (1, None)
+    elif isinstance(value, bool):
+        return (8, value)
+    elif is_number(value):
+        return (2, value)
+    elif isinstance(value, basestring):
+        return (3, value)
+    elif isinstance(value, dict):
+        return (4, [(key, sort_value(item)) for key, item in value.items()])
+    elif type(value) is list:
+        return (5, [sort_value(item) for item in value])
+    elif isinstance(value, ObjectId):
+        return (7, value)
+    elif isinstance(value, datetime):
+        return (9, value)
+    return (10, value)
+
+
+def truthy(value):
+    value = value_of(value)
+    return not (value is None or value is False or (is_number(value) and value == 0))
+
+
+def field_path(value, parts):
+    for idx, part in enumerate(parts):
+        if type(value) is list:
+            found = [field_path(item, parts[idx:]) for item in value]
+            return [item for item in found if item is not MISSING]
+        elif not isinstance(value, dict) or part not in value:
+            return MISSING
+        value = value[part]
+    return value
+
+
+def is_expression(expr):
+    return isinstance(expr, dict) and len(expr) == 1 and expr.keys()[0].startswith('$')
+
+
+def evaluate(expr, doc, variables=None):
+    variables = variables or {}
+    if isinstance(expr, basestring) and expr.startswith('$$'):
+        parts = expr[2:].split('.')
+        if parts[0] in ('ROOT', 'CURRENT'):
+            value = doc
+        elif parts[0] in variables:
+            value = variables[parts[0]]
+        else:
+            raise OperationFailure('undefined variable {}'.format(parts[0]))
+        return field_path(value, parts[1:])
+    elif isinstance(expr, basestring) and expr.startswith('$'):
+        return field_path(doc, expr[1:].split('.'))
+    elif type(expr) is list:
+        return [value_of(evaluate(item, doc, variables)) for item in expr]
+    elif is_expression(expr):
+        op, operand = expr.items()[0]
+        return evaluate_operator(op, operand, doc, variables)
+    elif isinstance(expr, dict):
+        result = SON()
+        for key, item in expr.items():
+            value = evaluate(item, doc, variables)
+            if value is not MISSING:
+                result[key] = value
+        return result
+    return expr
+
+
+def evaluate_operator(op, operand, doc, variables):
+    if op == '$literal':
+        return operand
+    elif op == '$cond':
+        if isinstance(operand, dict):
+            operand = [operand['if'], operand['then'], operand['else']]
+        if truthy(evaluate(operand[0], doc, variables)):
+            return evaluate(operand[1], doc, variables)
+        return evaluate(operand[2], doc, variables)
+    elif op in ('$filter', '$map'):
+        items = value_of(evaluate(operand['input'], doc, variables))
+        if items is None:
+            return None
+        name = operand.get('as', 'this')
+        if op == '$filter':
+            return [item for item in items if truthy(evaluate(
+                operand['cond'], doc, dict(variables, **{name: item})))]
+        return [value_of(evaluate(operand['in'], doc, dict(variables, **{name: item})))
+            for item in items]
+    elif op == '$reduce':
+        items = value_of(evaluate(operand['input'], doc, variables))
+        if items is None:
+            return None
+        value = value_of(evaluate(operand['initialValue'], doc, variables))
+        for item in items:
+            value = value_of(evaluate(operand['in'], doc,
+                dict(variables, value=value, this=item)))
+        return value
+    elif op == '$dateToString':
+        date = value_of(evaluate(operand['date'], doc, variables))
+        return None if date is None else date.strftime(operand['format'])
+
+    args = operand if type(operand) is list else [operand]
+    values = [value_of(evaluate(arg, doc, variables)) for arg in args]
+    if op == '$and':
+        return all(truthy(value) for value in values)
+    elif op == '$or':
+        return any(truthy(value) for value in values)
+    elif op == '$not':
+        return not truthy(values[0])
+    elif op in ('$eq', '$ne', '$gt', '$gte', '$lt', '$lte'):
+        left, right = sort_value(values[0]), sort_value(values[1])
+        return {
+            '$eq': left == right,
+            '$ne': left != right,
+            '$gt': left > right,
+            '$gte': left >= right,
+            '$lt': left < right,
+            '$lte': left <= right
+        }[op]
+    elif op == '$ifNull':
+        return values[1] if values[0] is None else values[0]
+    elif op == '$size':
+        if type(values[0]) is not list:
+            raise OperationFailure('$size needs an array')
+        return len(values[0])
+    elif op == '$concatArrays':
+        if None in values:
+            return None
+        return [item for value in values for item in value]
+    elif op == '$setUnion':
+        union = []
+        for value in values:
+            for item in value or []:
+                if sort_value(item) not in [sort_value(seen) for seen in union]:
+                    union.append(item)
+        return union
+    elif op == '$arrayElemAt':
+        items, idx = values
+        if items is None:
+            return None
+        return items[idx] if -len(items) <= idx < len(items) else MISSING
+    elif op == '$arrayToObject':
+        result = SON()
+        for item in values[0] or []:
+            if isinstance(item, dict):
+                result[item['k']] = item['v']
+            else:
+                result[item[0]] = item[1]
+        return result
+    elif op == '$concat':
+        if None in values:
+            return None
+        return ''.join(values)
+    elif op == '$substr':
+        value, start, length = values
+        value = '' if value is None else value if isinstance(value, basestring) else str(value)
+        return value[start:] if length < 0 else value[start:start + length]
+    elif op == '$dayOfWeek':
+        return None if values[0] is None else values[0].isoweekday() % 7 + 1
+    elif op in ('$add', '$subtract', '$multiply', '$divide'):
+        if None in values:
+            return None
+        return arithmetic(op, values)
+    elif op in ('$sum', '$max', '$min'):
+        if len(values) == 1 and type(values[0]) is list:
+            values = values[0]
+        return accumulate(op, values)
+    raise OperationFailure('unsupported expression operator {}'.format(op))
+
+
+def arithmetic(op, values):
+    if op == '$add':
+        dates = [value for value in values if isinstance(value, datetime)]
+        total = sum(value for value in values if not isinstance(value, datetime))
+        return dates[0] + timedelta(milliseconds=total) if dates else total
+    elif op == '$subtract':
+        left, right = values
+        if isinstance(left, datetime) and isinstance(right, datetime):
+            delta = left - right
+            return (delta.days * 86400 + delta.seconds) * 1000 + delta.microseconds // 1000
+        elif isinstance(left, datetime):
+            return left - timedelta(milliseconds=right)
+        return left - right
+    elif op == '$multiply':
+        return reduce(lambda a, b: a * b, values, 1)
+    if values[1] == 0:
+        raise OperationFailure('can\'t $divide by zero')
+    return values[0] / float(values[1])
+
+
+def accumulate(op, values):
+    values = [value_of(value) for value in values if value is not MISSING]
+    if op == '$sum':
+        return sum(value for value in values if is_number(value))
+    elif op == '$avg':
+        numbers = [value for value in values if is_number(value)]
+        return sum(numbers) / float(len(numbers)) if numbers else None
+    elif op in ('$max', '$min'):
+        present = [value for value in values if value is not None]
+        if not present:
+            return None
+        pick = max if op == '$max' else min
+        return pick(present, key=sort_value)
+    elif op == '$first':
+        return values[0] if values else None
+    elif op == '$last':
+        return values[-1] if values else None
+    elif op == '$push':
+        return values
+    elif op == '$addToSet':
+        unique = []
+        for value in values:
+            if sort_value(value) not in [sort_value(seen) for seen in unique]:
+                unique.append(value)
+        return unique
+    raise OperationFailure('unsupported accumulator {}'.format(op))
+
+
+def project_field(doc, key, spec, root):
+    if isinstance(spec, (int, long)) and spec in (0, 1):
+        if spec and isinstance(doc, dict) and key in doc:
+            return doc[key]
+        return MISSING
+    elif isinstance(spec, dict) and not is_expression(spec):
+        current = doc.get(key) if isinstance(doc, dict) else None
+        nested = SON()
+        for name, item in spec.items():
+            value = project_field(current, name, item, root)
+            if value is not MISSING:
+                nested[name] = value
+        return nested
+    return evaluate(spec, root)
+
+
+def project_stage(doc, spec):
+    result = SON()
+    if '_id' not in spec and '_id' in doc:
+        result['_id'] = doc['_id']
+    for key, item in spec.items():
+        value = project_field(doc, key, item, doc)
+        if value is not MISSING:
+            result[key] = value
+    return result
+
+
+def unwind_stage(docs, spec):
+    if isinstance(spec, dict):
+        path, preserve = spec['path'], spec.get('preserveNullAndEmptyArrays', False)
+    else:
+        path, preserve = spec, False
+
+    path = path[1:]
+    for doc in docs:
+        values = value_of(get_path(doc, path, MISSING))
+        if type(values) is not list:
+            if values is not None or preserve:
+                yield doc
+            continue
+        if not values and preserve:
+            unwound = clone(doc)
+            unset_path(unwound, path)
+            yield unwound
+        for value in values:
+            unwound = clone(doc)
+            set_path(unwound, path, value)
+            yield unwound
+
+
+def group_stage(docs, spec):
+    groups = OrderedDict()
+    for doc in docs:
+        key = value_of(evaluate(spec['_id'], doc))
+        group = json_util.dumps(key)
+        if group not in groups:
+            groups[group] = (key, [])
+        groups[group][1].append(doc)
+
+    for key, members in groups.values():
+        result = SON([('_id', key)])
+        for name, accumulator in spec.items():
+            if name != '_id':
+                op, expr = accumulator.items()[0]
+                result[name] = accumulate(op, [evaluate(expr, doc) for doc in members])
+        yield result
+
+
+def lookup_stage(database, docs, spec):
+    foreign = database[spec['from']].docs.values()
+    for doc in docs:
+        local = value_of(get_path(doc, spec['localField']))
+        local = expand([local])
+        joined = doc.copy()
+        joined[spec['as']] = [clone(other) for other in foreign
+            if any(value in local for value in expand(resolve(other, spec['foreignField'])))]
+        yield joined
+
+
+def aggregate_docs(database, docs, pipeline):
+    for stage in pipeline:
+        name, spec = stage.items()[0]
+        if name == '$match':
+            spec = clone(spec)
+            docs = [doc for doc in docs if match(doc, spec)]
+        elif name == '$project':
+            docs = [project_stage(doc, spec) for doc in docs]
+        elif name == '$addFields':
+            docs = [project_stage(doc, dict(
+                [(key, 1) for key in doc if key not in spec] + spec.items()))
+                for doc in docs]
+        elif name == '$unwind':
+            docs = list(unwind_stage(docs, spec))
+        elif name == '$group':
+            docs = list(group_stage(docs, spec))
+        elif name == '$sort':
+            docs = sort_docs_by_value(docs, spec.items())
+        elif name == '$skip':
+            docs = docs[spec:]
+        elif name == '$limit':
+            docs = docs[:spec]
+        elif name == '$lookup':
+            docs = list(lookup_stage(database, docs, spec))
+        elif name == '$out':
+            database[spec].replace_docs(docs)
+            docs = []
+        else:
+            raise OperationFailure('unsupported pipeline stage {}'.format(name))
+    return docs
+
+
+def sort_docs_by_value(docs, keys):
+    for key, direction in reversed(keys):
+        docs.sort(key=lambda doc: sort_value(get_path(doc, key)),
+            reverse=direction == pymongo.DESCENDING)
+    return docs
+
+
+class FakeCursor(object):
+
+    def __init__(self, collection, spec, fields=None, as_class=dict):
+        self.collection = collection
+        self.spec = spec
+        self.fields = fields
+        self.as_class = as_class
+        self.sort_keys = []
+        self.skip_count = 0
+        self.limit_count = 0
+        self.results = None
+
+    def sort(self, key_or_list, direction=pymongo.ASCENDING):
+        if type(key_or_list) is list:
+            self.sort_keys = key_or_list
+        else:
+            self.sort_keys = [(key_or_list, direction)]
+        return self
+
+    def skip(self, count):
+        self.skip_count = count
+        return self
+
+    def limit(self, count):
+        self.limit_count = count
+        return self
+
+    def batch_size(self, size):
+        return self
+
+    def count(self, with_limit_and_skip=False):
+        total = len(self.collection.matches(self.spec))
+        if with_limit_and_skip:
+            total = max(total - self.skip_count, 0)
+            if self.limit_count:
+                total = min(total, self.limit_count)
+        return total
+
+    def explain(self):
+        index = self.collection.query_index(self.spec)
+        cursor = 'BasicCursor' if index is None else 'BtreeCursor ' + index
+        return {
+            'cursor': cursor,
+            'nscannedObjects': len(self.collection.docs),
+            'n': self.count()
+        }
+
+    def fetch(self):
+        docs = self.collection.matches(self.spec)
+        if self.sort_keys:
+            docs = sort_docs(docs, self.sort_keys)
+        docs = docs[self.skip_count:]
+        if self.limit_count:
+            docs = docs[:self.limit_count]
+        return [project(doc, self.fields, self.as_class) for doc in docs]
+
+    def __iter__(self):
+        return self
+
+    def next(self):
+        if self.results is None:
+            self.results = iter(self.fetch())
+        return next(self.results)
+
+
+class FakeBulkFind(object):
+
+    def __init__(self, bulk, spec):
+        self.bulk = bulk
+        self.spec = spec
+        self.upserted = False
+
+    def upsert(self):
+        self.upserted = True
+        return self
+
+    def update_one(self, document):
+        self.bulk.ops.append(('update', self.spec, document, self.upserted, False))
+
+    def update(self, document):
+        self.bulk.ops.append(('update', self.spec, document, self.upserted, True))
+
+    def replace_one(self, document):
+        self.update_one(document)
+
+    def remove_one(self):
+        self.bulk.ops.append(('remove', self.spec, None, False, False))
+
+    def remove(self):
+        self.bulk.ops.append(('remove', self.spec, None, False, True))
+
+
+class FakeBulk(object):
+
+    def __init__(self, collection, ordered):
+        self.collection = collection
+        self.ordered = ordered
+        self.ops = []
+
+    def insert(self, doc):
+        self.ops.append(('insert', None, doc, False, False))
+
+    def find(self, spec):
+        return FakeBulkFind(self, spec)
+
+    def execute(self, write_concern=None):
+        result = {
+            'nInserted': 0,
+            'nMatched': 0,
+            'nModified': 0,
+            'nUpserted': 0,
+            'nRemoved': 0,
+            'upserted': [],
+            'writeErrors': [],
+            'writeConcernErrors': []
+        }
+
+        for idx, (op, spec, document, upsert, multi) in enumerate(self.ops):
+            try:
+                if op == 'insert':
+                    self.collection.insert(document)
+                    result['nInserted'] += 1
+                elif op == 'update':
+                    status = self.collection.update(spec, document, upsert, multi=multi)
+                    if status['updatedExisting']:
+                        result['nMatched'] += status['n']
+                        result['nModified'] += status['n']
+                    elif 'upserted' in status:
+                        result['nUpserted'] += 1
+                        result['upserted'].append(
+                            {'index': idx, '_id': status['upserted']})
+                else:
+                    result['nRemoved'] += self.collection.remove(spec, multi=multi)['n']
+            except DuplicateKeyError as e:
+                result['writeErrors'].append(
+                    {'index': idx, 'code': 11000, 'errmsg': str(e), 'op': document})
+                if self.ordered:
+                    break
+
+        if result['writeErrors']:
+            raise BulkWriteError(result)
+        return result
+
+
+class FakeCollection(object):
+
+    def __init__(self, database, name):
+        self.database = database
+        self.name = name
+        self.docs = OrderedDict()
+        self.indexes = OrderedDict([('_id_', [('_id', pymongo.ASCENDING)])])
+
+    @property
+    def full_name(self):
+        return '.'.join([self.database.name, self.name])
+
+    def insert(self, doc_or_docs, **kwargs):
+        docs = doc_or_docs if type(doc_or_docs) is list else [doc_or_docs]
+        ids = []
+        for doc in docs:
+            if '_id' not in doc:
+                doc['_id'] = ObjectId()
+            key = id_key(doc['_id'])
+            if key in self.docs:
+                raise DuplicateKeyError(
+                    'E11000 duplicate key error index: {}.$_id_'.format(self.full_name),
+                    11000)
+            self.docs[key] = clone(doc)
+            ids.append(doc['_id'])
+        return ids if type(doc_or_docs) is list else ids[0]
+
+    def save(self, doc, **kwargs):
+        if '_id' not in doc:
+            return self.insert(doc)
+        self.docs[id_key(doc['_id'])] = clone(doc)
+        return doc['_id']
+
+    def update(self, spec, document, upsert=False, manipulate=False,
+            safe=None, multi=False, **kwargs):
+        docs = self.matches(spec)
+        if not multi:
+            docs = docs[:1]
+
+        for doc in docs:
+            apply_update(doc, document)
+
+        if docs or not upsert:
+            return {'n': len(docs), 'updatedExisting': bool(docs), 'ok': 1.0}
+
+        doc = upsert_base(spec)
+        apply_update(doc, document, True)
+        if '_id' not in doc:
+            doc['_id'] = spec.get('_id', ObjectId())
+        self.insert(doc)
+        return {'n': 1, 'updatedExisting': False, 'upserted': doc['_id'], 'ok': 1.0}
+
+    def remove(self, spec_or_id=None, multi=True, **kwargs):
+        if spec_or_id is not None and not isinstance(spec_or_id, dict):
+            spec_or_id = {'_id': spec_or_id}
+
+        docs = self.matches(spec_or_id or {})
+        if not multi:
+            docs = docs[:1]
+        for doc in docs:
+            del self.docs[id_key(doc['_id'])]
+        return {'n': len(docs), 'ok': 1.0}
+
+    def matches(self, spec):
+        spec = clone(spec or {})
+        target = spec.get('_id')
+        if '_id' in spec and not is_operator(target):
+            doc = self.docs.get(id_key(target))
+            return [doc] if doc is not None and match(doc, spec) else []
+        return [doc for doc in self.docs.values() if match(doc, spec)]
+
+    def find(self, spec=None, fields=None, skip=0, limit=0, sort=None, 
+            as_class=dict, **kwargs):
+        cursor = FakeCursor(self, spec, fields, as_class).skip(skip).limit(limit)
+        if sort is not None:
+            cursor.sort(sort)
+        return cursor
+
+    def find_one(self, spec_or_id=None, *args, **kwargs):
+        if spec_or_id is not None and not isinstance(spec_or_id, dict):
+            spec_or_id = {'_id': spec_or_id}
+        for doc in self.find(spec_or_id, *args, **kwargs).limit(1):
+            return doc
+        return None
+
+    def count(self):
+        return len(self.docs)
+
+    def distinct(self, key):
+        values = []
+        for doc in self.docs.values():
+            for value in expand(resolve(doc, key)):
+                if type(value) is not list and value not in values:
+                    values.append(value)
+        return values
+
+    def create_index(self, key_or_list, **kwargs):
+        if type(key_or_list) is not list:
+            key_or_list = [(key_or_list, pymongo.ASCENDING)]
+        name = kwargs.get('name') or '_'.join(
+            '{}_{}'.format(key, direction) for key, direction in key_or_list)
+        self.indexes[name] = key_or_list
+        return name
+
+    def ensure_index(self, key_or_list, **kwargs):
+        return self.create_index(key_or_list, **kwargs)
+
+    def index_information(self):
+        return dict((name, {'key': keys}) for name, keys in self.indexes.items())
+
+    def query_index(self, spec):
+        fields = set(key for key in (spec or {}) if not key.startswith('$'))
+        for name, keys in self.indexes.items():
+            if keys[0][0] in fields:
+                return name
+        return None
+
+    def initialize_unordered_bulk_op(self):
+        return FakeBulk(self, False)
+
+    def initialize_ordered_bulk_op(self):
+        return FakeBulk(self, True)
+
+    def rename(self, new_name, **kwargs):
+        if new_name in self.database.collections:
+            if not kwargs.get('dropTarget', False):
+                raise OperationFailure('target namespace exists')
+        del self.database.collections[self.name]
+        self.name = new_name
+        self.database.collections[new_name] = self
+
+    def drop(self):
+        self.database.drop_collection(self.name)
+
+    def replace_docs(self, docs):
+        self.docs = OrderedDict()
+        for doc in docs:
+            self.insert(doc)
+
+    def aggregate(self, pipeline, **kwargs):
+        docs = self.docs.values()
+        if pipeline and pipeline[0].keys() == ['$match']:
+            docs = self.matches(pipeline[0]['$match'])
+            pipeline = pipeline[1:]
+
+        docs = [clone(doc, dict) for doc in 
+            aggregate_docs(self.database, [clone(doc) for doc in docs], pipeline)]
+        if 'cursor' in kwargs:
+            return iter(docs)
+        return {'result': docs, 'ok': 1.0}
+
+    def map_reduce(self, map, reduce, out, full_response=False, **kwargs):
+        start = time.time()
+        plugin, plan = self.database.find_plan(unicode(map))
+        spec = plugin.map_spec(plan.options)
+
+        counts = {'input': 0, 'emit': 0, 'reduce': 0, 'output': 0}
+        groups = OrderedDict()
+        for user in self.matches(kwargs.get('query')):
+            counts['input'] += 1
+            for key, value in plugin.map_user(plan, spec, user):
+                counts['emit'] += 1
+                group = json_util.dumps(key)
+                if group in groups:
+                    counts['reduce'] += 1
+                    value = plugin.reduce_values(plan, [groups[group][1], value])
+                groups[group] = (key, value)
+
+        docs = [{'_id': key, 'value': plugin.finalize_value(plan, key, value)}
+            for key, value in groups.values()]
+        counts['output'] = len(docs)
+
+        response = {
+            'counts': counts,
+            'timeMillis': int((time.time() - start) * 1000),
+            'ok': 1.0
+        }
+        if 'inline' in out:
+            response['results'] = docs
+            return response
+
+        output, collection = out.items()[0]
+        plugin.write_results(self.database, output, collection, plan, docs)
+        response['result'] = collection
+        if full_response:
+            return response
+        return self.database[collection]
+
+
+# map_reduce finds the compiled plan by its mapper, in the database's own plans
+# or its compilers' caches, and evaluates it with the plugin's Python mapper
+# instead of the JS templates. Reads decode documents
+# as plain dicts unless as_class is given, the same as a default pymongo 2.x
+# client, and aggregate interprets the pipeline stages the chart plugins use.
+class FakeDatabase(object):
+
+    def __init__(self, name='dashgourd', compilers=None):
+        self.name = name
+        self.compilers = compilers or [default_compiler]
+        self.plans = {}
+        self.collections = {}
+        self.plugins = {}
+        self.write_concern = {}
+
+    def __getitem__(self, name):
+        if name not in self.collections:
+            self.collections[name] = FakeCollection(self, name)
+        return self.collections[name]
+
+    def __getattr__(self, name):
+        if name.startswith('_'):
+            raise AttributeError(name)
+        return self[name]
+
+    def collection_names(self):
+        return self.collections.keys()
+
+    def drop_collection(self, name):
+        self.collections.pop(name, None)
+
+    def command(self, command, **kwargs):
+        command = SON(command)
+        name = command.keys()[0]
+        if name != 'explain' or command.get('verbosity') != 'queryPlanner':
+            raise OperationFailure('unsupported command {}'.format(name))
+
+        find = command['explain']
+        index = self[find['find']].query_index(find.get('filter'))
+        stage = {'stage': 'COLLSCAN'}
+        if index is not None:
+            stage = {'stage': 'FETCH', 'inputStage': {'stage': 'IXSCAN', 'indexName': index}}
+        return {'queryPlanner': {'winningPlan': stage}, 'ok': 1.0}
+
+    def add_plan(self, plan):
+        self.plans[unicode(plan.mapper)] = plan
+
+    def find_plan(self, mapper):
+        plan = self.plans.get(mapper)
+        for compiler in self.compilers:
+            if plan is not None:
+                break
+            plan = compiler.find(mapper)
+        if plan is None:
+            raise OperationFailure('no compiled chart plan matches this mapper')
+        return self.find_plugin(plan.plugin), plan
+
+    def find_plugin(self, name):
+        if name not in self.plugins:
+            module, cls = name.rsplit('.', 1)
+            self.plugins[name] = getattr(__import__(module, fromlist=[cls]), cls)()
+        return self.plugins[name]
@@ -16,6 +16,14 @@ setup(
     namespace_packages=['dashgourd'],    
     include_package_data=True,
     install_requires=[
-        'pymongo'
-    ]	
+        'pymongo>=2.7,<3'
+    ],
+    extras_require={
+        'numpy': ['numpy']
+    },
+    entry_points={
+        'console_scripts': [
+            'dashgourd = dashgourd.cli:main'
+        ]
+    }
 )
@@ -0,0 +1,74 @@
+from datetime import datetime
+
+from bson.son import SON
+from benchmarks.generator import EventGenerator
+from dashgourd.testing import FakeDatabase
+
+FUNNEL = {
+    'query': {'created_at': {'$gte': datetime(2013, 1, 1)}},
+    'group': [
+        {'attr': 'created_at', 'format': 'monthly'},
+        {'attr': 'plan'}
+    ],
+    'calc': [
+        {'attr': 'signup', 'calc': 'pct'},
+        {'attr': 'buy', 'calc': 'avg',
+            'bucket': {'type': 'range', 'value': [0, 1, [2, 5], [6, None]]}},
+        {'attr': 'buy', 'meta': 'amount', 'calc': 'avg'},
+        {'attr': ['view', 'share'], 'calc': 'pct',
+            'cond': {'type': 'at_least', 'value': 3}}
+    ]
+}
+
+# A plain dict iterates these keys as created_at, plan: the reverse of the
+# group order, so rows only merge if the _id key order survives a read.
+REORDERED = dict(FUNNEL, group=[
+    {'attr': 'plan'},
+    {'attr': 'created_at', 'format': 'monthly'}
+])
+
+ACTION_COHORT = {
+    'query': {},
+    'pivot': 'item',
+    'group': [
+        {'attr': 'plan'},
+        {'type': 'action', 'attr': 'buy', 'meta': 'created_at', 'format': 'monthly'}
+    ],
+    'calc': [{'attr': 'buy', 'meta': 'amount', 'calc': 'avg'}]
+}
+
+RETENTION = {
+    'query': {},
+    'group': [{'attr': 'created_at', 'format': 'weekly'}],
+    'action': 'view'
+}
+
+CHARTS = [
+    ('cohort_funnel', FUNNEL),
+    ('action_cohort', ACTION_COHORT),
+    ('retention', RETENTION)
+]
+
+
+def load_db(users=300, seed=1):
+    db = FakeDatabase()
+    EventGenerator(seed).load(db, users)
+    return db
+
+
+def normalize(value):
+    if isinstance(value, dict):
+        return dict((key, normalize(item)) for key, item in value.items())
+    elif isinstance(value, float):
+        return round(value, 9)
+    return value
+
+
+def chart_rows(db, collection):
+    return sorted((sorted(doc['_id'].items()), normalize(doc['value']))
+        for doc in db[collection].find())
+
+
+def ordered_rows(db, collection):
+    return sorted((doc['_id'].items(), normalize(doc['value']))
+        for doc in db[collection].find(as_class=SON))
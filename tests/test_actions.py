@@ -0,0 +1,136 @@
+import unittest
+from datetime import datetime
+
+from pymongo.errors import AutoReconnect, BulkWriteError
+from dashgourd.api.actions import ActionsApi
+from dashgourd.testing import FakeDatabase
+
+
+class ActionsApiTest(unittest.TestCase):
+
+    def setUp(self):
+        self.db = FakeDatabase()
+        self.api = ActionsApi(self.db)
+        self.api.create_user({'_id': 1, 'created_at': datetime(2014, 1, 1)})
+
+    def action(self, name, day=1):
+        return {'name': name, 'created_at': datetime(2014, 1, day)}
+
+    def test_batch_reports_missing_users(self):
+        results = self.api.insert_actions_batch([
+            (1, self.action('view')),
+            (2, self.action('view')),
+            (1, self.action('buy'))
+        ])
+
+        self.assertEqual(results, [
+            {'ok': True},
+            {'ok': False, 'error': 'user not found'},
+            {'ok': True}
+        ])
+        self.assertEqual(len(self.db.users.find_one({'_id': 1})['actions']), 2)
+
+    def test_unique_batch_skips_duplicates_but_reports_missing_users(self):
+        self.api.insert_action(1, self.action('signup'))
+        results = self.api.insert_actions_batch([
+            (1, self.action('signup', 2)),
+            (2, self.action('signup'))
+        ], unique=True)
+
+        self.assertEqual(results, [
+            {'ok': True},
+            {'ok': False, 'error': 'user not found'}
+        ])
+        self.assertEqual(len(self.db.users.find_one({'_id': 1})['actions']), 1)
+
+
+class FailingCollection(object):
+
+    def __init__(self, collection):
+        self.collection = collection
+
+    def __getattr__(self, name):
+        return getattr(self.collection, name)
+
+    def update(self, *args, **kwargs):
+        raise AutoReconnect('bucket write failed')
+
+    def initialize_unordered_bulk_op(self):
+        bulk = self.collection.initialize_unordered_bulk_op()
+        bulk.execute = self.update
+        return bulk
+
+
+class RejectingCollection(FailingCollection):
+
+    def update(self, *args, **kwargs):
+        raise BulkWriteError({
+            'writeErrors': [{'index': 0, 'code': 2, 'errmsg': 'bucket rejected'}],
+            'writeConcernErrors': []
+        })
+
+
+class BucketedActionsApiTest(unittest.TestCase):
+
+    def setUp(self):
+        self.db = FakeDatabase()
+        self.api = ActionsApi(self.db, layout='bucketed')
+
+    def action(self, name, day=1):
+        return {'name': name, 'created_at': datetime(2014, 1, day)}
+
+    def bucket_actions(self, id):
+        bucket = self.db.action_buckets.find_one({'user_id': id})
+        return bucket['actions'] if bucket else []
+
+    def fail_buckets(self):
+        buckets = self.db.action_buckets
+        self.db.collections['action_buckets'] = FailingCollection(buckets)
+        return buckets
+
+    def test_failed_bucket_write_releases_claim(self):
+        buckets = self.fail_buckets()
+        with self.assertRaises(AutoReconnect):
+            self.api.insert_action(1, self.action('signup'), unique=True)
+        self.assertEqual(self.db.action_keys.count(), 0)
+
+        self.db.collections['action_buckets'] = buckets
+        self.api.insert_action(1, self.action('signup', 2), unique=True)
+        self.assertEqual(len(self.bucket_actions(1)), 1)
+
+    def test_failed_bucket_batch_releases_claims(self):
+        buckets = self.fail_buckets()
+        events = [
+            (1, self.action('signup')),
+            (1, self.action('signup', 2)),
+            (2, self.action('signup'))
+        ]
+        with self.assertRaises(AutoReconnect):
+            self.api.insert_actions_batch(events, unique=True)
+        self.assertEqual(self.db.action_keys.count(), 0)
+
+        self.db.collections['action_buckets'] = buckets
+        results = self.api.insert_actions_batch(events, unique=True)
+        self.assertEqual(results, [{'ok': True}] * 3)
+        self.assertEqual(len(self.bucket_actions(1)), 1)
+        self.assertEqual(len(self.bucket_actions(2)), 1)
+
+    def test_bucket_write_error_releases_claims_and_fails_duplicates(self):
+        self.db.collections['action_buckets'] = RejectingCollection(
+            self.db.action_buckets)
+
+        results = self.api.insert_actions_batch([
+            (1, self.action('signup')),
+            (1, self.action('signup', 2)),
+            (2, self.action('signup'))
+        ], unique=True)
+
+        self.assertEqual(results, [
+            {'ok': False, 'error': 'bucket rejected'},
+            {'ok': False, 'error': 'bucket rejected'},
+            {'ok': True}
+        ])
+        self.assertEqual(self.db.action_keys.count(), 1)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,121 @@
+import gc
+import os
+import shutil
+import tempfile
+import threading
+import time
+import unittest
+import weakref
+from datetime import datetime
+
+from bson import json_util
+
+from dashgourd.api.actions import ActionsApi
+from dashgourd.api.buffered import BufferedActionsWriter, open_writers
+from dashgourd.testing import FakeDatabase
+
+
+class RecordingActionsApi(ActionsApi):
+
+    def __init__(self, db):
+        super(RecordingActionsApi, self).__init__(db)
+        self.calls = []
+
+    def insert_actions_batch(self, events, unique=False):
+        self.calls.append(('insert_actions_batch', [id for id, data in events]))
+        return super(RecordingActionsApi, self).insert_actions_batch(events, unique)
+
+    def update_profile(self, id, data):
+        self.calls.append(('update_profile', [id]))
+        if id == 'broken':
+            raise RuntimeError('profile write failed')
+        super(RecordingActionsApi, self).update_profile(id, data)
+
+
+class BufferedActionsWriterTest(unittest.TestCase):
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.spill_path = os.path.join(self.dir, 'spill.jsonl')
+        self.db = FakeDatabase()
+        self.api = RecordingActionsApi(self.db)
+        for id in (1, 2):
+            self.api.create_user({'_id': id, 'created_at': datetime(2014, 1, 1)})
+        self.writer = BufferedActionsWriter(self.api, batch_size=100,
+            flush_interval=0.05, spill_path=self.spill_path)
+
+    def tearDown(self):
+        self.writer.close()
+        shutil.rmtree(self.dir)
+
+    def action(self, name):
+        return {'name': name, 'created_at': datetime(2014, 1, 2)}
+
+    def spilled(self):
+        with open(self.spill_path) as spill_file:
+            return [tuple(json_util.loads(line)) for line in spill_file]
+
+    def test_keeps_submission_order(self):
+        self.writer.insert_action(1, self.action('view'))
+        self.writer.update_profile(1, {'plan': 'pro'})
+        self.writer.insert_action(2, self.action('view'))
+        self.writer.insert_action(1, self.action('buy'))
+        self.writer.close()
+
+        self.assertEqual(self.api.calls, [
+            ('insert_actions_batch', [1]),
+            ('update_profile', [1]),
+            ('insert_actions_batch', [2, 1])
+        ])
+        self.assertEqual(self.writer.counters['flushed'], 4)
+
+    def test_spills_only_failed_ops(self):
+        self.writer.insert_action(1, self.action('view'))
+        self.writer.update_profile('broken', {'plan': 'pro'})
+        self.writer.insert_action(3, self.action('view'))
+        self.writer.insert_action(2, self.action('view'))
+        self.writer.close()
+
+        self.assertEqual([(method, id) for method, id, data, unique in self.spilled()],
+            [('update_profile', 'broken'), ('insert_action', 3)])
+        self.assertEqual(self.writer.counters['flushed'], 2)
+        self.assertEqual(self.writer.counters['failed'], 2)
+        self.assertEqual(self.writer.counters['spilled'], 2)
+        self.assertEqual(len(self.db.users.find_one({'_id': 1})['actions']), 1)
+        self.assertEqual(len(self.db.users.find_one({'_id': 2})['actions']), 1)
+
+    def test_no_item_is_queued_behind_close(self):
+        def produce():
+            try:
+                while True:
+                    self.writer.insert_action(1, self.action('view'))
+            except ValueError:
+                pass
+
+        producers = [threading.Thread(target=produce) for i in range(4)]
+        for producer in producers:
+            producer.start()
+        while self.writer.counters['queued'] < 100:
+            time.sleep(0.001)
+        self.writer.close()
+        for producer in producers:
+            producer.join()
+
+        counters = self.writer.counters
+        self.assertEqual(counters['queued'], counters['flushed'] + counters['failed'])
+        self.assertTrue(self.writer.queue.empty())
+
+    def test_closed_writers_are_not_kept_alive(self):
+        writer = BufferedActionsWriter(self.api)
+        self.assertIn(writer, open_writers)
+        writer.close()
+        self.assertNotIn(writer, open_writers)
+
+        ref = weakref.ref(writer)
+        del writer
+        gc.collect()
+        self.assertIsNone(ref())
+
+
+if __name__ == '__main__':
+    unittest.main()
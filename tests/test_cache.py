@@ -0,0 +1,105 @@
+import unittest
+
+from bson import BSON
+from dashgourd.api import cache
+from dashgourd.api.cache import ResultCache
+from dashgourd.api.charts import ChartsApi
+from tests.helpers import FUNNEL, RETENTION, load_db
+
+
+class FakeClock(object):
+
+    def __init__(self):
+        self.now = 1000.0
+
+    def time(self):
+        return self.now
+
+
+class ResultCacheTest(unittest.TestCase):
+
+    def setUp(self):
+        self.clock = FakeClock()
+        self.time, cache.time = cache.time, self.clock
+
+    def tearDown(self):
+        cache.time = self.time
+
+    def docs(self, count, width=100):
+        return [{'_id': idx, 'value': 'x' * width} for idx in range(count)]
+
+    def test_entries_expire_after_ttl(self):
+        results = ResultCache(ttl=60)
+        results.put(('chart', None), 1, self.docs(2))
+
+        self.clock.now += 59
+        self.assertEqual(results.get(('chart', None), 1), self.docs(2))
+        self.clock.now += 2
+        self.assertIsNone(results.get(('chart', None), 1))
+        self.assertEqual(results.stats()['entries'], 0)
+
+    def test_evicts_least_recently_used_to_stay_under_max_bytes(self):
+        size = sum(len(BSON.encode(doc)) for doc in self.docs(10))
+        results = ResultCache(max_bytes=size * 5 / 2)
+        for name in ('a', 'b'):
+            results.put((name, None), 1, self.docs(10))
+        results.get(('a', None), 1)
+        results.put(('c', None), 1, self.docs(10))
+
+        self.assertIsNone(results.get(('b', None), 1))
+        self.assertIsNotNone(results.get(('a', None), 1))
+        stats = results.stats()
+        self.assertEqual(stats['evictions'], 1)
+        self.assertEqual(stats['bytes'], size * 2)
+        self.assertFalse(results.put(('big', None), 1, self.docs(100)))
+
+    def test_returned_documents_are_copies(self):
+        results = ResultCache()
+        results.put(('chart', None), 1, self.docs(1))
+        results.get(('chart', None), 1)[0]['value'] = 'changed'
+        self.assertEqual(results.get(('chart', None), 1), self.docs(1))
+
+
+class ChartsApiCacheTest(unittest.TestCase):
+
+    def setUp(self):
+        self.db = load_db(users=60)
+        self.writer = ChartsApi(self.db, cache=ResultCache())
+        # Another process: same database, its own cache.
+        self.reader = ChartsApi(self.db, cache=ResultCache())
+
+    def rows(self, api, collection):
+        return sorted((sorted(doc['_id'].items()), doc['value']['total']['value'])
+            for doc in api.get_chart(collection))
+
+    def test_generation_bump_invalidates_other_processes(self):
+        self.writer.generate_chart('cohort_funnel', 'funnel', FUNNEL)
+        before = self.rows(self.reader, 'funnel')
+
+        query = {'created_at': FUNNEL['query']['created_at'], 'plan': 'pro'}
+        self.writer.generate_chart('cohort_funnel', 'funnel', dict(FUNNEL, query=query))
+        after = self.rows(self.reader, 'funnel')
+
+        self.assertNotEqual(before, after)
+        self.assertEqual(after, self.rows(ChartsApi(self.db), 'funnel'))
+
+    def test_incremental_runs_bump_the_generation(self):
+        options = dict(FUNNEL, incremental=True)
+        self.writer.generate_incremental(
+            self.writer.plugins['cohort_funnel'], 'funnel', options)
+        self.assertEqual(self.writer.get_generation('funnel'), 1)
+
+    def test_failed_runs_bump_the_generation(self):
+        class Broken(object):
+            def run(self, db, collection, options):
+                db[collection].insert({'_id': 'partial'})
+                raise IOError('connection lost')
+
+        self.reader.get_chart('retention')
+        api = ChartsApi(self.db, plugins={'broken': Broken()})
+        self.assertRaises(IOError, api.generate_chart, 'broken', 'retention', RETENTION)
+        self.assertEqual(len(self.reader.get_chart('retention')), 1)
+
+
+if __name__ == '__main__':
+    unittest.main()
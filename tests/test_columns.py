@@ -0,0 +1,36 @@
+import unittest
+
+import numpy as np
+from dashgourd.api.columns import chart_columns, key_array
+
+
+class ChartColumnsTest(unittest.TestCase):
+
+    def test_mixed_keys_keep_their_types(self):
+        keys = key_array([1, u'1', 2.5])
+        self.assertEqual(keys.dtype, object)
+        self.assertEqual(list(keys), [1, u'1', 2.5])
+
+    def test_missing_keys_stay_none(self):
+        self.assertEqual(list(key_array([1, None])), [1, None])
+
+    def test_uniform_keys_are_typed(self):
+        self.assertEqual(key_array([1, 2]).dtype.kind, 'i')
+        self.assertEqual(key_array([u'pro', u'free']).dtype.kind, 'U')
+
+    def test_chart_columns(self):
+        columns = chart_columns([
+            {'_id': {'plan': u'pro'}, 'value': {'signup': {'value': 0.5, 'n': 2}}},
+            {'_id': {'plan': 3}, 'value': {}}
+        ], ['signup'])
+
+        self.assertEqual(columns['size'], 2)
+        self.assertEqual(list(columns['keys']['plan']), [u'pro', 3])
+        signup = columns['values']['signup']
+        self.assertEqual(signup['value'][0], 0.5)
+        self.assertTrue(np.isnan(signup['value'][1]))
+        self.assertTrue(np.isnan(signup['total'][0]))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,64 @@
+import copy
+import unittest
+
+from dashgourd.charts.action_cohort import ActionCohort
+from dashgourd.charts.cohort_funnel import CohortFunnel
+from dashgourd.charts.compiler import ChartCompiler
+from dashgourd.charts.retention import Retention
+from tests.helpers import ACTION_COHORT, FUNNEL, RETENTION
+
+
+class ChartCompilerTest(unittest.TestCase):
+
+    def setUp(self):
+        self.compiler = ChartCompiler(max_size=2)
+        self.funnel = CohortFunnel(compiler=self.compiler)
+
+    def test_same_config_hits_the_cache(self):
+        plan = self.compiler.compile(self.funnel, FUNNEL)
+        again = self.compiler.compile(self.funnel, dict(FUNNEL, output='merge', debug=True))
+
+        self.assertEqual(again, plan)
+        self.assertEqual((self.compiler.hits, self.compiler.misses), (1, 1))
+
+    def test_derived_queries_reuse_the_plan(self):
+        plan = self.compiler.compile(self.funnel, dict(FUNNEL, backend='pipeline'))
+        window = {'$and': [FUNNEL['query'], {'_id': {'$lt': 10}}]}
+        part = self.compiler.compile(self.funnel, 
+            dict(FUNNEL, backend='pipeline', query=window))
+
+        self.assertEqual((self.compiler.hits, self.compiler.misses), (1, 1))
+        self.assertEqual(part.config_hash, plan.config_hash)
+        self.assertEqual(part.query, window)
+        self.assertEqual(part.options['query'], window)
+        self.assertEqual(part.pipeline[0], {'$match': window})
+        self.assertEqual(part.pipeline[1:], plan.pipeline[1:])
+        self.assertEqual(plan.query, FUNNEL['query'])
+
+    def test_least_recently_used_plan_is_evicted(self):
+        first = self.compiler.compile(self.funnel, FUNNEL)
+        second = self.compiler.compile(self.funnel, dict(FUNNEL, group=[{'attr': 'plan'}]))
+        self.compiler.compile(self.funnel, FUNNEL)
+        self.compiler.compile(self.funnel, dict(FUNNEL, group=[{'attr': 'country'}]))
+
+        self.assertEqual(self.compiler.find(first.mapper), first)
+        self.assertIsNone(self.compiler.find(second.mapper))
+
+    def test_missing_query_is_not_compiled(self):
+        self.compiler.compile(self.funnel, FUNNEL)
+        self.assertIsNone(self.compiler.compile(self.funnel, dict(FUNNEL, query=None)))
+
+    def test_compiling_twice_gives_the_same_code(self):
+        for plugin, options in [(CohortFunnel(), FUNNEL), (Retention(), RETENTION),
+                (ActionCohort(), ACTION_COHORT)]:
+            options = dict(options, backend='pipeline')
+            first = plugin.compile(copy.deepcopy(options))
+            second = plugin.compile(copy.deepcopy(options))
+            self.assertEqual(second.mapper, first.mapper)
+            self.assertEqual(second.reducer, first.reducer)
+            self.assertEqual(second.finalizer, first.finalizer)
+            self.assertEqual(second.pipeline, first.pipeline)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,53 @@
+import unittest
+
+from dashgourd.api.charts import ChartsApi
+from dashgourd.charts.formatters import FormatTable
+from dashgourd.testing import FakeDatabase
+
+FIELDS = [
+    {'name': 'plan', 'is_key_col': True, 'data_type': 'string'},
+    {'name': 'signup'}
+]
+
+
+class FormatTableTest(unittest.TestCase):
+
+    def setUp(self):
+        self.db = FakeDatabase()
+        for plan, signup in [('pro', 3), ('free', 9), ('team', 1)]:
+            self.db.table.insert({
+                '_id': {'plan': plan},
+                'value': {'signup': {'value': signup, 'calc': 'sum'}}
+            })
+        self.formatter = FormatTable()
+
+    def test_sort_spec_uses_key_and_value_paths(self):
+        row_order = [{'name': 'signup', 'reverse': True}, {'name': 'plan'}]
+        self.assertEqual(self.formatter.sort_spec(FIELDS, row_order),
+            [('value.signup.value', -1), ('_id.plan', 1)])
+
+    def test_server_sort_matches_python_sort(self):
+        row_order = [{'name': 'signup', 'reverse': True}]
+        docs = ChartsApi(self.db).get_chart('table',
+            sort=self.formatter.sort_spec(FIELDS, row_order))
+
+        rows = list(self.formatter.iter_rows(docs, FIELDS))
+        self.assertEqual(rows, self.formatter.build(
+            self.db.table.find(), FIELDS, row_order)['data'])
+        self.assertEqual([row['plan'] for row in rows], ['free', 'pro', 'team'])
+
+    def test_presorted_rows_are_streamed_in_input_order(self):
+        payload = self.formatter.build_json(iter(self.db.table.find()), FIELDS,
+            [{'name': 'plan'}], presorted=True)
+        self.assertTrue(payload.index('pro') < payload.index('free') < payload.index('team'))
+
+    def test_payload_rows_are_sorted_by_the_server(self):
+        row_order = [{'name': 'signup', 'reverse': True}]
+        payload = ChartsApi(self.db).build_payload('table', 
+            {'formatter': 'table', 'fields': FIELDS, 'row_order': row_order})
+        self.assertEqual(payload, 
+            self.formatter.build_json(self.db.table.find(), FIELDS, row_order))
+
+
+if __name__ == '__main__':
+    unittest.main()
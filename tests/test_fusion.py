@@ -0,0 +1,38 @@
+import unittest
+
+from dashgourd.api.charts import ChartsApi
+from tests.helpers import REORDERED, load_db, ordered_rows
+
+SIGNUP = dict(REORDERED, calc=[{'attr': 'signup', 'calc': 'pct'}])
+BUY = dict(REORDERED, calc=[{'attr': 'buy', 'meta': 'amount', 'calc': 'avg'}])
+
+
+class ChartFusionTest(unittest.TestCase):
+
+    def setUp(self):
+        self.db = load_db()
+        self.api = ChartsApi(self.db)
+        statuses = self.api.generate_charts([
+            ('cohort_funnel', 'fused_signup', SIGNUP),
+            ('cohort_funnel', 'fused_buy', BUY)
+        ], fuse=True)
+        self.assertEqual([status['fused'] for status in statuses], [2, 2])
+
+    def test_fused_output_matches_single_runs(self):
+        self.api.generate_chart('cohort_funnel', 'signup', SIGNUP)
+        self.api.generate_chart('cohort_funnel', 'buy', BUY)
+
+        self.assertEqual(ordered_rows(self.db, 'fused_signup'), 
+            ordered_rows(self.db, 'signup'))
+        self.assertEqual(ordered_rows(self.db, 'fused_buy'), 
+            ordered_rows(self.db, 'buy'))
+
+    def test_reduce_merges_into_fused_output(self):
+        count = self.db.fused_signup.count()
+        self.api.generate_chart('cohort_funnel', 'fused_signup', 
+            dict(SIGNUP, output='reduce'))
+        self.assertEqual(self.db.fused_signup.count(), count)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,32 @@
+import unittest
+
+from dashgourd.api import helper
+from dashgourd.api.actions import ActionsApi
+
+
+class ClientRegistryTest(unittest.TestCase):
+
+    uri = 'mongodb://localhost:27017'
+
+    def tearDown(self):
+        helper.close_clients()
+
+    def test_api_objects_share_one_client(self):
+        first = ActionsApi(self.uri, 'dashgourd')
+        second = ActionsApi(self.uri, 'other')
+        self.assertIs(first.db.connection, second.db.connection)
+        self.assertEqual(second.db.users.full_name, 'other.users')
+
+    def test_api_objects_follow_the_registry_after_fork(self):
+        api = ActionsApi(self.uri, 'dashgourd')
+        parent = api.db.connection
+
+        # What get_client sees in a forked child: a different pid.
+        helper.clients_pid = -1
+        child = api.db.connection
+        self.assertIsNot(child, parent)
+        self.assertIs(child, helper.get_client(self.uri))
+
+
+if __name__ == '__main__':
+    unittest.main()
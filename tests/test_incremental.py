@@ -0,0 +1,65 @@
+import unittest
+from datetime import datetime
+
+from dashgourd.api.actions import ActionsApi
+from dashgourd.api.charts import ChartsApi
+from tests.helpers import ACTION_COHORT, FUNNEL, RETENTION, chart_rows, load_db
+
+
+class IncrementalChartTest(unittest.TestCase):
+
+    def setUp(self):
+        self.db = load_db(users=200)
+        self.charts = ChartsApi(self.db)
+        self.actions = ActionsApi(self.db)
+
+    def change_users(self):
+        user = self.db.users.find_one({'actions.name': {'$ne': 'buy'}})
+        self.actions.insert_action(user['_id'], 
+            {'name': 'buy', 'amount': 30, 'created_at': datetime(2013, 6, 2)})
+        self.actions.insert_action(user['_id'], 
+            {'name': 'view', 'created_at': datetime(2013, 12, 30)})
+        self.actions.create_user({'_id': 'new', 'created_at': datetime(2013, 3, 5),
+            'plan': 'pro'})
+        self.actions.insert_action('new', 
+            {'name': 'signup', 'created_at': datetime(2013, 3, 5)})
+
+    def assert_matches_rebuild(self, plugin, options):
+        options = dict(options, incremental=True)
+        self.charts.generate_chart(plugin, 'chart', options)
+        before = chart_rows(self.db, 'chart')
+
+        self.change_users()
+        self.charts.generate_chart(plugin, 'chart', options)
+        self.charts.generate_chart(plugin, 'rebuild', dict(options, incremental=False))
+
+        self.assertEqual(chart_rows(self.db, 'chart'), chart_rows(self.db, 'rebuild'))
+        self.assertNotEqual(chart_rows(self.db, 'chart'), before)
+
+    def test_funnel_matches_rebuild_after_existing_user_changes(self):
+        self.assert_matches_rebuild('cohort_funnel', FUNNEL)
+
+    def test_pipeline_funnel_matches_rebuild(self):
+        self.assert_matches_rebuild('cohort_funnel', dict(FUNNEL, backend='pipeline'))
+
+    def test_retention_matches_rebuild_after_existing_user_changes(self):
+        self.assert_matches_rebuild('retention', RETENTION)
+
+    def test_no_changes_skip_the_run(self):
+        options = dict(FUNNEL, incremental=True)
+        self.charts.generate_chart('cohort_funnel', 'chart', options)
+        self.assertIsNone(self.charts.generate_chart('cohort_funnel', 'chart', options))
+
+    def test_refuses_configs_it_cannot_rebuild(self):
+        ab = dict(FUNNEL, incremental=True, group=[{'type': 'ab', 'attr': 'checkout'}])
+        for plugin, options in [
+                ('action_cohort', dict(ACTION_COHORT, incremental=True)),
+                ('cohort_funnel', ab),
+                ('cohort_funnel', dict(FUNNEL, incremental=True, layout='bucketed'))]:
+            self.assertRaises(ValueError, 
+                self.charts.generate_chart, plugin, 'chart', options)
+        self.assertEqual(self.db.chart.count(), 0)
+
+
+if __name__ == '__main__':
+    unittest.main()
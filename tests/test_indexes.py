@@ -0,0 +1,81 @@
+import unittest
+from datetime import datetime
+
+from bson.son import SON
+from dashgourd.charts.indexes import IndexAdvisor, explain_query
+from dashgourd.testing import FakeDatabase
+
+
+class IndexAdvisorTest(unittest.TestCase):
+
+    def setUp(self):
+        self.advisor = IndexAdvisor()
+
+    def fields(self, options):
+        return [[field for field, direction in spec]
+            for spec in self.advisor.chart_indexes(options)]
+
+    def test_son_operators_are_ranges(self):
+        query = {'created_at': SON([('$gte', datetime(2014, 1, 1))]), 'plan': 'pro'}
+        self.assertEqual(self.fields({'query': query}), [['plan', 'created_at']])
+
+    def test_embedded_documents_are_equality(self):
+        query = {'address': {'city': 'Oslo'}}
+        self.assertEqual(self.fields({'query': query}), [['address']])
+
+    def test_or_inside_and_is_expanded(self):
+        query = {'$and': [
+            {'created_at': {'$gte': datetime(2014, 1, 1)}},
+            {'$or': [{'plan': 'pro'}, {'country': 'NO'}]}
+        ]}
+        self.assertEqual(self.fields({'query': query}), [
+            ['plan', 'created_at'],
+            ['country', 'created_at']
+        ])
+        self.assertEqual(self.advisor.query_problems(query), [])
+
+    def test_group_fields_and_actions_are_indexed(self):
+        options = {
+            'query': {'created_at': {'$gte': datetime(2014, 1, 1)}},
+            'group': [
+                {'attr': 'created_at', 'format': 'monthly'},
+                {'type': 'ab', 'attr': 'checkout'},
+                {'attr': 'plan'}
+            ],
+            'calc': [{'attr': 'buy', 'calc': 'pct'}]
+        }
+        self.assertEqual(self.fields(options), [
+            ['created_at', 'ab.checkout', 'plan'],
+            ['actions.name']
+        ])
+        self.assertEqual(self.fields(dict(options, layout='bucketed')), [
+            ['created_at', 'ab.checkout', 'plan']
+        ])
+
+    def test_unindexable_branch_is_reported(self):
+        query = {'$or': [{'plan': 'pro'}, {'plan': {'$ne': 'free'}}]}
+        self.assertEqual(self.advisor.query_problems(query),
+            ['no indexable field in plan'])
+
+
+class ExplainQueryTest(unittest.TestCase):
+
+    def setUp(self):
+        self.db = FakeDatabase()
+        for id, plan in enumerate(['free', 'pro', 'pro']):
+            self.db.users.insert({'_id': id, 'plan': plan})
+
+    def test_default_explain_only_plans_the_query(self):
+        self.assertEqual(explain_query(self.db, {'plan': 'pro'}),
+            {'index': None, 'examined': None, 'returned': None})
+
+        name = self.db.users.create_index([('plan', 1)])
+        self.assertEqual(explain_query(self.db, {'plan': 'pro'})['index'], name)
+
+    def test_execution_stats_are_opt_in(self):
+        stats = explain_query(self.db, {'plan': 'pro'}, execution=True)
+        self.assertEqual((stats['examined'], stats['returned']), (3, 2))
+
+
+if __name__ == '__main__':
+    unittest.main()
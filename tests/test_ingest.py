@@ -0,0 +1,31 @@
+import unittest
+from datetime import datetime
+
+from benchmarks.ingest import clear_collections
+from dashgourd.api.actions import ActionsApi
+from dashgourd.testing import FakeDatabase
+
+
+class ClearCollectionsTest(unittest.TestCase):
+
+    def setUp(self):
+        self.api = ActionsApi(FakeDatabase(), layout='bucketed')
+
+    def test_empty_database_needs_no_drop(self):
+        self.assertEqual(clear_collections(self.api), [])
+
+    def test_refuses_to_drop_existing_data(self):
+        self.api.create_user({'_id': 1, 'created_at': datetime(2014, 1, 1)})
+        self.assertRaises(ValueError, clear_collections, self.api)
+        self.assertEqual(self.api.db.users.count(), 1)
+
+    def test_drops_existing_data_when_asked(self):
+        self.api.create_user({'_id': 1, 'created_at': datetime(2014, 1, 1)})
+        self.api.insert_action(1, {'name': 'view', 'created_at': datetime(2014, 1, 2)})
+        self.assertEqual(clear_collections(self.api, drop=True),
+            ['users', 'action_buckets'])
+        self.assertEqual(self.api.db.users.count(), 0)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,60 @@
+import unittest
+from datetime import datetime
+
+from dashgourd.api.actions import ActionsApi
+from dashgourd.api.migrate import MigrateApi
+from dashgourd.testing import FakeDatabase
+
+
+class ConcurrentMigrateApi(MigrateApi):
+
+    def migrate_batch(self, actions_api, users, remove):
+        self.db.users.update({'_id': 1}, {'$push': {'actions': {
+            'name': 'late', 'created_at': datetime(2014, 2, 1)}}})
+        return super(ConcurrentMigrateApi, self).migrate_batch(
+            actions_api, users, remove)
+
+
+class MigrateApiTest(unittest.TestCase):
+
+    def setUp(self):
+        self.db = FakeDatabase()
+        api = ActionsApi(self.db)
+        for id in (1, 2):
+            api.create_user({'_id': id, 'created_at': datetime(2014, 1, 1)})
+            api.insert_actions_batch([
+                (id, {'name': 'view', 'created_at': datetime(2014, 1, 2)}),
+                (id, {'name': 'buy', 'created_at': datetime(2014, 1, 3)})
+            ])
+
+    def bucket_counts(self):
+        return dict((bucket['user_id'], bucket['count'])
+            for bucket in self.db.action_buckets.find())
+
+    def test_moves_actions_to_buckets(self):
+        self.assertEqual(MigrateApi(self.db).actions_to_buckets(), 2)
+        self.assertEqual(self.bucket_counts(), {1: 2, 2: 2})
+        self.assertEqual(self.db.users.find({'actions': {'$exists': True}}).count(), 0)
+
+    def test_keeps_actions_written_during_migration(self):
+        ConcurrentMigrateApi(self.db).actions_to_buckets()
+
+        user = self.db.users.find_one({'_id': 1})
+        self.assertEqual([action['name'] for action in user['actions']], ['late'])
+        self.assertEqual(self.bucket_counts(), {1: 2, 2: 2})
+
+        MigrateApi(self.db).actions_to_buckets()
+        self.assertEqual(self.db.action_buckets.find({'user_id': 1}).count(), 2)
+        self.assertNotIn('actions', self.db.users.find_one({'_id': 1}))
+
+    def test_rerun_does_not_duplicate_actions(self):
+        api = MigrateApi(self.db)
+        api.actions_to_buckets(remove=False)
+        api.actions_to_buckets()
+
+        self.assertEqual(self.bucket_counts(), {1: 2, 2: 2})
+        self.assertEqual(self.db.users.find({'actions': {'$exists': True}}).count(), 0)
+
+
+if __name__ == '__main__':
+    unittest.main()
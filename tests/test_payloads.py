@@ -0,0 +1,64 @@
+import json
+import unittest
+
+from dashgourd.api.charts import ChartsApi, NOT_MODIFIED
+from dashgourd.charts.formatters import FormatCombo
+from tests.helpers import FUNNEL, load_db
+
+COMBO = {
+    'formatter': 'combo',
+    'fields': [{'name': 'pct_signup'}],
+    'group': {'name': 'created_at'},
+    'split': 'plan'
+}
+
+
+class PayloadTest(unittest.TestCase):
+
+    def setUp(self):
+        self.db = load_db(users=100)
+        self.api = ChartsApi(self.db)
+
+    def generate(self, formats):
+        return self.api.generate_chart('cohort_funnel', 'funnel', 
+            dict(FUNNEL, formats=formats))
+
+    def test_formatter_errors_do_not_fail_the_run(self):
+        self.generate({'combo': COMBO})
+        broken = dict(COMBO, fields=[{'name': 'missing'}])
+        stats = self.generate({'broken': broken, 'combo': COMBO})
+
+        self.assertEqual(type(stats), dict)
+        self.assertIsNotNone(self.api.get_formatted('funnel', 'combo'))
+        self.assertIsNone(self.api.get_formatted('funnel', 'broken'))
+
+    def test_payload_rows_are_sorted(self):
+        self.generate({})
+        docs = list(self.db.funnel.find())
+        self.db.funnel.remove()
+        for doc in reversed(docs):
+            self.db.funnel.insert(doc)
+
+        config = dict(COMBO)
+        del config['formatter']
+        expected = FormatCombo().build_json(
+            sorted(docs, key=lambda doc: doc['_id']['created_at']), **config)
+        payload = self.api.build_payload('funnel', COMBO)
+
+        self.assertEqual(payload, expected)
+        dates = [row['c'][0]['v'] for row in json.loads(payload)['rows']]
+        self.assertEqual(len(dates), len(set(dates)))
+
+    def test_get_formatted_returns_payload_and_etag(self):
+        self.generate({'combo': COMBO})
+        current = self.api.get_formatted('funnel', 'combo')
+        self.assertEqual(sorted(current), ['created_at', 'etag', 'payload'])
+
+        self.assertIs(self.api.get_formatted('funnel', 'combo', 
+            '"{}"'.format(current['etag'])), NOT_MODIFIED)
+        self.assertEqual(self.api.get_formatted('funnel', 'combo', 'stale'), current)
+        self.assertIsNone(self.api.get_formatted('funnel', 'other'))
+
+
+if __name__ == '__main__':
+    unittest.main()
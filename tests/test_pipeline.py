@@ -0,0 +1,46 @@
+import unittest
+
+from bson.son import SON
+
+from dashgourd.api.charts import ChartsApi
+from tests.helpers import CHARTS, FUNNEL, chart_rows, load_db
+
+REORDERED = dict(FUNNEL, backend='pipeline', group=[
+    {'attr': 'plan'},
+    {'attr': 'created_at', 'format': 'monthly'}
+])
+
+
+class PipelineTest(unittest.TestCase):
+
+    def setUp(self):
+        self.db = load_db()
+        self.api = ChartsApi(self.db)
+
+    def test_matches_map_reduce(self):
+        for plugin, options in CHARTS:
+            self.api.generate_chart(plugin, 'mapreduce', options)
+            self.api.generate_chart(plugin, 'pipeline', dict(options, backend='pipeline'))
+            self.assertEqual(chart_rows(self.db, 'pipeline'), chart_rows(self.db, 'mapreduce'))
+
+    def test_merge_updates_existing_rows(self):
+        self.api.generate_chart('cohort_funnel', 'chart', REORDERED)
+        expected = chart_rows(self.db, 'chart')
+
+        self.api.generate_chart('cohort_funnel', 'chart', dict(REORDERED, output='merge'))
+        self.assertEqual(chart_rows(self.db, 'chart'), expected)
+
+    def test_reduce_adds_into_existing_rows(self):
+        self.api.generate_chart('cohort_funnel', 'single', REORDERED)
+        self.api.generate_chart('cohort_funnel', 'chart', REORDERED)
+        self.api.generate_chart('cohort_funnel', 'chart', dict(REORDERED, output='reduce'))
+        self.assertEqual(self.db.chart.count(), self.db.single.count())
+
+        for single in self.db.single.find(as_class=SON):
+            chart = self.db.chart.find_one({'_id': single['_id']})
+            self.assertEqual(chart['value']['total']['value'],
+                2 * single['value']['total']['value'])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,128 @@
+import sys
+import unittest
+from StringIO import StringIO
+from datetime import datetime, timedelta
+
+from dashgourd.api.charts import ChartsApi
+from tests.helpers import FUNNEL, RETENTION, chart_rows, load_db
+
+
+class BrokenChart(object):
+
+    def run(self, db, collection, options):
+        raise RuntimeError('map_reduce failed')
+
+
+class ChartRunsTest(unittest.TestCase):
+
+    def setUp(self):
+        self.db = load_db(users=50)
+        self.api = ChartsApi(self.db)
+
+    def record(self, collection, wall_time, days=0):
+        run = self.api.record_run('cohort_funnel', collection, {
+            'wall_time': wall_time, 
+            'config_hash': '{}-{}'.format(collection, days)
+        })
+        self.db.chart_runs.update({'_id': run['_id']},
+            {'$set': {'created_at': datetime(2014, 1, 1) + timedelta(days=days)}})
+
+    def test_debug_runs_are_not_recorded(self):
+        stdout, sys.stdout = sys.stdout, StringIO()
+        try:
+            self.api.generate_chart('cohort_funnel', 'funnel', dict(FUNNEL, debug=True))
+        finally:
+            sys.stdout = stdout
+        self.assertEqual(self.db.chart_runs.count(), 0)
+        self.assertEqual(self.api.get_generation('funnel'), 0)
+
+    def test_failing_hook_does_not_fail_the_chart(self):
+        seen = []
+        def broken(run):
+            raise IOError('statsd is down')
+
+        self.api.add_hook(broken)
+        self.api.add_hook(seen.append)
+        stats = self.api.generate_chart('retention', 'retention', RETENTION)
+
+        self.assertEqual(type(stats), dict)
+        self.assertEqual([run['collection'] for run in seen], ['retention'])
+
+    def test_failed_chart_does_not_stop_the_batch(self):
+        self.api.plugins['broken'] = BrokenChart()
+        statuses = self.api.generate_charts([
+            ('cohort_funnel', 'funnel', FUNNEL),
+            ('broken', 'broken', {}),
+            ('cohort_funnel', 'invalid', dict(FUNNEL, query=None)),
+            ('retention', 'retention', RETENTION)
+        ], max_workers=2)
+
+        self.assertEqual([status['collection'] for status in statuses], 
+            ['funnel', 'broken', 'invalid', 'retention'])
+        self.assertEqual([status['status'] for status in statuses], 
+            ['ok', 'failed', 'invalid', 'ok'])
+        self.assertIn('map_reduce failed', statuses[1]['error'])
+        self.assertIsNone(statuses[0]['error'])
+
+        self.api.generate_chart('cohort_funnel', 'single', FUNNEL)
+        self.assertEqual(chart_rows(self.db, 'funnel'), chart_rows(self.db, 'single'))
+        self.assertTrue(self.db.retention.count() > 0)
+        self.assertEqual(self.api.get_generation('broken'), 1)
+
+    def test_explain_reports_the_plan_without_running_it(self):
+        report = self.api.generate_chart('cohort_funnel', 'funnel', dict(FUNNEL, explain=True))
+
+        self.assertEqual(report['backend'], 'mapreduce')
+        self.assertEqual(report['query'], FUNNEL['query'])
+        self.assertIn('emit(', report['mapper'])
+        self.assertEqual(report['query_plan']['index'], None)
+        self.assertEqual(report['problems'], ['query plan does not use an index'])
+        self.assertEqual(report['matched'], self.db.users.find(FUNNEL['query']).count())
+        self.assertEqual(report['sampled'], report['matched'])
+        self.assertTrue(report['groups']['exact'])
+        self.assertEqual(self.db.chart_runs.count(), 0)
+        self.assertEqual(self.db.funnel.count(), 0)
+
+        stats = self.api.generate_chart('cohort_funnel', 'funnel', FUNNEL)
+        self.assertEqual(report['emits']['estimate'], stats['counts']['emit'])
+        self.assertEqual(report['groups']['sampled'], self.db.funnel.count())
+
+    def test_explain_uses_indexes_and_samples(self):
+        self.api.ensure_indexes([('cohort_funnel', 'funnel', FUNNEL)])
+        report = self.api.generate_chart('cohort_funnel', 'funnel', 
+            dict(FUNNEL, backend='pipeline', explain=True, explain_sample=10))
+
+        self.assertIsNotNone(report['query_plan']['index'])
+        self.assertEqual(report['problems'], [])
+        self.assertEqual(report['pipeline'][0], {'$match': FUNNEL['query']})
+        self.assertEqual(report['sampled'], 10)
+        self.assertFalse(report['groups']['exact'])
+        self.assertEqual(self.db.funnel.count(), 0)
+
+    def test_rank_charts(self):
+        self.record('a', 1.0, days=0)
+        self.record('a', 3.0, days=2)
+        self.record('b', 4.0, days=1)
+        self.record('c', 0.5, days=3)
+        self.api.record_run('cohort_funnel', 'd', {'wall_time': None})
+
+        ranked = self.api.slowest_charts(limit=2)
+        self.assertEqual([chart['collection'] for chart in ranked], ['b', 'a'])
+        self.assertEqual(ranked[1]['runs'], 2)
+        self.assertEqual(ranked[1]['total'], 4.0)
+        self.assertEqual(ranked[1]['max'], 3.0)
+        self.assertEqual(ranked[1]['avg'], 2.0)
+        self.assertEqual(ranked[1]['last_run'], datetime(2014, 1, 3))
+        self.assertEqual(ranked[1]['config_hash'], 'a-2')
+
+        since = self.api.slowest_charts(since=datetime(2014, 1, 2, 12))
+        self.assertEqual([chart['collection'] for chart in since], ['a', 'c'])
+
+    def test_run_indexes(self):
+        self.api.ensure_indexes([], runs_ttl=86400)
+        indexes = self.db.chart_runs.index_information()
+        self.assertIn([('created_at', 1)], [index['key'] for index in indexes.values()])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,84 @@
+import os
+import sys
+import unittest
+from StringIO import StringIO
+
+from dashgourd import cli
+from dashgourd.api.charts import ChartsApi
+from dashgourd.scheduler import ChartScheduler
+from tests.helpers import FUNNEL, load_db
+
+
+class ChartSchedulerTest(unittest.TestCase):
+
+    def setUp(self):
+        self.db = load_db(users=50)
+        self.manifest = {'charts': [{
+            'plugin': 'cohort_funnel',
+            'collection': 'funnel',
+            'options': dict(FUNNEL, incremental=True)
+        }]}
+        self.scheduler = ChartScheduler(ChartsApi(self.db), self.manifest, 1)
+
+    def test_builds_and_watermarks_use_separate_collections(self):
+        statuses = self.scheduler.run_once()
+        self.assertEqual([status['status'] for status in statuses], ['ok'])
+
+        self.assertEqual(sorted(self.db.chart_logs.find_one({'_id': 'funnel'})),
+            ['_id', 'last_update'])
+        self.assertEqual(sorted(self.db.chart_builds.find_one({'_id': 'funnel'})),
+            ['_id', 'built_at', 'sources'])
+        self.assertEqual(self.scheduler.run_once(), [])
+
+    def test_run_forever_survives_a_failed_pass(self):
+        passes = []
+        def run_once():
+            passes.append(len(passes))
+            if len(passes) == 1:
+                raise RuntimeError('mongod went away')
+            return []
+
+        reports = []
+        def report(statuses):
+            reports.append(statuses)
+            raise KeyboardInterrupt
+
+        self.scheduler.run_once = run_once
+        self.scheduler.interval = 0
+        self.assertRaises(KeyboardInterrupt, self.scheduler.run_forever, report)
+        self.assertEqual(passes, [0, 1])
+        self.assertEqual(reports, [[]])
+
+
+class CliTest(unittest.TestCase):
+
+    def run_cli(self, argv):
+        environ = dict(os.environ)
+        os.environ.pop('MONGO_URI', None)
+        os.environ.pop('MONGO_DB', None)
+        sys_argv, sys.argv = sys.argv, ['dashgourd'] + argv
+        stderr, sys.stderr = sys.stderr, StringIO()
+        try:
+            with self.assertRaises(SystemExit) as context:
+                cli.main()
+            return context.exception.code, sys.stderr.getvalue()
+        finally:
+            sys.argv = sys_argv
+            sys.stderr = stderr
+            os.environ.clear()
+            os.environ.update(environ)
+
+    def test_requires_mongo_uri(self):
+        code, error = self.run_cli(['scheduler', 'charts.json', '--mongo-db', 'x'])
+        self.assertEqual(code, 2)
+        self.assertIn('MONGO_URI', error)
+
+    def test_requires_mongo_db(self):
+        code, error = self.run_cli(['scheduler', 'charts.json', 
+            '--mongo-uri', 'mongodb://localhost'])
+        self.assertEqual(code, 2)
+        self.assertIn('MONGO_DB', error)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,48 @@
+import shutil
+import tempfile
+import unittest
+from datetime import datetime
+
+from dashgourd.api.actions import ActionsApi
+from dashgourd.charts.retention import Retention
+from dashgourd.snapshot import SnapshotEngine, export_snapshot
+from dashgourd.testing import FakeDatabase
+from tests.helpers import RETENTION, chart_rows, normalize
+
+
+class SnapshotRetentionTest(unittest.TestCase):
+
+    def setUp(self):
+        self.path = tempfile.mkdtemp()
+        self.db = FakeDatabase()
+        self.api = ActionsApi(self.db)
+        for id in (1, 2):
+            self.api.create_user({'_id': id, 'created_at': datetime(2014, 1, id)})
+
+    def tearDown(self):
+        shutil.rmtree(self.path)
+
+    def run_snapshot(self, options):
+        engine = SnapshotEngine(export_snapshot(self.db, self.path))
+        return sorted((sorted(doc['_id'].items()), normalize(doc['value']))
+            for doc in engine.run('retention', options))
+
+    def run_mongo(self, options):
+        Retention().run(self.db, 'retention', options)
+        return chart_rows(self.db, 'retention')
+
+    def test_missing_start_column_returns_empty_result(self):
+        options = dict(RETENTION, group=[{'attr': 'signup_at', 'format': 'weekly'}])
+        self.assertEqual(self.run_snapshot(options), [])
+        self.assertEqual(self.run_mongo(options), [])
+
+    def test_users_without_actions_match_mongo(self):
+        self.assertEqual(self.run_snapshot(RETENTION), self.run_mongo(RETENTION))
+
+    def test_actions_match_mongo(self):
+        self.api.insert_action(1, {'name': 'view', 'created_at': datetime(2014, 1, 9)})
+        self.assertEqual(self.run_snapshot(RETENTION), self.run_mongo(RETENTION))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,96 @@
+import unittest
+from datetime import datetime, timedelta, tzinfo
+
+from bson.son import SON
+from pymongo.errors import OperationFailure
+
+from dashgourd.api.charts import ChartsApi
+from dashgourd.api.migrate import MigrateApi
+from dashgourd.charts.cohort_funnel import CohortFunnel
+from dashgourd.charts.compiler import ChartCompiler
+from dashgourd.testing import FakeDatabase
+from tests.helpers import CHARTS, FUNNEL, REORDERED, chart_rows, load_db, ordered_rows
+
+
+class Offset(tzinfo):
+
+    def utcoffset(self, dt):
+        return timedelta(hours=2)
+
+
+class FakeDatabaseTest(unittest.TestCase):
+
+    def test_reads_decode_as_dict_unless_as_class_is_given(self):
+        db = FakeDatabase()
+        db.charts.insert({'_id': SON([('signup', 1), ('test1', 2)]), 'value': 1})
+
+        self.assertIs(type(db.charts.find_one()['_id']), dict)
+        self.assertIs(type(db.charts.find_one(as_class=SON)['_id']), SON)
+        self.assertEqual(db.charts.find_one(as_class=SON)['_id'].keys(), ['signup', 'test1'])
+
+    def test_embedded_id_matches_in_field_order(self):
+        db = FakeDatabase()
+        db.charts.insert({'_id': SON([('signup', 1), ('test1', 2)])})
+
+        self.assertIsNotNone(db.charts.find_one({'_id': SON([('signup', 1), ('test1', 2)])}))
+        self.assertIsNone(db.charts.find_one({'_id': SON([('test1', 2), ('signup', 1)])}))
+
+    def test_tz_aware_datetimes_are_stored_as_naive_utc(self):
+        db = FakeDatabase()
+        db.logs.insert({'_id': 1, 'at': datetime(2014, 1, 1, 12, tzinfo=Offset())})
+
+        self.assertEqual(db.logs.find_one()['at'], datetime(2014, 1, 1, 10))
+        self.assertIsNotNone(db.logs.find_one(
+            {'at': datetime(2014, 1, 1, 12, tzinfo=Offset())}))
+
+    def test_map_reduce_finds_plans_in_the_databases_compilers(self):
+        db = load_db(50)
+        plugin = CohortFunnel(compiler=ChartCompiler())
+        plan = plugin.compiler.compile(plugin, FUNNEL)
+        db.compilers = [plugin.compiler]
+        plugin.execute(db, 'replace', 'chart', plan)
+        self.assertTrue(db.chart.count() > 0)
+
+    def test_map_reduce_runs_plans_added_to_the_database(self):
+        db = load_db(50)
+        plugin = CohortFunnel(compiler=ChartCompiler(max_size=1))
+        plan = plugin.compiler.compile(plugin, FUNNEL)
+        plugin.compiler.compile(plugin, dict(FUNNEL, group=[{'attr': 'country'}]))
+        self.assertIsNone(plugin.compiler.find(plan.mapper))
+        db.compilers = [plugin.compiler]
+        self.assertRaises(OperationFailure, plugin.execute, db, 'replace', 'evicted', plan)
+
+        db.add_plan(plan)
+        plugin.execute(db, 'replace', 'evicted', plan)
+        self.assertTrue(db.evicted.count() > 0)
+
+    def test_aggregate_reads_bucketed_actions(self):
+        db = load_db(100)
+        api = ChartsApi(db)
+        for plugin, options in CHARTS:
+            api.generate_chart(plugin, plugin + '_embedded', options)
+
+        MigrateApi(db).actions_to_buckets()
+        for plugin, options in CHARTS:
+            api.generate_chart(plugin, plugin, dict(options, layout='bucketed'))
+            self.assertTrue(db[plugin].count() > 0)
+            self.assertEqual(chart_rows(db, plugin), chart_rows(db, plugin + '_embedded'))
+
+    def test_aggregate_merge_saves_over_existing_rows(self):
+        db = load_db(100)
+        api = ChartsApi(db)
+        options = dict(REORDERED, backend='pipeline')
+        api.generate_chart('cohort_funnel', 'full', options)
+
+        api.generate_chart('cohort_funnel', 'chart', dict(options, 
+            query={'$and': [REORDERED['query'], {'plan': 'pro'}]}))
+        stale = {'_id': SON([('plan', 'gone'), ('created_at', '2012/01/01')]), 'value': {}}
+        db.chart.insert(stale)
+        api.generate_chart('cohort_funnel', 'chart', dict(options, output='merge'))
+
+        self.assertEqual(db.chart.count(), db.full.count() + 1)
+        db.chart.remove({'_id': stale['_id']})
+        self.assertEqual(ordered_rows(db, 'chart'), ordered_rows(db, 'full'))
+
+if __name__ == '__main__':
+    unittest.main()